@@ -17,7 +17,7 @@
 # 
 # The `san-diego_california.osm` file is approximately 303.8 MB large; while this is not overwhelmingly large, it is good practice to first work with a sample of your data to reduce processing time in the auditing and cleaning phases.
 # 
-# Below is a snippet I borrowed from Udacity that will help us create our sample from the original file. The code block will investigate every k-th top level element that matches 'node', 'way', or 'relation' and write it (and it's children) out to an outfile named 'sample.osm'.
+# I started from a snippet borrowed from Udacity that wrote every k-th top level element that matches 'node', 'way', or 'relation' (and it's children) out to an outfile named 'sample.osm'. Below it is replaced by a seeded random sample of about 1 in k elements that also keeps the nodes its ways need.
 
 # In[2]:
 
@@ -34,7 +34,7 @@ from collections import defaultdict
 OSM_FILE = "san-diego_california.osm"  # Replace this with your osm file
 SAMPLE_FILE = "sample.osm"
 
-k = 10 # Parameter: take every k-th top level element
+k = 10 # Parameter: sample about 1 in k top level elements
 
 def get_element(osm_file, tags=('node', 'way', 'relation')):
     """Yield element if it is the right type of tag
@@ -50,16 +50,146 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
             root.clear()
 
 
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
+# The Udacity snippet parsed every element into a tree and wrote every k-th one back out. That is slow, since most of the parsed elements are thrown away, and it breaks our map: a sampled way usually points at nodes that were not sampled.
+# 
+# `sample_osm` below never parses the elements it rejects. It scans the raw bytes for top level `<node>`, `<way>` and `<relation>` tags and copies the kept elements to the sample file unchanged. It has two ways of choosing elements, both seeded so the same sample can be produced again:
+# 
+#  - 'bernoulli' keeps each element with probability `fraction` (decided from a hash of the seed and the element's id)
+#  - 'reservoir' keeps exactly `size` elements chosen uniformly at random
+# 
+# With `complete=True` it makes a second pass that also keeps every node referenced by a sampled way, so the sample has no dangling `node_refs`.
+
+# In[ ]:
+
+import hashlib
+import random
+
+ELEMENT_START = re.compile(r'<(node|way|relation)[\s/>]')
+ELEMENT_ID = re.compile(r'''\sid=["'](-?\d+)["']''')
+NODE_REF = re.compile(r'''<nd\s+ref=["'](-?\d+)["']''')
+
+def iter_raw_elements(osm_file, block_size=1 << 22):
+    """
+    Description:
+        Generator scanning an .osm file for top level node/way/relation elements without parsing them
+
+    Args:
+        osm_file (str): The name of the .osm file
+        block_size (int)(optional): The number of bytes read at a time
+
+    Returns:
+        A generator of (tag, id, raw) tuples; raw is the element's bytes up to the start of the next element (so it includes the whitespace after it)
+    """
+    with open(osm_file, 'rb') as fp:
+        buf = fp.read(block_size)
+        pending = None
+        pos = 0
+        while True:
+            match = ELEMENT_START.search(buf, pos)
+            if match:
+                if pending is not None:
+                    yield pending, int(ELEMENT_ID.search(buf, start).group(1)), buf[start:match.start()]
+                pending, start, pos = match.group(1), match.start(), match.end()
+                continue
+            more = fp.read(block_size)
+            if not more:
+                break
+            # Keep the element we are in the middle of (or a few bytes, in case a tag is split between blocks)
+            keep = start if pending is not None else max(pos, len(buf) - 16)
+            buf = buf[keep:] + more
+            pos -= keep
+            if pending is not None:
+                start -= keep
+        if pending is not None:
+            end = buf.rfind('</osm>')
+            yield pending, int(ELEMENT_ID.search(buf, start).group(1)), buf[start:end if end > start else len(buf)]
+
+def keep_element(tag, el_id, fraction, seed):
+    """
+    Description:
+        Function used to decide whether an element is in a bernoulli sample; the same element always gets the same answer for a given seed
+
+    Args:
+        tag (str): 'node', 'way' or 'relation'
+        el_id (int): The element id
+        fraction (float): The probability of keeping an element
+        seed (int): The seed
+
+    Returns:
+        True if the element is kept
+    """
+    return int(hashlib.md5('{}:{}:{}'.format(seed, tag, el_id)).hexdigest()[:8], 16) < fraction * 2 ** 32
+
+def sample_osm(osm_file, sample_file, mode='bernoulli', fraction=0.1, size=None, seed=0, complete=False):
+    """
+    Description:
+        Function used to write a random sample of the top level elements of an .osm file to a new .osm file
+
+    Args:
+        osm_file (str): The name of the .osm file to sample
+        sample_file (str): The name of the sample file to write
+        mode (str)(optional): 'bernoulli' (keep each element with probability fraction) or 'reservoir' (keep exactly size elements)
+        fraction (float)(optional): The probability of keeping an element in 'bernoulli' mode
+        size (int)(optional): The number of elements to keep in 'reservoir' mode
+        seed (int)(optional): The random seed
+        complete (bool)(optional): Also keep every node referenced by a sampled way
+
+    Returns:
+        counts (dict): The number of elements of each type written
+    """
+    if mode not in ('bernoulli', 'reservoir'):
+        raise ValueError("Unknown sampling mode {}".format(mode))
+    if mode == 'reservoir' and not (isinstance(size, (int, long)) and size > 0):
+        raise ValueError("Reservoir sampling needs a positive size, got {!r}".format(size))
+    counts = defaultdict(int)
+    with open(sample_file, 'wb') as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<osm>\n  ')
+
+        if mode == 'reservoir':
+            rng = random.Random(seed)
+            reservoir = []
+            for i, (tag, el_id, raw) in enumerate(iter_raw_elements(osm_file)):
+                if i < size:
+                    reservoir.append((i, tag, el_id, raw))
+                else:
+                    j = rng.randint(0, i)
+                    if j < size:
+                        reservoir[j] = (i, tag, el_id, raw)
+            reservoir.sort()
+            if complete:
+                selected = set(i for i, tag, el_id, raw in reservoir)
+                is_selected = lambda i, tag, el_id: i in selected
+            else:
+                for i, tag, el_id, raw in reservoir:
+                    output.write(raw)
+                    counts[tag] += 1
+        else:
+            is_selected = lambda i, tag, el_id: keep_element(tag, el_id, fraction, seed)
+
+        if mode == 'bernoulli' and not complete:
+            for i, (tag, el_id, raw) in enumerate(iter_raw_elements(osm_file)):
+                if is_selected(i, tag, el_id):
+                    output.write(raw)
+                    counts[tag] += 1
+        elif complete:
+            # First pass: which nodes do our sampled ways need?
+            refs = set()
+            for i, (tag, el_id, raw) in enumerate(iter_raw_elements(osm_file)):
+                if tag == 'way' and is_selected(i, tag, el_id):
+                    refs.update(int(ref) for ref in NODE_REF.findall(raw))
+            for i, (tag, el_id, raw) in enumerate(iter_raw_elements(osm_file)):
+                if is_selected(i, tag, el_id) or (tag == 'node' and el_id in refs):
+                    output.write(raw)
+                    counts[tag] += 1
 
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
+        output.write('</osm>')
+    return dict(counts)
 
-    output.write('</osm>')
+
+# In[ ]:
+
+print sample_osm(OSM_FILE, SAMPLE_FILE, fraction=1.0 / k, seed=0, complete=True)
 
 
 # In[3]:
@@ -69,41 +199,379 @@ sample_size = os.stat('sample.osm')
 print "Original file size:\t{}\nSample file size:\t{}".format(original_size.st_size, sample_size.st_size)
 
 
-# We can see that our sample file size is now approximately 30.8 MB in comparison to our 303.8 MB. This should be large enough to determine some cleaning rules and small enough that our functions will run quickly.
+# Our sample keeps about 1 in k elements plus every node referenced by a sampled way, so it comes out somewhat larger than a tenth of our 303.8 MB (the exact sizes are printed above). This should be large enough to determine some cleaning rules and small enough that our functions will run quickly.
 
 # ## Section 2: General Audit
 # 
 # Now that we have our sample, we should get a sense of what data is available to us. To do this, we will use a SAX parsing method (iterparse) to create a dictionary with tags and their counts to help determine which fields will be critical during our shaping phase.
+# 
+# While we are parsing every tag anyway, we also collect what we need for our field audits (Section 3) in the same pass: the keys belonging to each field we care about and statistics on the values of every key. Keeping every distinct value in a set is fine for our sample but grows without bound on the full file, so instead each key keeps an approximate distinct count (a HyperLogLog sketch, about 3% error in 1 KB) and its most frequent values (a top-k "space saving" sketch). Parsed elements are cleared as we go, so the whole 300 MB file can be profiled in a fixed amount of memory.
+
+# Every pass over the map below reads the same thing from each top level element: its attributes, its `<tag>` key/value pairs and (for ways) its `<nd>` node references. The parsing is done by a "backend" that produces exactly that, so we can pick the fastest parser available at runtime:
+# 
+#  - 'etree': `cElementTree.iterparse`, always available
+#  - 'lxml': lxml's iterparse, asked for top level elements only (used if lxml is installed)
+#  - 'expat': the expat parser driven by callbacks, which never builds Element objects at all
+# 
+# `PARSER_BACKEND` sets the backend used when none is given (None picks lxml if it is installed, etree otherwise). The benchmark below compares them on our sample.
+
+# In[ ]:
+
+from xml.parsers import expat
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+PARSER_BACKEND = None
+TOP_LEVEL = ('node', 'way', 'relation')
+
+def etree_records(osm_file):
+    """
+    Description:
+        Generator reading the top level elements of an .osm file with cElementTree.iterparse
+
+    Args:
+        osm_file (str): The name of the .osm file (or an open file object)
+
+    Returns:
+        A generator of (tag, attributes, tags, refs) tuples; tags is a list of (key, value) pairs and refs a list of node ids
+    """
+    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
+    _, root = next(context)
+    for ev, el in context:
+        if ev == 'end' and el.tag in TOP_LEVEL:
+            yield (el.tag, dict(el.attrib), [(tag.get('k'), tag.get('v')) for tag in el.iter('tag')],
+                   [nd.get('ref') for nd in el.iter('nd')])
+            root.clear()
+
+def lxml_records(osm_file):
+    """
+    Description:
+        Generator reading the top level elements of an .osm file with lxml's iterparse, which only reports the tags we ask for
+
+    Args:
+        osm_file (str): The name of the .osm file (or an open file object)
+
+    Returns:
+        A generator of (tag, attributes, tags, refs) tuples, the same as etree_records
+    """
+    for ev, el in lxml_etree.iterparse(osm_file, events=('end',), tag=TOP_LEVEL):
+        yield (el.tag, dict(el.attrib), [(tag.get('k'), tag.get('v')) for tag in el.iter('tag')],
+               [nd.get('ref') for nd in el.iter('nd')])
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+
+def expat_string(value):
+    """
+    Description:
+        Function used to return a string from expat (always unicode in Python 2) the way ElementTree does: str if it is ascii, unicode otherwise
+
+    Args:
+        value (unicode): The attribute value (may be None)
+
+    Returns:
+        str or unicode
+    """
+    if value is None:
+        return value
+    try:
+        return value.encode('ascii')
+    except UnicodeEncodeError:
+        return value
+
+def expat_records(osm_file, block_size=1 << 20):
+    """
+    Description:
+        Generator reading the top level elements of an .osm file with expat callbacks, without building any Element objects
+
+    Args:
+        osm_file (str): The name of the .osm file (or an open file object)
+        block_size (int)(optional): The number of bytes fed to the parser at a time
+
+    Returns:
+        A generator of (tag, attributes, tags, refs) tuples, the same as etree_records
+    """
+    records = []
+    current = []
+
+    def start(name, attrs):
+        if name in TOP_LEVEL:
+            current.append((expat_string(name), dict((expat_string(k), expat_string(v)) for k, v in attrs.items()), [], []))
+        elif current:
+            if name == 'tag':
+                current[0][2].append((expat_string(attrs.get('k')), expat_string(attrs.get('v'))))
+            elif name == 'nd':
+                current[0][3].append(expat_string(attrs.get('ref')))
+
+    def end(name):
+        if name in TOP_LEVEL:
+            records.append(current.pop())
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    fp = open(osm_file, 'rb') if isinstance(osm_file, basestring) else osm_file
+    try:
+        while True:
+            data = fp.read(block_size)
+            parser.Parse(data, not data)
+            for record in records:
+                yield record
+            del records[:]
+            if not data:
+                break
+    finally:
+        if fp is not osm_file:
+            fp.close()
+
+PARSER_BACKENDS = {'etree': etree_records, 'expat': expat_records}
+if lxml_etree is not None:
+    PARSER_BACKENDS['lxml'] = lxml_records
+
+def iter_records(osm_file, backend=None):
+    """
+    Description:
+        Generator reading the top level elements of an .osm file with the chosen parser backend
+
+    Args:
+        osm_file (str): The name of the .osm file (or an open file object)
+        backend (str)(optional): 'etree', 'lxml' or 'expat', defaults to PARSER_BACKEND
+
+    Returns:
+        A generator of (tag, attributes, tags, refs) tuples, see etree_records
+    """
+    backend = backend or PARSER_BACKEND or ('lxml' if 'lxml' in PARSER_BACKENDS else 'etree')
+    if backend not in PARSER_BACKENDS:
+        raise ValueError("Unknown or unavailable parser backend {}".format(backend))
+    return PARSER_BACKENDS[backend](osm_file)
+
+# In[ ]:
+
+import time
+
+def benchmark_backends(osm_file, backends=None, repeat=3):
+    """
+    Description:
+        Function used to time each parser backend reading an .osm file
+
+    Args:
+        osm_file (str): The name of the .osm file
+        backends (list)(optional): The backends to time, defaults to every available backend
+        repeat (int)(optional): The number of runs per backend; the fastest is kept
+
+    Returns:
+        rates (dict): The number of top level elements read per second by each backend
+    """
+    rates = {}
+    for backend in backends or sorted(PARSER_BACKENDS):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            count = sum(1 for record in iter_records(osm_file, backend))
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        rates[backend] = count / best
+    return rates
+
+
+# In[ ]:
+
+for backend, rate in sorted(benchmark_backends(SAMPLE_FILE).items(), key=lambda x: -x[1]):
+    print "{:>6}: {:,.0f} elements/sec".format(backend, rate)
+
+
 
 # In[1]:
 
-def get_tag_frequencies(file_name):
+import heapq
+import math
+import struct
+
+HLL_BITS = 10 # 2 ** 10 registers per sketch
+
+def hll_add(registers, value):
+    """
+    Description:
+        Function used to add a value to a HyperLogLog sketch
+
+    Args:
+        registers (bytearray): The sketch, 2 ** HLL_BITS registers
+        value (str): The value to add
+
+    Returns:
+        None, registers is updated in place
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    h = struct.unpack('<Q', hashlib.md5(value).digest()[:8])[0]
+    index = h >> (64 - HLL_BITS)
+    rest = h & ((1 << (64 - HLL_BITS)) - 1)
+    # Position of the first 1 bit in the remaining bits
+    rank = (64 - HLL_BITS) - rest.bit_length() + 1
+    if rank > registers[index]:
+        registers[index] = rank
+
+def hll_count(registers):
+    """
+    Description:
+        Function used to estimate the number of distinct values added to a HyperLogLog sketch
+
+    Args:
+        registers (bytearray): The sketch
+
+    Returns:
+        The estimated number of distinct values (int)
+    """
+    m = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in registers)
+    zeros = registers.count('\x00')
+    if estimate <= 2.5 * m and zeros:
+        # Small range correction
+        estimate = m * math.log(float(m) / zeros)
+    return int(round(estimate))
+
+def new_top_k():
+    """
+    Description:
+        Function used to create an empty space saving top-k sketch
+
+    Returns:
+        sketch (dict): 'counts' maps values to their (over)estimated counts, 'heap' is used to find the least frequent value
+    """
+    return {'counts': {}, 'heap': []}
+
+def top_k_add(sketch, value, capacity):
+    """
+    Description:
+        Function used to add a value to a space saving top-k sketch; once the sketch is full the least frequent value is replaced.
+        Heap entries are only refreshed when they reach the top, so counting a value already in the sketch is a single dict update.
+
+    Args:
+        sketch (dict): The sketch from new_top_k
+        value (str): The value to add
+        capacity (int): The maximum number of values kept
+
+    Returns:
+        None, sketch is updated in place
+    """
+    counts, heap = sketch['counts'], sketch['heap']
+    if value in counts:
+        counts[value] += 1
+        return
+    if len(counts) < capacity:
+        counts[value] = 1
+        heapq.heappush(heap, (1, value))
+        return
+    while True:
+        count, smallest = heapq.heappop(heap)
+        if counts[smallest] == count:
+            break
+        heapq.heappush(heap, (counts[smallest], smallest))
+    del counts[smallest]
+    counts[value] = count + 1
+    heapq.heappush(heap, (count + 1, value))
+
+AUDIT_FAMILIES = [
+    ('housenumber', lambda key: 'housenumber' in key),
+    ('postcode', lambda key: 'postcode' in key or 'zip' in key),
+    ('street', lambda key: 'street' in key),
+    ('city', lambda key: 'city' in key and key != 'capacity'),
+    ('phone', lambda key: 'phone' in key),
+    ('amenity', lambda key: 'amenity' in key),
+    ('cuisine', lambda key: 'cuisine' in key),
+]
+
+def profile_osm(file_name, top_k=20, family_top_k=5000, backend=None):
+    """
+    Description:
+        Function used to audit a .osm file in a single pass: tag frequencies, the keys belonging to each of our AUDIT_FAMILIES,
+        and an approximate distinct count plus most frequent values for every key and family.
+
+    Args:
+        file_name (str): The name of the file to be parsed
+        top_k (int)(optional): The number of most frequent values kept for each key
+        family_top_k (int)(optional): The number of most frequent values kept for each family; these are the values we audit by eye later
+        backend (str)(optional): The parser backend (see iter_records)
+
+    Returns:
+        profile (dict): 'elements' counts each element type, 'tag_freq' counts the tags on nodes and ways (the same as get_tag_frequencies),
+            'keys' maps each key to its 'count', 'hll' and 'top' sketches and 'families' maps each family to its 'keys' (set), 'hll' and 'values' sketches
+            (the values themselves are in the 'counts' of each top-k sketch)
+    """
+    profile = {'elements': defaultdict(int), 'tag_freq': defaultdict(int), 'keys': {},
+               'families': dict((family, {'keys': set(), 'hll': bytearray(2 ** HLL_BITS), 'values': new_top_k()}) for family, match in AUDIT_FAMILIES)}
+    key_families = {}
+
+    for kind, attrib, tags, refs in iter_records(file_name, backend):
+        profile['elements'][kind] += 1
+        for tag_key, tag_val in tags:
+            if kind != 'relation':
+                profile['tag_freq'][tag_key] += 1
+            stats = profile['keys'].get(tag_key)
+            if stats is None:
+                stats = profile['keys'][tag_key] = {'count': 0, 'hll': bytearray(2 ** HLL_BITS), 'top': new_top_k()}
+                key_families[tag_key] = [family for family, match in AUDIT_FAMILIES if match(tag_key)]
+            stats['count'] += 1
+            hll_add(stats['hll'], tag_val)
+            top_k_add(stats['top'], tag_val, top_k)
+            for family in key_families[tag_key]:
+                family_stats = profile['families'][family]
+                family_stats['keys'].add(tag_key)
+                hll_add(family_stats['hll'], tag_val)
+                top_k_add(family_stats['values'], tag_val, family_top_k)
+    return profile
+
+def get_tag_frequencies(file_name, backend=None):
     """
     Description:
         Function used to return the unique/distinct tags from a .osm file by iteratively parsing said file and examining each node and way element's child tags.
     
     Args:
         file_name (str): The name of the file to be parsed
+        backend (str)(optional): The parser backend (see iter_records)
         
     Returns:
         tag_freq (dict): A dictionary containing the tags and frequencies at which they occur in the file. 
     """
-    tag_freq = defaultdict(int)
+    return profile_osm(file_name, backend=backend)['tag_freq']
+
+def key_summary(profile, key, top=5):
+    """
+    Description:
+        Function used to summarize the values of one key from a profile
 
-    for ev, el, in ET.iterparse(file_name):
-        if el.tag == 'node' or el.tag == 'way':
-            for tag in el.iter('tag'):
-                tag_freq[tag.get('k')] += 1
-    return tag_freq
+    Args:
+        profile (dict): The output of profile_osm
+        key (str): The tag key
+        top (int)(optional): The number of most frequent values to show
+
+    Returns:
+        A tuple of (number of tags, approximate distinct values, list of (value, count) most frequent first)
+    """
+    stats = profile['keys'][key]
+    values = sorted(stats['top']['counts'].items(), key=lambda item: -item[1])[:top]
+    return stats['count'], hll_count(stats['hll']), values
 
 
 # In[10]:
 
-tag_freq = get_tag_frequencies('sample.osm')
+profile = profile_osm('sample.osm')
+tag_freq = profile['tag_freq']
 print "{} unique tags in our data set\n".format(len(tag_freq))
 pp.pprint(dict(tag_freq))
 
 
+# In[ ]:
+
+for key in ['amenity', 'cuisine', 'name', 'addr:street', 'addr:postcode']:
+    if key in profile['keys']:
+        count, distinct, values = key_summary(profile, key)
+        print "{}: {} tags, ~{} distinct values, most common {}".format(key, count, distinct, values)
+
+
 # 433 tags is a lot to handle but our analysis is not dependant on a lot of these fields. 
 # 
 # In our analysis later on, we will be looking mostly at address and amenity tag data so we will need to find which other tags relate to our interests from these 433. (Ex: we will be looking at the distribution of different types of fast food so we will need to clean the name and cuisine fields as well as amenity)
@@ -127,7 +595,7 @@ pp.pprint(dict(tag_freq))
 #                   "user":"linuxUser16",
 #                   "uid":"1219059"
 #                 },
-#         "pos": [41.9757030, -87.6921867],
+#         "pos": {"type": "Point", "coordinates": [-87.6921867, 41.9757030]},
 #         "address": {
 #                   "housenumber": "5157",
 #                   "postcode": "60625",
@@ -139,6 +607,8 @@ pp.pprint(dict(tag_freq))
 #         "phone": "1 (773)-271-5176"
 #     }
 # 
+# The model above stored `pos` as a `[lat, lon]` pair; since the OSM attributes are strings that would leave us with two strings, which Mongo cannot index or query geographically. We store positions as GeoJSON points instead: numbers, longitude first, which is the form Mongo's `2dsphere` index expects.
+# 
 # Some entries will not have all of these tags, some will have far more; these are the tags we will be using in our analysis later so these are what we will prioritize cleaning. 
 # 
 # **We will still retain entries that contain most of this data (like type, id, and our created fields) as well as the additional tags that we are not interested in at this time for potential later use.**
@@ -162,66 +632,138 @@ pp.pprint(dict(tag_freq))
 # After I completed this list, I looked for potential to automate this since it was a pain to examine 433 unique keys. I found that the keys were generally self explanatory, if we are looking for housenumber data, typically the key had 'housenumber' in it's name even if it were prefixed by something like 'addr:' or 'tiger:'. One caveat was that 'city' yielded more keys than necessary, so I had to add an extra check to make sure 'capacity' was not added.
 # 
 # Next I realized that since I would be parsing each tag in our sample data, I might as well add it's value to a set as well so that I could later glance at the unique values in our sample and derive cleaning rules for once our data is shaped.
+# 
+# Both of these now happen in the single pass of `profile_osm` above (see `AUDIT_FAMILIES` for the rules), so here we only pull the keys and the most frequent values of each family out of our profile.
 
 # In[77]:
 
-housenumber = set()
-house_keys = set()
-
-postcode = set()
-postcode_keys = set()
-
-street = set()
-street_keys = set()
-
-city = set()
-city_keys = set()
-
-phone = set()
-phone_keys = set()
-
-amenity = set()
-amenity_keys = set()
-
-cuisine = set()
-cuisine_keys = set()
-
-for ev, el in ET.iterparse('sample.osm'):
-        tag_list = el.iter('tag')
-        if len(list(tag_list)) > 0:
-            for tag in el.iter('tag'):
-                tag_key = tag.get('k')
-                tag_val = tag.get('v')
-                if 'housenumber' in tag_key:
-                    housenumber.add(tag_val)
-                    house_keys.add(tag_key)
-                if 'postcode' in tag_key or 'zip' in tag_key:
-                    postcode.add(tag_val)
-                    postcode_keys.add(tag_key)
-                if 'street' in tag_key:
-                    street.add(tag_val)
-                    street_keys.add(tag_key)
-                if 'city' in tag_key and (tag_key != 'capacity'):
-                    city.add(tag_val)
-                    city_keys.add(tag_key)
-                if 'phone' in tag_key:
-                    phone.add(tag_val)
-                    phone_keys.add(tag_key)
-                if 'amenity' in tag_key:
-                    amenity.add(tag_val)
-                    amenity_keys.add(tag_key)
-                if 'cuisine' in tag_key:
-                    cuisine.add(tag_val)
-                    cuisine_keys.add(tag_key)
+families = profile['families']
+
+housenumber = set(families['housenumber']['values']['counts'])
+house_keys = families['housenumber']['keys']
+
+postcode = set(families['postcode']['values']['counts'])
+postcode_keys = families['postcode']['keys']
+
+street = set(families['street']['values']['counts'])
+street_keys = families['street']['keys']
+
+city = set(families['city']['values']['counts'])
+city_keys = families['city']['keys']
+
+phone = set(families['phone']['values']['counts'])
+phone_keys = families['phone']['keys']
+
+amenity = set(families['amenity']['values']['counts'])
+amenity_keys = families['amenity']['keys']
+
+cuisine = set(families['cuisine']['values']['counts'])
+cuisine_keys = families['cuisine']['keys']
+
+for family in sorted(families):
+    print "{}: {} keys, ~{} distinct values".format(family, len(families[family]['keys']), hll_count(families[family]['hll']))
 
 
 # ## Section 4: Shaping
 # 
 # Now that we have the keys we are interested in, I thought it wise to shape our data first before cleaning, as I find it easier to have consistent field names (i.e. our zip code data will be in address.postcode rather than zip_1, zip_2, and addr:zip_1) when cleaning similar fields of data.
+# 
+# Building one big list works fine for our sample, but the full file (and any metro extract larger than San Diego) would have to sit in memory twice: once as the parsed XML tree and once as the shaped list. `iter_shaped` yields one document at a time and clears each element after it is shaped, so the later stages can consume it lazily.
 
 # In[2]:
 
-def shape_data(map_file):
+def geojson_point(lat, lon):
+    """
+    Description:
+        Function used to turn a node's lat/lon attributes into a GeoJSON point
+
+    Args:
+        lat (str): The latitude attribute (may be None)
+        lon (str): The longitude attribute (may be None)
+
+    Returns:
+        point (dict): {"type": "Point", "coordinates": [lon, lat]} with float coordinates, None if the node has no position
+    """
+    if lat is None or lon is None:
+        return None
+    return {'type': 'Point', 'coordinates': [float(lon), float(lat)]}
+
+def shape_record(kind, attrib, tags, refs=()):
+    """
+    Description:
+        Function used to shape a single node/way into the data model used for this project (see shape_data below), from its parts
+        rather than from a parsed Element, so readers of other formats can use the same logic
+
+    Args:
+        kind (str): 'node' or 'way'
+        attrib (dict): The element's attributes (id, lat, lon, version, changeset, user, uid, timestamp) as strings; lat and lon
+            become the GeoJSON point in pos (left out for nodes without a position, e.g. deletions in a change file)
+        tags (iterable): The element's (key, value) tag pairs in order
+        refs (iterable)(optional): The ids of a way's nodes as strings
+
+    Returns:
+        node (dict): The element's attributes and tag key values shaped into a python dict
+    """
+    node = {}
+    node['id'] = attrib.get('id')
+    node['type'] = kind
+    if node['type'] == 'node':
+        pos = geojson_point(attrib.get('lat'), attrib.get('lon'))
+        if pos is not None:
+            node['pos'] = pos
+    node['created'] = {'version': attrib.get('version'),                       'changeset': attrib.get('changeset'), 'user': attrib.get('user'),                       'uid': attrib.get('uid'), 'timestamp': attrib.get('timestamp')}
+    node['address'] = {}
+    for key, value in tags:
+        if key in city_keys:
+            node['address']['city'] = value
+        if key in house_keys:
+            node['address']['housenumber'] = value
+        if key in postcode_keys:
+            node['address']['postcode'] = value
+        if key in street_keys:
+            node['address']['street'] = value
+        if key in phone_keys:
+            node['phone_number'] = value
+        elif key[:4] != 'addr':
+            node[key] = value
+    if node['type'] == 'way':
+        node['node_refs'] = list(refs)
+    if len(node['address'].keys()) == 0:
+        del node['address']
+    return node
+
+def shape_element(el):
+    """
+    Description:
+        Function used to shape a single node/way element into the data model used for this project (see shape_data below)
+
+    Args:
+        el (Element): A 'node' or 'way' element produced by iterparse
+
+    Returns:
+        node (dict): The element's attributes and child tag key values shaped into a python dict
+    """
+    return shape_record(el.tag, el.attrib, [(tag.get('k'), tag.get('v')) for tag in el.iter('tag')],
+                        [nd.get('ref') for nd in el.iter('nd')])
+
+def iter_shaped(map_file, backend=None):
+    """
+    Description:
+        Generator version of shape_data; yields one shaped document at a time, and the parser backend drops each element
+        once it has been read, so memory use stays flat regardless of file size.
+
+    Args:
+        map_file (str): The name of the file to be parsed (or an open file object)
+        backend (str)(optional): The parser backend (see iter_records)
+
+    Returns:
+        A generator of dictionaries shaped like the data model in shape_data
+    """
+    for kind, attrib, tags, refs in iter_records(map_file, backend):
+        if kind != 'relation':
+            yield shape_record(kind, attrib, tags, refs)
+
+def shape_data(map_file, backend=None):
     """
     Description:
         Function used to shape an .osm file into the data model used for this project (example model shown below)
@@ -237,7 +779,7 @@ def shape_data(map_file):
                   "user":"linuxUser16",
                   "uid":"1219059"
                 },
-        "pos": [41.9757030, -87.6921867],
+        "pos": {"type": "Point", "coordinates": [-87.6921867, 41.9757030]},
         "address": {
                   "housenumber": "5157",
                   "postcode": "60625",
@@ -251,42 +793,12 @@ def shape_data(map_file):
     
     Args:
         map_file (str): The name of the file to be parsed
+        backend (str)(optional): The parser backend (see iter_records)
         
     Returns:
         master (list): A list of dictionaries containing the node/way elements from the parsed file. Each node/way child tag key value is shaped into a python dict key value.
     """
-    master = []
-    for ev, el in ET.iterparse(map_file):  
-        if el.tag == 'node' or el.tag == 'way':
-            node = {}
-            node['id'] = el.get('id')
-            node['type'] = el.tag
-            if node['type'] == 'node':
-                node['pos'] = [el.get('lat'), el.get('lon')]
-            node['created'] = {'version': el.get('version'),                               'changeset': el.get('changeset'), 'user': el.get('user'),                               'uid': el.get('uid'), 'timestamp': el.get('timestamp')}
-            node['address'] = {}
-            for tag in el.iter('tag'):
-                key = tag.get('k')
-                if key in city_keys:
-                    node['address']['city'] = tag.get('v')
-                if key in house_keys:
-                    node['address']['housenumber'] = tag.get('v')
-                if key in postcode_keys:
-                    node['address']['postcode'] = tag.get('v')
-                if key in street_keys:
-                    node['address']['street'] = tag.get('v')
-                if key in phone_keys:
-                    node['phone_number'] = tag.get('v')
-                elif key[:4] != 'addr':
-                    node[key] = tag.get('v')
-            if node['type'] == 'way':
-                node['node_refs'] = []
-                for nd in el.iter('nd'):
-                    node['node_refs'].append(nd.get('ref'))
-            if len(node['address'].keys()) == 0:
-                del node['address']
-            master.append(node)
-    return master
+    return list(iter_shaped(map_file, backend))
 
 
 # In[175]:
@@ -294,621 +806,3385 @@ def shape_data(map_file):
 sample = shape_data('sample.osm')
 
 
-# Our data is now shaped, so let's start our field audits and move into cleaning.
+# Shaping the full file this way still only uses one core. Since every top level `<node>`, `<way>` and `<relation>` is independent of the others, we can split the file into byte ranges that start at one of these tags, shape each range in its own process and stitch the documents back together in file order.
 
-# ## Section 5: Field Audits and Cleaning Functions
-# 
-# We already have all of our unique entries for the fields we need to audit stored in a set from our key gathering process so let's take a look at each one and determine our cleaning rules before we write our cleaning functions
-# 
-# We will look at the following fields:
-# 
-#     1 - City name
-#     2 - Postcode
-#     3 - Housenumber
-#     4 - Streetname
-#     5 - Phone number
-#     6 - Amenity name/type
-#     7 - Cuisine
-#     8 - Fast Food Names
-#     9 - Place of Worship
-# 
-# Since the goal of this cleaning process is to produce a quality data product, let's remind ourselves of the dimensions of quality data to remind us of what to look for in our audit.
-# 
-# ** Completeness, Consistency, Accuracy, Validity, Uniformity. **
+# In[ ]:
 
-# ### 5.1 City Name
+import io
+import multiprocessing
 
-# In[80]:
+def find_element_start(fp, offset, block_size=1 << 20):
+    """
+    Description:
+        Function used to find the first top level node/way/relation tag at or after a byte offset in an .osm file
 
-for item in city:
-    print item
+    Args:
+        fp (file): The .osm file opened in binary mode
+        offset (int): The byte offset to start searching from
+        block_size (int)(optional): The number of bytes read at a time while searching
 
+    Returns:
+        The byte offset of the next '<node', '<way' or '<relation' tag, or None if there is none
+    """
+    while True:
+        fp.seek(offset)
+        block = fp.read(block_size)
+        if not block:
+            return None
+        match = ELEMENT_START.search(block)
+        if match:
+            return offset + match.start()
+        if len(block) < block_size:
+            return None
+        # Step back a little so a tag split across two blocks is not missed
+        offset += len(block) - 16
+
+def find_chunk_offsets(map_file, chunks):
+    """
+    Description:
+        Function used to split an .osm file into byte ranges that each start at a top level node/way/relation tag
 
-# Great news, nothing to clean here, these are all valid, complete, accurate cities within the San Diego city limit! Lets move on.
+    Args:
+        map_file (str): The name of the .osm file
+        chunks (int): The desired number of ranges (fewer are returned for very small files)
 
-# ### 5.2 Postcode
+    Returns:
+        offsets (list): A list of (start, end) byte offsets in file order
+    """
+    size = os.path.getsize(map_file)
+    with open(map_file, 'rb') as fp:
+        fp.seek(max(0, size - 4096))
+        tail = fp.read()
+        end = size - len(tail) + tail.rfind('</osm>')
+        starts = []
+        for i in range(chunks):
+            start = find_element_start(fp, size * i // chunks)
+            if start is not None and start < end and start not in starts:
+                starts.append(start)
+    return zip(starts, starts[1:] + [end])
+
+def shape_chunk(job):
+    """
+    Description:
+        Function used by our worker processes to shape one byte range of an .osm file
 
-# In[81]:
+    Args:
+        job (tuple): The name of the .osm file, and the start and end byte offsets of the range
 
-for pc in postcode:
-    print pc
+    Returns:
+        A list of the shaped dictionaries in the range, in file order
+    """
+    map_file, start, end = job
+    with open(map_file, 'rb') as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+    return list(iter_shaped(io.BytesIO('<osm>' + data + '</osm>')))
 
+def iter_shaped_parallel(map_file, processes=None, chunks=None, ordered=True):
+    """
+    Description:
+        Parallel version of iter_shaped; shapes byte ranges of the file in a pool of worker processes.
+        The workers are forked, so the key sets from our key gathering step must already be defined.
 
-# We have some minor problems with postcodes here. While these values are all within the San Diego city limits, we have some values in the format XXXXX-XXXX and some that express a range of values for our ways that span multiple postal codes.
-# 
-# **Cleaning Rules**
-#  - If an entry contains a '-' character, split the value at '-' and retain the first 5 digits
-#  - If an entry contains a ':' (denoting a range) fill in the range of postal codes between the two numbers and store the postal code as a list of those values
+    Args:
+        map_file (str): The name of the file to be parsed
+        processes (int)(optional): The number of worker processes, defaults to the number of cores
+        chunks (int)(optional): The number of byte ranges to split the file into, defaults to 4 per process
+        ordered (bool)(optional): If True (default) documents are yielded in file order, the same as iter_shaped.
+            If False each range is yielded as soon as it is shaped, which keeps the workers busier but the order depends on timing.
 
-# In[3]:
+    Returns:
+        A generator of dictionaries shaped like the data model in shape_data
+    """
+    processes = processes or multiprocessing.cpu_count()
+    jobs = [(map_file, start, end) for start, end in find_chunk_offsets(map_file, chunks or processes * 4)]
+    return iter_pool_results(shape_chunk, jobs, processes, ordered)
 
-def clean_postcode(map_dict):
+def iter_pool_results(func, jobs, processes, ordered=True):
     """
     Description:
-        Function used to clean postcode data from our 'shaped' San Diego map file
+        Generator running func on each job in a pool of worker processes and yielding the items of the lists it returns
 
     Args:
-        map_dict (list): A list of dictionaries representing the node/way elements from our map data
+        func (function): A module level function taking a job and returning a list
+        jobs (list): The jobs
+        processes (int): The number of worker processes
+        ordered (bool)(optional): Yield the results in job order (default) or as soon as each job is done
 
     Returns:
-        No return value, outputs data to be cleaned and it's new cleaned value
+        A generator of the items returned by func
     """
-    for entry in map_dict:
-        if 'address' in entry.keys():
-            if 'postcode' in entry['address'].keys():
-                if len(entry['address']['postcode']) > 5:     
-                    if '-' in entry['address']['postcode']:
-                        print  "{} becomes {}".format(entry['address']['postcode'], entry['address']['postcode'][:5]) 
-                        entry['address']['postcode'] = entry['address']['postcode'][:5]
-                        
-                    if ':' in entry['address']['postcode']:
-                        zip_range = entry['address']['postcode'].split(':')                       
-                        print "{} becomes {}".format(entry['address']['postcode'], range(int(zip_range[0]), int(zip_range[1])))
-                        entry['address']['postcode'] = range(int(zip_range[0]), int(zip_range[1]))
+    pool = multiprocessing.Pool(processes)
+    try:
+        if ordered:
+            results = pool.imap(func, jobs)
+        else:
+            results = pool.imap_unordered(func, jobs)
+        for items in results:
+            for item in items:
+                yield item
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 
-# ### 5.3 Housenumber
+# In[ ]:
 
-# In[82]:
+print "Parallel shaping matches: {}".format(list(iter_shaped_parallel('sample.osm')) == sample)
 
-for number in housenumber:
-    if not number.isdigit():
-        print number
 
+# Our shaped documents keep everything as strings inside nested dicts, which costs several hundred bytes per entry; that is fine while streaming, but adds up quickly when millions of nodes have to be held in memory at once. `CompactElement` stores the same information with numeric ids, float coordinates, an integer array for `node_refs`, shared copies of repeated strings (user names, tag keys) and the remaining tags in a tuple of pairs. `to_dict` gives back the regular document whenever we need to write JSON or load Mongo.
 
-# There were far too many house numbers to audit with my own eye and there are very vague rules on what house numbers (that are purely digits) are valid (ex: your house can be 111 or 6666666 and it can still be valid) so I decided for our audit, we would only look that those house numbers with non digit characters in them.
-# 
+# In[ ]:
+
+from array import array
+import calendar
+import time
+
+# Python 2's array has no 64-bit integer type and 'l' is only 32 bits wide where a C long is (Windows); doubles hold
+# every OSM id exactly (they stay well below 2**53)
+ID_TYPECODE = 'l' if array('l').itemsize == 8 else 'd'
+
+INTERNED = {}
+
+def intern_string(value):
+    """
+    Description:
+        Function used to share one copy of a repeated string (works for unicode, unlike the builtin intern)
+
+    Args:
+        value (str): The string
+
+    Returns:
+        The shared copy of value
+    """
+    return INTERNED.setdefault(value, value)
+
+def compact_number(value, convert, render):
+    """
+    Description:
+        Function used to convert a string attribute to a number, but only if it can be rendered back to exactly the same string
+
+    Args:
+        value (str): The attribute value (may be None)
+        convert (function): int or float
+        render (function): The function turning the number back into a string
+
+    Returns:
+        The number, or the original value if the conversion would not round trip
+    """
+    try:
+        number = convert(value)
+    except (TypeError, ValueError):
+        return value
+    if render(number) == value:
+        return number
+    return value
+
+def render_timestamp(value):
+    """
+    Description:
+        Function used to write seconds since the epoch in the OSM timestamp format
+
+    Args:
+        value (int): The timestamp
+
+    Returns:
+        The timestamp as a string, e.g. 2013-08-03T16:43:42Z
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(value))
+
+def parse_timestamp(value):
+    """
+    Description:
+        Function used to read an OSM timestamp into seconds since the epoch
+
+    Args:
+        value (str): The timestamp, e.g. 2013-08-03T16:43:42Z
+
+    Returns:
+        The timestamp as an int
+    """
+    return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))
+
+def render_string(value):
+    """
+    Description:
+        Function used to write a number back as the string our data model stores
+
+    Args:
+        value: A number, or the original string if it could not be compacted
+
+    Returns:
+        value as a string (None stays None)
+    """
+    if value is None or isinstance(value, basestring):
+        return value
+    return str(value)
+
+class CompactElement(object):
+    """
+    Description:
+        Compact in-memory version of a shaped node/way document
+
+    Attributes:
+        id, version, changeset, uid (int): Numeric attributes (the original string if it is not a plain number)
+        type, user (str): Shared copies of the element type and user name
+        timestamp (int): Seconds since the epoch (the original string if it is not in the OSM format)
+        lat, lon (float): The node position, None for ways
+        node_refs (array): The referenced node ids as 64-bit numbers (see ID_TYPECODE), None for nodes
+        address (tuple): (key, value) pairs of the address sub-document, None if there is none
+        tags (tuple): (key, value) pairs of every other field
+    """
+    __slots__ = ('id', 'type', 'version', 'changeset', 'uid', 'user', 'timestamp', 'lat', 'lon', 'node_refs', 'address', 'tags')
+
+    def to_dict(self):
+        """
+        Description:
+            Function used to turn the compact element back into our regular data model
+
+        Returns:
+            doc (dict): The shaped document
+        """
+        doc = {'id': render_string(self.id), 'type': self.type}
+        timestamp = self.timestamp
+        if not (timestamp is None or isinstance(timestamp, basestring)):
+            timestamp = render_timestamp(timestamp)
+        doc['created'] = {'version': render_string(self.version), 'changeset': render_string(self.changeset),
+                          'user': self.user, 'uid': render_string(self.uid), 'timestamp': timestamp}
+        if self.lat is not None:
+            doc['pos'] = {'type': 'Point', 'coordinates': [self.lon, self.lat]}
+        if self.node_refs is not None:
+            doc['node_refs'] = [str(int(ref)) for ref in self.node_refs]
+        if self.address is not None:
+            doc['address'] = dict(self.address)
+        for key, value in self.tags:
+            doc[key] = value
+        return doc
+
+def compact_element(doc):
+    """
+    Description:
+        Function used to turn a shaped document into a CompactElement
+
+    Args:
+        doc (dict): A dictionary representing a node/way element from our map data
+
+    Returns:
+        element (CompactElement): The compact version of doc
+    """
+    element = CompactElement()
+    created = doc['created']
+    element.id = compact_number(doc['id'], int, str)
+    element.type = intern_string(doc['type'])
+    element.version = compact_number(created['version'], int, str)
+    element.changeset = compact_number(created['changeset'], int, str)
+    element.uid = compact_number(created['uid'], int, str)
+    element.user = created['user'] if created['user'] is None else intern_string(created['user'])
+    element.timestamp = compact_number(created['timestamp'], parse_timestamp, render_timestamp)
+    element.lat = element.lon = None
+    if 'pos' in doc:
+        element.lon, element.lat = doc['pos']['coordinates']
+    element.node_refs = None
+    if 'node_refs' in doc:
+        element.node_refs = array(ID_TYPECODE, [int(ref) for ref in doc['node_refs']])
+    element.address = None
+    if 'address' in doc:
+        element.address = tuple((intern_string(key), value) for key, value in doc['address'].items())
+    element.tags = tuple((intern_string(key), value) for key, value in doc.items()
+                         if key not in ('id', 'type', 'created', 'pos', 'node_refs', 'address'))
+    return element
+
+
+# In[ ]:
+
+compact_sample = [compact_element(doc) for doc in sample]
+print "Compact elements convert back unchanged: {}".format([element.to_dict() for element in compact_sample] == sample)
+
+
+# Ways only carry the ids of their nodes in `node_refs`, so anything involving their shape (length, bounding box, drawing them) would otherwise need a join in Mongo. While shaping we can collect every node's position into a node index: a sorted array of 64-bit node ids next to float32 latitude and longitude arrays (16 bytes per node, a few hundred MB even for a large metro extract). The arrays can be saved to disk and memory mapped, and looking up all the nodes of any number of ways is a single vectorized binary search.
+# 
+# The same index lets us give ways a shape in Mongo: `add_way_geometry` adds a GeoJSON LineString `geometry` to every way whose nodes are all known. An .osm file lists all nodes before the first way, so by the time the first way arrives the index is complete. The index keeps coordinates as float32, so way geometry is only accurate to about a meter (and rounded to 6 decimal places); node positions keep their full precision.
+
+# In[ ]:
+
+import numpy as np
+
+EARTH_RADIUS = 6371008.8 # meters
+
+def new_node_index_builder():
+    """
+    Description:
+        Function used to create the growable arrays that collect node positions during shaping
+
+    Returns:
+        builder (dict): Empty 'ids', 'lat' and 'lon' arrays
+    """
+    return {'ids': array(ID_TYPECODE), 'lat': array('f'), 'lon': array('f')}
+
+def index_node_positions(data, builder):
+    """
+    Description:
+        Generator passing documents straight through while adding the position of every node to a node index builder
+
+    Args:
+        data (iterable): An iterable of dictionaries representing the node/way elements from our map data
+        builder (dict): A builder from new_node_index_builder
+
+    Returns:
+        A generator of the same dictionaries
+    """
+    ids, lat, lon = builder['ids'], builder['lat'], builder['lon']
+    for entry in data:
+        if 'pos' in entry:
+            ids.append(int(entry['id']))
+            lon.append(entry['pos']['coordinates'][0])
+            lat.append(entry['pos']['coordinates'][1])
+        yield entry
+
+def finish_node_index(builder, path=None):
+    """
+    Description:
+        Function used to turn a node index builder into sorted NumPy arrays, optionally saving them to disk
+
+    Args:
+        builder (dict): A builder filled by index_node_positions
+        path (str)(optional): If given, the arrays are saved as <path>.ids.npy, <path>.lat.npy and <path>.lon.npy and memory mapped back
+
+    Returns:
+        index (dict): 'ids' (int64), 'lat' and 'lon' (float32) arrays sorted by node id
+    """
+    index = {'ids': np.frombuffer(builder['ids'], dtype=ID_TYPECODE).astype(np.int64),
+             'lat': np.frombuffer(builder['lat'], dtype=np.float32),
+             'lon': np.frombuffer(builder['lon'], dtype=np.float32)}
+    # Nodes come out of an .osm file sorted by id already, only sort if they did not
+    if len(index['ids']) > 1 and (np.diff(index['ids']) < 0).any():
+        order = np.argsort(index['ids'], kind='mergesort')
+        index = dict((name, values[order]) for name, values in index.items())
+    if path:
+        for name, values in index.items():
+            np.save('{}.{}.npy'.format(path, name), values)
+        return load_node_index(path)
+    return index
+
+def load_node_index(path, mmap=True):
+    """
+    Description:
+        Function used to load a node index saved by finish_node_index
+
+    Args:
+        path (str): The path the index was saved under
+        mmap (bool)(optional): Memory map the arrays rather than reading them into memory (default)
+
+    Returns:
+        index (dict): 'ids', 'lat' and 'lon' arrays sorted by node id
+    """
+    mode = 'r' if mmap else None
+    return dict((name, np.load('{}.{}.npy'.format(path, name), mmap_mode=mode)) for name in ('ids', 'lat', 'lon'))
+
+def lookup_nodes(index, refs):
+    """
+    Description:
+        Function used to find the positions of many node ids in a node index at once
+
+    Args:
+        index (dict): A node index
+        refs (list or array): Node ids (strings or ints)
+
+    Returns:
+        lat, lon (arrays): float64 coordinates of each node, NaN where a node is not in the index
+    """
+    refs = np.asarray(refs, dtype=np.int64)
+    ids = index['ids']
+    if len(ids) == 0:
+        return np.full(len(refs), np.nan), np.full(len(refs), np.nan)
+    where = np.minimum(np.searchsorted(ids, refs), len(ids) - 1)
+    found = ids[where] == refs
+    lat = np.where(found, index['lat'][where], np.nan)
+    lon = np.where(found, index['lon'][where], np.nan)
+    return lat.astype(np.float64), lon.astype(np.float64)
+
+def resolve_ways(index, ways):
+    """
+    Description:
+        Function used to look up the nodes of many ways in one go
+
+    Args:
+        index (dict): A node index
+        ways (list): Way documents (anything with 'node_refs')
+
+    Returns:
+        offsets (array): Where each way's nodes start in lat/lon (one extra entry marks the end)
+        lat, lon (arrays): The coordinates of all ways' nodes, one after another
+    """
+    counts = np.array([len(way['node_refs']) for way in ways], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    refs = np.fromiter((int(ref) for way in ways for ref in way['node_refs']), dtype=np.int64, count=int(offsets[-1]))
+    lat, lon = lookup_nodes(index, refs)
+    return offsets, lat, lon
+
+def way_lengths(index, ways):
+    """
+    Description:
+        Function used to compute the length of many ways along their nodes (haversine distance)
+
+    Args:
+        index (dict): A node index
+        ways (list): Way documents
+
+    Returns:
+        lengths (array): The length of each way in meters, NaN if one of its nodes is missing from the index
+    """
+    offsets, lat, lon = resolve_ways(index, ways)
+    lat, lon = np.radians(lat), np.radians(lon)
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    segments = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+    # Segment i joins node i and i + 1; the segments crossing from one way into the next are not part of either, so
+    # they are zeroed and each way sums only its own segments (a missing node cannot spill into the following ways)
+    counts = np.diff(offsets)
+    way_of_node = np.repeat(np.arange(len(ways)), counts)
+    segments[way_of_node[:-1] != way_of_node[1:]] = 0
+    lengths = np.zeros(len(ways))
+    has_segments = counts > 1
+    if has_segments.any():
+        lengths[has_segments] = np.add.reduceat(segments, offsets[:-1][has_segments])
+    has_nodes = counts > 0
+    if has_nodes.any():
+        missing = np.logical_or.reduceat(np.isnan(lat), offsets[:-1][has_nodes])
+        lengths[np.flatnonzero(has_nodes)[missing]] = np.nan
+    return lengths
+
+def way_bboxes(index, ways):
+    """
+    Description:
+        Function used to compute the bounding box of many ways
+
+    Args:
+        index (dict): A node index
+        ways (list): Way documents
+
+    Returns:
+        bboxes (array): One row of (min lat, min lon, max lat, max lon) per way, NaN for ways without nodes
+    """
+    offsets, lat, lon = resolve_ways(index, ways)
+    bboxes = np.full((len(ways), 4), np.nan)
+    has_nodes = offsets[1:] > offsets[:-1]
+    starts = offsets[:-1][has_nodes]
+    if len(starts):
+        bboxes[has_nodes, 0] = np.fmin.reduceat(lat, starts)
+        bboxes[has_nodes, 1] = np.fmin.reduceat(lon, starts)
+        bboxes[has_nodes, 2] = np.fmax.reduceat(lat, starts)
+        bboxes[has_nodes, 3] = np.fmax.reduceat(lon, starts)
+    return bboxes
+
+def way_geometry(index, refs):
+    """
+    Description:
+        Function used to build the GeoJSON LineString of a way
+
+    Args:
+        index (dict): A node index
+        refs (list): The way's node ids
+
+    Returns:
+        geometry (dict): {"type": "LineString", "coordinates": [[lon, lat], ...]}, None if a node is missing or the way
+            has fewer than two distinct points (Mongo rejects such lines)
+    """
+    lat, lon = lookup_nodes(index, refs)
+    if np.isnan(lat).any():
+        return None
+    coordinates = []
+    for point in zip(np.round(lon, 6).tolist(), np.round(lat, 6).tolist()):
+        if not coordinates or coordinates[-1] != list(point):
+            coordinates.append(list(point))
+    if len(coordinates) < 2:
+        return None
+    return {'type': 'LineString', 'coordinates': coordinates}
+
+def add_way_geometry(data, builder):
+    """
+    Description:
+        Generator passing documents straight through while adding a GeoJSON LineString 'geometry' to each way, using the
+        nodes collected so far by index_node_positions
+
+    Args:
+        data (iterable): An iterable of dictionaries representing the node/way elements from our map data
+        builder (dict): The builder index_node_positions is filling
+
+    Returns:
+        A generator of the same dictionaries
+    """
+    index = None
+    for entry in data:
+        if 'node_refs' in entry:
+            if index is None:
+                # Snapshot the builder: its arrays keep growing if nodes follow the ways
+                index = finish_node_index(dict((name, array(values.typecode, values)) for name, values in builder.items()))
+            geometry = way_geometry(index, entry['node_refs'])
+            if geometry is not None:
+                entry['geometry'] = geometry
+        yield entry
+
+
+# In[ ]:
+
+sample_builder = new_node_index_builder()
+sample_ways = [entry for entry in index_node_positions(sample, sample_builder) if 'node_refs' in entry]
+sample_index = finish_node_index(sample_builder)
+print "{} nodes indexed, longest way in the sample is {:.0f} m".format(len(sample_index['ids']), np.nanmax(way_lengths(sample_index, sample_ways)))
+print "{} of {} ways have a geometry".format(sum(way_geometry(sample_index, way['node_refs']) is not None for way in sample_ways), len(sample_ways))
+
+
+# OpenStreetMap also distributes its extracts in the PBF format: the same data stored as blocks of zlib compressed protocol buffers, which is several times smaller than the XML and much faster to read. The reader below decodes the file with the standard library and NumPy (no protobuf package needed) and feeds each element to `shape_record`, the same logic `shape_element` uses, so it produces the same documents as the XML reader:
+# 
+#  - each block of the file is independent, so the blocks are decoded by a pool of worker processes
+#  - most nodes are stored as "dense nodes", where ids, coordinates and metadata are delta coded arrays of varints; these arrays are decoded with NumPy in one go instead of one number at a time
+#  - coordinates and timestamps are written back as strings in the format used in the XML (7 decimal places, and `render_timestamp`)
+# 
+# Relations are skipped, as they are in `iter_shaped`.
+
+# In[ ]:
+
+import zlib
+
+PBF_FEATURES = set(['OsmSchema-V0.6', 'DenseNodes'])
+
+def read_varint(buf, pos):
+    """
+    Description:
+        Function used to read one protocol buffer varint
+
+    Args:
+        buf (str): The encoded message
+        pos (int): The offset of the varint
+
+    Returns:
+        (value, pos) with pos the offset after the varint
+    """
+    result = shift = 0
+    while True:
+        b = ord(buf[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+def iter_fields(buf):
+    """
+    Description:
+        Generator reading the fields of a protocol buffer message
+
+    Args:
+        buf (str): The encoded message
+
+    Returns:
+        A generator of (field number, value) tuples; value is an int for varints and a str for everything else
+    """
+    pos, end = 0, len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire == 2:
+            size, pos = read_varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protocol buffer wire type {}".format(wire))
+        yield key >> 3, value
+
+def signed64(value):
+    """
+    Description:
+        Function used to read a varint as a (two's complement) int64
+
+    Args:
+        value (int): The varint
+
+    Returns:
+        The signed value
+    """
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def zigzag(value):
+    """
+    Description:
+        Function used to decode a zigzag encoded (sint32/sint64) varint
+
+    Args:
+        value (int): The varint
+
+    Returns:
+        The signed value
+    """
+    return (value >> 1) ^ -(value & 1)
+
+def decode_packed(data, signed=False, delta=False):
+    """
+    Description:
+        Function used to decode a packed array of varints with NumPy
+
+    Args:
+        data (str): The packed field
+        signed (bool)(optional): The values are zigzag encoded (sint32/sint64)
+        delta (bool)(optional): Each value is stored as the difference from the previous one
+
+    Returns:
+        values (ndarray): The values as int64
+    """
+    b = np.frombuffer(data, dtype=np.uint8)
+    if not len(b):
+        return np.zeros(0, dtype=np.int64)
+    ends = b < 0x80
+    starts = np.concatenate(([0], np.flatnonzero(ends)[:-1] + 1))
+    # The bytes of one varint hold 7 bits each, lowest first, so shifting them into place and adding them up gives its value
+    position = np.arange(len(b)) - starts[np.cumsum(ends) - ends]
+    values = np.add.reduceat((b & 0x7f).astype(np.uint64) << (7 * position).astype(np.uint64), starts)
+    if signed:
+        values = (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+    else:
+        values = values.astype(np.int64)
+    if delta:
+        values = np.cumsum(values)
+    return values
+
+def pbf_string(value):
+    """
+    Description:
+        Function used to decode a string from a PBF string table the way ElementTree returns attributes: str if it is ascii, unicode otherwise
+
+    Args:
+        value (str): The utf-8 bytes
+
+    Returns:
+        str or unicode
+    """
+    try:
+        value.decode('ascii')
+        return value
+    except UnicodeDecodeError:
+        return value.decode('utf-8')
+
+def decode_info(data, strings, date_granularity):
+    """
+    Description:
+        Function used to decode the metadata (Info message) of a node or way
+
+    Args:
+        data (str): The encoded Info message
+        strings (list): The block's string table
+        date_granularity (int): Milliseconds per timestamp unit
+
+    Returns:
+        attrib (dict): version, timestamp, changeset, uid and user as strings
+    """
+    attrib = {}
+    for number, value in iter_fields(data):
+        if number == 1:
+            attrib['version'] = str(signed64(value))
+        elif number == 2:
+            attrib['timestamp'] = render_timestamp(signed64(value) * date_granularity // 1000)
+        elif number == 3:
+            attrib['changeset'] = str(signed64(value))
+        elif number == 4:
+            attrib['uid'] = str(signed64(value))
+        elif number == 5:
+            attrib['user'] = strings[value]
+    return attrib
+
+def decode_dense_nodes(data, block):
+    """
+    Description:
+        Function used to shape the nodes of a DenseNodes message
+
+    Args:
+        data (str): The encoded DenseNodes message
+        block (dict): The block's string table, granularities and offsets
+
+    Returns:
+        docs (list): The shaped nodes
+    """
+    fields = dict(iter_fields(data))
+    ids = decode_packed(fields.get(1, ''), signed=True, delta=True)
+    lat = (decode_packed(fields.get(8, ''), signed=True, delta=True) * block['granularity'] + block['lat_offset']).tolist()
+    lon = (decode_packed(fields.get(9, ''), signed=True, delta=True) * block['granularity'] + block['lon_offset']).tolist()
+    strings = block['strings']
+    info = dict(iter_fields(fields[5])) if 5 in fields else {}
+    info_columns = [('version', decode_packed(info.get(1, ''))),
+                    ('timestamp', decode_packed(info.get(2, ''), signed=True, delta=True) * block['date_granularity'] // 1000),
+                    ('changeset', decode_packed(info.get(3, ''), signed=True, delta=True)),
+                    ('uid', decode_packed(info.get(4, ''), signed=True, delta=True)),
+                    ('user', decode_packed(info.get(5, ''), signed=True, delta=True))]
+    info_columns = [(name, column.tolist()) for name, column in info_columns if len(column) == len(ids)]
+    keys_vals = decode_packed(fields.get(10, '')).tolist()
+    docs = []
+    k = 0
+    for i, el_id in enumerate(ids.tolist()):
+        attrib = {'id': str(el_id), 'lat': '{:.7f}'.format(lat[i] * 1e-9), 'lon': '{:.7f}'.format(lon[i] * 1e-9)}
+        for name, column in info_columns:
+            if name == 'timestamp':
+                attrib[name] = render_timestamp(column[i])
+            elif name == 'user':
+                attrib[name] = strings[column[i]]
+            else:
+                attrib[name] = str(column[i])
+        tags = []
+        if keys_vals:
+            while keys_vals[k]:
+                tags.append((strings[keys_vals[k]], strings[keys_vals[k + 1]]))
+                k += 2
+            k += 1
+        docs.append(shape_record('node', attrib, tags))
+    return docs
+
+def decode_packed_many(segments, signed=False, delta=False):
+    """
+    Description:
+        Function used to decode many short packed arrays (such as the node refs of every way in a block) with a single call to decode_packed
+
+    Args:
+        segments (list): The packed fields
+        signed (bool)(optional): The values are zigzag encoded (sint32/sint64)
+        delta (bool)(optional): Each value is stored as the difference from the previous one in the same array
+
+    Returns:
+        A list holding the values of each array as a list of ints
+    """
+    data = ''.join(segments)
+    values = decode_packed(data, signed)
+    # The number of varints ending before each array's end tells us where to split the values
+    ends = np.concatenate(([0], np.cumsum(np.frombuffer(data, dtype=np.uint8) < 0x80)))
+    stops = ends[np.cumsum([len(segment) for segment in segments], dtype=np.int64)]
+    starts = np.concatenate(([0], stops[:-1])).astype(np.int64)
+    if delta and len(values):
+        total = np.cumsum(values)
+        values = total - np.repeat(np.concatenate(([0], total))[starts], stops - starts)
+    values = values.tolist()
+    return [values[a:b] for a, b in zip(starts.tolist(), stops.tolist())]
+
+def decode_elements(kind, messages, block):
+    """
+    Description:
+        Function used to shape the (non dense) Node or Way messages of a PrimitiveGroup
+
+    Args:
+        kind (str): 'node' or 'way'
+        messages (list): The encoded messages
+        block (dict): The block's string table, granularities and offsets
+
+    Returns:
+        docs (list): The shaped nodes/ways
+    """
+    strings = block['strings']
+    fields = [dict(iter_fields(message)) for message in messages]
+    keys = decode_packed_many([f.get(2, '') for f in fields])
+    vals = decode_packed_many([f.get(3, '') for f in fields])
+    if kind == 'way':
+        refs = decode_packed_many([f.get(8, '') for f in fields], signed=True, delta=True)
+    docs = []
+    for i, f in enumerate(fields):
+        attrib = decode_info(f[4], strings, block['date_granularity']) if 4 in f else {}
+        tags = [(strings[k], strings[v]) for k, v in zip(keys[i], vals[i])]
+        if kind == 'node':
+            attrib['id'] = str(zigzag(f[1]))
+            attrib['lat'] = '{:.7f}'.format((zigzag(f[8]) * block['granularity'] + block['lat_offset']) * 1e-9)
+            attrib['lon'] = '{:.7f}'.format((zigzag(f[9]) * block['granularity'] + block['lon_offset']) * 1e-9)
+            docs.append(shape_record(kind, attrib, tags))
+        else:
+            attrib['id'] = str(signed64(f[1]))
+            docs.append(shape_record(kind, attrib, tags, [str(ref) for ref in refs[i]]))
+    return docs
+
+def decode_primitive_block(data):
+    """
+    Description:
+        Function used to shape the nodes and ways of a PrimitiveBlock
+
+    Args:
+        data (str): The uncompressed PrimitiveBlock message
+
+    Returns:
+        docs (list): The shaped nodes/ways in the order they are stored
+    """
+    block = {'strings': [], 'granularity': 100, 'lat_offset': 0, 'lon_offset': 0, 'date_granularity': 1000}
+    groups = []
+    for number, value in iter_fields(data):
+        if number == 1:
+            block['strings'] = [pbf_string(s) for n, s in iter_fields(value) if n == 1]
+        elif number == 2:
+            groups.append(value)
+        elif number == 17:
+            block['granularity'] = value
+        elif number == 18:
+            block['date_granularity'] = value
+        elif number == 19:
+            block['lat_offset'] = signed64(value)
+        elif number == 20:
+            block['lon_offset'] = signed64(value)
+    docs = []
+    for group in groups:
+        # A group holds only one kind of element
+        messages = {1: [], 3: []}
+        for number, value in iter_fields(group):
+            if number == 2:
+                docs.extend(decode_dense_nodes(value, block))
+            elif number in messages:
+                messages[number].append(value)
+        if messages[1]:
+            docs.extend(decode_elements('node', messages[1], block))
+        if messages[3]:
+            docs.extend(decode_elements('way', messages[3], block))
+    return docs
+
+def read_pbf_blob(fp, offset, size):
+    """
+    Description:
+        Function used to read and decompress one blob of a PBF file
+
+    Args:
+        fp (file): The open PBF file
+        offset (int): The offset of the Blob message
+        size (int): The size of the Blob message
+
+    Returns:
+        The uncompressed block (str)
+    """
+    fp.seek(offset)
+    blob = dict(iter_fields(fp.read(size)))
+    if 1 in blob:
+        return blob[1]
+    if 3 in blob:
+        return zlib.decompress(blob[3])
+    raise ValueError("Unsupported PBF blob compression (only raw and zlib blobs can be read)")
+
+def find_pbf_blocks(pbf_file):
+    """
+    Description:
+        Function used to list the data blocks of a PBF file, checking that its header only requires features we can read
+
+    Args:
+        pbf_file (str): The name of the .osm.pbf file
+
+    Returns:
+        blocks (list): A list of (offset, size) tuples of the OSMData blobs in file order
+    """
+    blocks = []
+    with open(pbf_file, 'rb') as fp:
+        while True:
+            head = fp.read(4)
+            if len(head) < 4:
+                break
+            header = dict(iter_fields(fp.read(struct.unpack('>I', head)[0])))
+            offset = fp.tell()
+            if header[1] == 'OSMHeader':
+                required = set(s for n, s in iter_fields(read_pbf_blob(fp, offset, header[3])) if n == 4)
+                if required - PBF_FEATURES:
+                    raise ValueError("Unsupported PBF features: {}".format(', '.join(sorted(required - PBF_FEATURES))))
+            elif header[1] == 'OSMData':
+                blocks.append((offset, header[3]))
+            fp.seek(offset + header[3])
+    return blocks
+
+def shape_pbf_block(job):
+    """
+    Description:
+        Function used by our worker processes to shape one block of a PBF file
+
+    Args:
+        job (tuple): The name of the PBF file, and the offset and size of the block
+
+    Returns:
+        A list of the shaped dictionaries in the block, in file order
+    """
+    pbf_file, offset, size = job
+    with open(pbf_file, 'rb') as fp:
+        return decode_primitive_block(read_pbf_blob(fp, offset, size))
+
+def iter_shaped_pbf(pbf_file, processes=None, ordered=True):
+    """
+    Description:
+        Version of iter_shaped_parallel reading an .osm.pbf file; the blocks are decoded and shaped in a pool of worker processes.
+        The workers are forked, so the key sets from our key gathering step must already be defined.
+
+    Args:
+        pbf_file (str): The name of the .osm.pbf file
+        processes (int)(optional): The number of worker processes, defaults to the number of cores (1 decodes in this process)
+        ordered (bool)(optional): If True (default) documents are yielded in file order
+
+    Returns:
+        A generator of dictionaries shaped like the data model in shape_data
+    """
+    jobs = [(pbf_file, offset, size) for offset, size in find_pbf_blocks(pbf_file)]
+    if processes == 1:
+        return (doc for job in jobs for doc in shape_pbf_block(job))
+    return iter_pool_results(shape_pbf_block, jobs, processes or multiprocessing.cpu_count(), ordered)
+
+
+# To check the reader, I converted our sample to PBF with osmium (`osmium cat sample.osm -o sample.osm.pbf`) and compared the documents with the ones shaped from the XML. For the full data set, `iter_shaped_pbf('san-diego_california.osm.pbf')` can take the place of `iter_shaped_parallel` in the final step.
+
+# In[ ]:
+
+pbf_sample = list(iter_shaped_pbf('sample.osm.pbf'))
+print "{} documents, identical to the XML sample: {}".format(len(pbf_sample), pbf_sample == sample)
+
+
+# Our data is now shaped, so let's start our field audits and move into cleaning.
+
+# ## Section 5: Field Audits and Cleaning Functions
+# 
+# We already have all of our unique entries for the fields we need to audit stored in a set from our key gathering process so let's take a look at each one and determine our cleaning rules before we write our cleaning functions
+# 
+# We will look at the following fields:
+# 
+#     1 - City name
+#     2 - Postcode
+#     3 - Housenumber
+#     4 - Streetname
+#     5 - Phone number
+#     6 - Amenity name/type
+#     7 - Cuisine
+#     8 - Fast Food Names
+#     9 - Place of Worship
+# 
+# Since the goal of this cleaning process is to produce a quality data product, let's remind ourselves of the dimensions of quality data to remind us of what to look for in our audit.
+# 
+# ** Completeness, Consistency, Accuracy, Validity, Uniformity. **
+
+# ### Cleaning telemetry
+# 
+# Our cleaning functions used to print a line for every value they changed. On the full data set that is hundreds of thousands of lines, which slows the run down and still does not tell us how far along we are or where the time goes. Instead, every change is reported to `record_change`, which only counts it per rule, and the pipeline stages are measured with a few small tools:
+# 
+#  - `stage_timer` times a block of code, and `track_stage` counts the documents passing through a generator and reports docs/sec as it goes
+#  - `set_verbose_sink` turns the old per-value output back on, rate limited to a number of lines per second, as json lines
+#  - `enable_profiling` runs cProfile during every timed stage
+#  - `telemetry_report` collects everything into a dictionary that can be saved as json
+
+# In[ ]:
+
+import cProfile
+import sys
+import time
+from contextlib import contextmanager
+
+TELEMETRY = {'stages': {}, 'changes': defaultdict(int), 'counters': defaultdict(int),
+             'verbose': None, 'progress': None, 'profiler': None, 'profile_depth': 0, 'time_cleaners': False, 'change_log': None,
+             'capture': None}
+
+def reset_telemetry():
+    """
+    Description:
+        Function used to clear all timers and counters (the sinks and profiling settings are kept)
+
+    Returns:
+        None
+    """
+    TELEMETRY.update({'stages': {}, 'changes': defaultdict(int), 'counters': defaultdict(int)})
+
+def emit(stream, record):
+    """
+    Description:
+        Function used to write one machine readable telemetry record as a json line
+
+    Args:
+        stream (file): The stream to write to
+        record (dict): The record
+
+    Returns:
+        None
+    """
+    stream.write(json.dumps(record, sort_keys=True, default=repr) + '\n')
+
+def stage_stats(name):
+    """
+    Description:
+        Function used to get (or create) the statistics of a stage
+
+    Args:
+        name (str): The name of the stage
+
+    Returns:
+        stats (dict): The stage's 'seconds', 'calls' and 'items'
+    """
+    stats = TELEMETRY['stages'].get(name)
+    if stats is None:
+        stats = TELEMETRY['stages'][name] = {'seconds': 0.0, 'calls': 0, 'items': 0}
+    return stats
+
+def profile_enter():
+    """
+    Description:
+        Function used to turn the profiler on at the start of a timed stage (stages can be nested, it stays on until the outermost one ends)
+
+    Returns:
+        None
+    """
+    if TELEMETRY['profiler'] is not None:
+        if TELEMETRY['profile_depth'] == 0:
+            TELEMETRY['profiler'].enable()
+        TELEMETRY['profile_depth'] += 1
+
+def profile_exit():
+    """
+    Description:
+        Function used to turn the profiler off at the end of the outermost timed stage
+
+    Returns:
+        None
+    """
+    if TELEMETRY['profiler'] is not None:
+        TELEMETRY['profile_depth'] -= 1
+        if TELEMETRY['profile_depth'] == 0:
+            TELEMETRY['profiler'].disable()
+
+@contextmanager
+def stage_timer(name, items=0):
+    """
+    Description:
+        Context manager timing a stage (and profiling it if enable_profiling was called)
+
+    Args:
+        name (str): The name of the stage
+        items (int)(optional): The number of items the stage handles (can also be added to the yielded stats)
+
+    Returns:
+        The stage's stats (dict)
+    """
+    stats = stage_stats(name)
+    stats['items'] += items
+    profile_enter()
+    start = time.time()
+    try:
+        yield stats
+    finally:
+        stats['seconds'] += time.time() - start
+        stats['calls'] += 1
+        profile_exit()
+
+def track_stage(data, name, report_every=100000):
+    """
+    Description:
+        Generator passing documents through unchanged while counting them and timing how long it waits for each one.
+        The time includes the stages before it in the pipeline. If set_progress was called, a progress record with docs/sec is written every report_every documents.
+
+    Args:
+        data (iterable): The documents
+        name (str): The name of the stage
+        report_every (int)(optional): The number of documents between progress records
+
+    Returns:
+        A generator of the same documents
+    """
+    stats = stage_stats(name)
+    stats['calls'] += 1
+    iterator = iter(data)
+    start = time.time()
+    while True:
+        profile_enter()
+        before = time.time()
+        try:
+            entry = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            stats['seconds'] += time.time() - before
+            profile_exit()
+        stats['items'] += 1
+        if TELEMETRY['progress'] is not None and stats['items'] % report_every == 0:
+            elapsed = time.time() - start
+            emit(TELEMETRY['progress'], {'event': 'progress', 'stage': name, 'items': stats['items'],
+                                         'seconds': elapsed, 'items_per_sec': stats['items'] / elapsed if elapsed else None})
+        yield entry
+
+def record_change(rule, entry, field, old, new):
+    """
+    Description:
+        Function called by the cleaning functions for every value they change; the change is counted, and also written to the verbose sink
+        and the change log when they are turned on. A "change" that leaves the value as it was is ignored.
+
+    Args:
+        rule (str): The name of the cleaning rule
+        entry (dict): The node/way being cleaned
+        field (str): The field changed, e.g. 'address.postcode'
+        old: The value before the change
+        new: The value after the change (None if the field was removed)
+
+    Returns:
+        None
+    """
+    if old == new:
+        return
+    TELEMETRY['changes'][rule] += 1
+    sink = TELEMETRY['verbose']
+    if sink is not None:
+        now = int(time.time())
+        if now != sink['second']:
+            sink['second'], sink['written'] = now, 0
+        if sink['written'] < sink['per_second']:
+            sink['written'] += 1
+            emit(sink['stream'], {'event': 'change', 'rule': rule, 'id': entry.get('id'), 'type': entry.get('type'),
+                                  'field': field, 'old': old, 'new': new})
+        else:
+            sink['dropped'] += 1
+    if TELEMETRY['change_log'] is not None:
+        log_change(TELEMETRY['change_log'], rule, entry, field, old, new)
+    if TELEMETRY['capture'] is not None:
+        TELEMETRY['capture'].append(('change', rule, field, old, new))
+
+def count(name, value=1):
+    """
+    Description:
+        Function used to add to a named counter
+
+    Args:
+        name (str): The counter
+        value (int)(optional): The amount to add
+
+    Returns:
+        None
+    """
+    TELEMETRY['counters'][name] += value
+    if TELEMETRY['capture'] is not None:
+        TELEMETRY['capture'].append(('count', name, value))
+
+@contextmanager
+def capture_telemetry():
+    """
+    Description:
+        Context manager collecting the changes and counts recorded inside it (they are still recorded as usual), so they can
+        be stored next to a cached document and replayed with replay_telemetry when the document is read back
+
+    Returns:
+        records (list): ('change', rule, field, old, new) and ('count', name, value) tuples
+    """
+    outer = TELEMETRY['capture']
+    records = TELEMETRY['capture'] = []
+    try:
+        yield records
+    finally:
+        TELEMETRY['capture'] = outer
+
+def replay_telemetry(entry, records):
+    """
+    Description:
+        Function used to record again the changes and counts captured while a document was cleaned
+
+    Args:
+        entry (dict): The cleaned node/way
+        records (list): The records from capture_telemetry
+
+    Returns:
+        None
+    """
+    for record in records:
+        if record[0] == 'change':
+            record_change(record[1], entry, *record[2:])
+        else:
+            count(*record[1:])
+
+def set_verbose_sink(stream=sys.stdout, per_second=20):
+    """
+    Description:
+        Function used to write every change as a json line (what the cleaning functions used to print), at most per_second lines per second
+
+    Args:
+        stream (file)(optional): The stream to write to, None turns the sink off
+        per_second (int)(optional): The number of lines allowed per second; the rest are only counted
+
+    Returns:
+        None
+    """
+    TELEMETRY['verbose'] = None if stream is None else {'stream': stream, 'per_second': per_second, 'second': None, 'written': 0, 'dropped': 0}
+
+def set_progress(stream=sys.stderr):
+    """
+    Description:
+        Function used to choose where track_stage writes its progress records
+
+    Args:
+        stream (file)(optional): The stream to write to, None turns progress records off
+
+    Returns:
+        None
+    """
+    TELEMETRY['progress'] = stream
+
+def enable_profiling(time_cleaners=True):
+    """
+    Description:
+        Function used to run cProfile during every timed stage (see telemetry_report to save the results)
+
+    Args:
+        time_cleaners (bool)(optional): Also time each cleaning function on its own, as a 'clean:<name>' stage
+
+    Returns:
+        profiler (Profile)
+    """
+    TELEMETRY['profiler'] = cProfile.Profile()
+    TELEMETRY['profile_depth'] = 0
+    TELEMETRY['time_cleaners'] = time_cleaners
+    return TELEMETRY['profiler']
+
+def telemetry_report(filename=None, profile_file=None):
+    """
+    Description:
+        Function used to collect the timers and counters, and optionally save them
+
+    Args:
+        filename (str)(optional): A json file to write the report to
+        profile_file (str)(optional): A file to write the cProfile statistics to (readable with pstats), if profiling was enabled
+
+    Returns:
+        report (dict): 'stages' (seconds, calls, items and items_per_sec of each stage), 'changes' (per rule), 'counters' and 'verbose_dropped'
+    """
+    stages = {}
+    for name, stats in TELEMETRY['stages'].items():
+        stages[name] = dict(stats, items_per_sec=stats['items'] / stats['seconds'] if stats['seconds'] else None)
+    report = {'stages': stages, 'changes': dict(TELEMETRY['changes']), 'counters': dict(TELEMETRY['counters']),
+              'verbose_dropped': TELEMETRY['verbose']['dropped'] if TELEMETRY['verbose'] else 0}
+    if filename:
+        with open(filename, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    if profile_file and TELEMETRY['profiler'] is not None:
+        TELEMETRY['profiler'].dump_stats(profile_file)
+    return report
+
+
+# The counters tell us how many values each rule changed, but not which ones. To be able to check afterwards what cleaning did to any element, `open_change_log` keeps a record of every change (element type and id, field, old value, new value and rule). The records are collected in a list and every `batch_size` of them are handed to a background thread that turns them into columns and appends them to the file, so the cleaning itself only pays for one list append per change. The file is Parquet if pyarrow is installed (old and new values are stored as json text, since they can be lists); otherwise it is gzipped newline delimited JSON with one line per batch, holding a list of values for each column. `iter_change_log` reads either back one record at a time.
+
+# In[ ]:
+
+import gzip
+import threading
+import Queue
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+CHANGE_LOG_COLUMNS = ('type', 'id', 'field', 'old', 'new', 'rule')
+
+def write_change_batches(log):
+    """
+    Description:
+        Function run by the change log's background thread, appending each batch from the queue to the file until it gets None
+
+    Args:
+        log (dict): The change log from open_change_log
+
+    Returns:
+        None
+    """
+    writer = None
+    fp = None
+    try:
+        while True:
+            rows = log['queue'].get()
+            if rows is None:
+                break
+            batch = dict(zip(CHANGE_LOG_COLUMNS, map(list, zip(*rows))))
+            if log['format'] == 'parquet':
+                batch['old'] = [json.dumps(value) for value in batch['old']]
+                batch['new'] = [json.dumps(value) for value in batch['new']]
+                table = pyarrow.Table.from_arrays([pyarrow.array(batch[name], type=pyarrow.string()) for name in CHANGE_LOG_COLUMNS],
+                                                  names=list(CHANGE_LOG_COLUMNS))
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(log['filename'], table.schema)
+                writer.write_table(table)
+            else:
+                if fp is None:
+                    fp = gzip.open(log['filename'], 'wb', compresslevel=1)
+                fp.write(json.dumps(batch, sort_keys=True) + '\n')
+    except Exception as e:
+        log['error'] = e
+        # Keep emptying the queue so the cleaning never blocks on a dead writer
+        while log['queue'].get() is not None:
+            pass
+    finally:
+        if writer is not None:
+            writer.close()
+        if fp is not None:
+            fp.close()
+
+def open_change_log(filename, batch_size=50000, format=None):
+    """
+    Description:
+        Function used to start recording every change made by the cleaning functions to a file
+
+    Args:
+        filename (str): The change log file
+        batch_size (int)(optional): The number of records collected before they are written
+        format (str)(optional): 'parquet' or 'ndjson', guessed from the file extension by default
+
+    Returns:
+        log (dict): The change log, pass it to close_change_log when cleaning is done
+    """
+    if format is None:
+        format = 'parquet' if filename.endswith('.parquet') else 'ndjson'
+    if format not in ('parquet', 'ndjson'):
+        raise ValueError("Unknown change log format {}".format(format))
+    if format == 'parquet' and pyarrow is None:
+        raise ValueError("A parquet change log needs the pyarrow package")
+    log = {'filename': filename, 'format': format, 'batch_size': batch_size, 'records': 0, 'error': None,
+           'rows': [], 'queue': Queue.Queue(maxsize=4)}
+    log['thread'] = threading.Thread(target=write_change_batches, args=(log,))
+    log['thread'].daemon = True
+    log['thread'].start()
+    TELEMETRY['change_log'] = log
+    return log
+
+def log_change(log, rule, entry, field, old, new):
+    """
+    Description:
+        Function used by record_change to add one record to the change log
+
+    Args:
+        log (dict): The change log from open_change_log
+        rule (str): The name of the cleaning rule
+        entry (dict): The node/way being cleaned
+        field (str): The field changed
+        old: The value before the change
+        new: The value after the change
+
+    Returns:
+        None
+    """
+    rows = log['rows']
+    rows.append((entry.get('type'), entry.get('id'), field, old, new, rule))
+    if len(rows) >= log['batch_size']:
+        flush_change_log(log)
+
+def flush_change_log(log):
+    """
+    Description:
+        Function used to hand the collected records to the writer thread
+
+    Args:
+        log (dict): The change log from open_change_log
+
+    Returns:
+        None
+    """
+    if log['rows']:
+        log['records'] += len(log['rows'])
+        log['queue'].put(log['rows'])
+        log['rows'] = []
+
+def close_change_log(log):
+    """
+    Description:
+        Function used to write the remaining records, wait for the writer thread and stop recording changes
+
+    Args:
+        log (dict): The change log from open_change_log
+
+    Returns:
+        The number of records written
+    """
+    flush_change_log(log)
+    log['queue'].put(None)
+    log['thread'].join()
+    if TELEMETRY['change_log'] is log:
+        TELEMETRY['change_log'] = None
+    if log['error'] is not None:
+        raise log['error']
+    return log['records']
+
+def iter_change_log(filename, rule=None):
+    """
+    Description:
+        Generator reading a change log back one record at a time
+
+    Args:
+        filename (str): The change log file (.parquet, or gzipped ndjson)
+        rule (str)(optional): Only return the changes made by this rule
+
+    Returns:
+        A generator of dictionaries with the CHANGE_LOG_COLUMNS as keys
+    """
+    if filename.endswith('.parquet'):
+        columns = pyarrow.parquet.read_table(filename).to_pydict()
+        for row in zip(*[columns[name] for name in CHANGE_LOG_COLUMNS]):
+            record = dict(zip(CHANGE_LOG_COLUMNS, row))
+            record['old'], record['new'] = json.loads(record['old']), json.loads(record['new'])
+            if rule is None or record['rule'] == rule:
+                yield record
+    else:
+        with gzip.open(filename, 'rb') as fp:
+            for line in fp:
+                columns = json.loads(line)
+                for row in zip(*[columns[name] for name in CHANGE_LOG_COLUMNS]):
+                    if rule is None or row[-1] == rule:
+                        yield dict(zip(CHANGE_LOG_COLUMNS, row))
+
+
+# ### Memoized normalizers
+# 
+# Most values we clean repeat over and over: the same street names, cuisines, phone numbers and postcodes appear on thousands of entries. The value level part of our street, cuisine, phone, postcode, housenumber (and later franchise name) rules is written as a `normalize_<field>` function that takes a raw value and returns the cleaned value together with the changes it made, and `memoized` remembers its answer for each raw value. A repeated value then costs a dictionary lookup, plus replaying its changes to `record_change` so the counters and change log stay complete.
+# 
+# Each field keeps at most `MEMO_SIZE` values. Rather than reordering a list on every hit, the memo keeps two generations: new answers go into the current one, and when it is half full it becomes the old generation and the previous old one is dropped. A value found in the old generation is moved back into the current one, so values in regular use are never evicted (an approximation of least recently used). Results that are lists (postcode and housenumber ranges, split cuisines) are copied before they are returned, so no two entries share one. `export_memos` and `preload_memos` let worker processes start with the answers the main process has already worked out.
+
+# In[ ]:
+
+MEMO_SIZE = 50000 # Parameter: the number of raw values remembered per field
+MEMOS = {}
+
+def remember(memo, key, result):
+    """
+    Description:
+        Function used to add an answer to a memo, starting a new generation when the current one is half full
+
+    Args:
+        memo (dict): The memo of one field
+        key: The raw value (or the key built from it)
+        result (tuple): The cleaned value and its changes
+
+    Returns:
+        None
+    """
+    memo['new'][key] = result
+    if len(memo['new']) >= memo['max_size'] // 2:
+        memo['evictions'] += len(memo['old'])
+        memo['old'], memo['new'] = memo['new'], {}
+
+def copy_result(result):
+    """
+    Description:
+        Function used to copy a list result so entries never share the memo's copy
+
+    Args:
+        result (tuple): The cleaned value and its changes
+
+    Returns:
+        The same tuple, or a new one holding a copy of the list
+    """
+    if isinstance(result[0], list):
+        return list(result[0]), result[1]
+    return result
+
+def memoized(field, max_size=None, key=None):
+    """
+    Description:
+        Decorator remembering the answer of a normalize_<field> function for each raw value
+
+    Args:
+        field (str): The name of the field, used in memo_stats
+        max_size (int)(optional): The number of values remembered, defaults to MEMO_SIZE
+        key (function)(optional): A function building the memo key from the raw value, for rules whose answer depends on more than
+            the value's equality (e.g. on whether it is unicode)
+
+    Returns:
+        decorator (function)
+    """
+    def decorator(func):
+        memo = MEMOS[field] = {'new': {}, 'old': {}, 'max_size': max_size or MEMO_SIZE, 'hits': 0, 'misses': 0, 'evictions': 0}
+
+        def lookup(value):
+            k = value if key is None else key(value)
+            try:
+                result = memo['new'][k]
+            except KeyError:
+                result = memo['old'].pop(k, None)
+                if result is None:
+                    memo['misses'] += 1
+                    result = func(value)
+                    remember(memo, k, result)
+                    return copy_result(result)
+                remember(memo, k, result)
+            except TypeError:
+                # Not hashable (a list we cleaned before), so it cannot be remembered
+                return func(value)
+            memo['hits'] += 1
+            return copy_result(result)
+
+        lookup.__name__ = func.__name__
+        lookup.__doc__ = func.__doc__
+        lookup.__wrapped__ = func
+        return lookup
+    return decorator
+
+def apply_normalized(entry, field, result):
+    """
+    Description:
+        Function used by the cleaning functions to report the changes of a normalize_<field> result
+
+    Args:
+        entry (dict): The node/way being cleaned
+        field (str): The field, e.g. 'address.street'
+        result (tuple): The cleaned value and a list of (rule, old value, new value) changes
+
+    Returns:
+        The cleaned value
+    """
+    value, changes = result
+    for rule, old, new in changes:
+        record_change(rule, entry, field, old, new)
+    return value
+
+def memo_stats():
+    """
+    Description:
+        Function used to report how well each field's memo is doing
+
+    Returns:
+        stats (dict): field -> hits, misses, hit_rate, size and evictions
+    """
+    stats = {}
+    for field, memo in MEMOS.items():
+        lookups = memo['hits'] + memo['misses']
+        stats[field] = {'hits': memo['hits'], 'misses': memo['misses'], 'evictions': memo['evictions'],
+                        'hit_rate': memo['hits'] / float(lookups) if lookups else 0.0, 'size': len(memo['new']) + len(memo['old'])}
+    return stats
+
+def reset_memos():
+    """
+    Description:
+        Function used to forget every remembered answer and clear the hit/miss counts (the memos stay registered in MEMOS)
+
+    Returns:
+        None
+    """
+    for memo in MEMOS.values():
+        memo['new'], memo['old'] = {}, {}
+        memo['hits'] = memo['misses'] = memo['evictions'] = 0
+
+def export_memos():
+    """
+    Description:
+        Function used to copy every remembered answer, e.g. to hand to worker processes
+
+    Returns:
+        tables (dict): field -> {key: result}
+    """
+    tables = {}
+    for field, memo in MEMOS.items():
+        table = dict(memo['old'])
+        table.update(memo['new'])
+        tables[field] = table
+    return tables
+
+def preload_memos(tables):
+    """
+    Description:
+        Function used to load answers exported with export_memos; it can be used as the initializer of a multiprocessing Pool
+
+    Args:
+        tables (dict): field -> {key: result}
+
+    Returns:
+        None
+    """
+    for field, table in tables.items():
+        if field in MEMOS:
+            for k, result in table.items():
+                remember(MEMOS[field], k, result)
+
+
+# ### 5.1 City Name
+
+# In[80]:
+
+for item in city:
+    print item
+
+
+# Great news, nothing to clean here, these are all valid, complete, accurate cities within the San Diego city limit! Lets move on.
+
+# ### 5.2 Postcode
+
+# In[81]:
+
+for pc in postcode:
+    print pc
+
+
+# We have some minor problems with postcodes here. While these values are all within the San Diego city limits, we have some values in the format XXXXX-XXXX and some that express a range of values for our ways that span multiple postal codes.
+# 
+# **Cleaning Rules**
+#  - If an entry contains a '-' character, split the value at '-' and retain the first 5 digits
+#  - If an entry contains a ':' (denoting a range) fill in the range of postal codes between the two numbers and store the postal code as a list of those values
+
+# Each of our cleaning functions below works on a single entry and registers itself in `CLEANERS`. This lets the master cleaning function apply every rule to an entry in one pass instead of sweeping the full data set once per field; the `clean_<field>(map_dict)` versions are kept for cleaning a whole list one field at a time while auditing.
+
+# In[3]:
+
+CLEANERS = []
+
+def register_cleaner(func):
+    """
+    Description:
+        Decorator used to add a single entry cleaning function to CLEANERS; cleaners are applied in the order they are registered
+
+    Args:
+        func (function): A function taking one dictionary representing a node/way element and cleaning it in place
+
+    Returns:
+        func, unchanged
+    """
+    CLEANERS.append(func)
+    return func
+
+def clean_document(entry):
+    """
+    Description:
+        Function used to apply every registered cleaning function to a single entry
+
+    Args:
+        entry (dict): A dictionary representing a node/way element from our map data
+
+    Returns:
+        entry (dict): The same dictionary, cleaned in place
+    """
+    if TELEMETRY['time_cleaners']:
+        for cleaner in CLEANERS:
+            with stage_timer('clean:' + cleaner.__name__, 1):
+                cleaner(entry)
+        return entry
+    for cleaner in CLEANERS:
+        cleaner(entry)
+    return entry
+
+@memoized('address.postcode')
+def normalize_postcode(postcode):
+    """
+    Description:
+        Function used to clean a single postcode value
+
+    Args:
+        postcode (str): The raw postcode
+
+    Returns:
+        (postcode, changes): The cleaned postcode and a list of the (rule, old value, new value) changes made
+    """
+    changes = []
+    if len(postcode) > 5:
+        if '-' in postcode:
+            changes.append(('postcode_zip4', postcode, postcode[:5]))
+            postcode = postcode[:5]
+
+        if ':' in postcode:
+            zip_range = postcode.split(':')
+            changes.append(('postcode_range', postcode, range(int(zip_range[0]), int(zip_range[1]))))
+            postcode = range(int(zip_range[0]), int(zip_range[1]))
+    return postcode, changes
+
+@register_cleaner
+def clean_postcode_entry(entry):
+    """
+    Description:
+        Function used to clean the postcode data of a single entry from our 'shaped' San Diego map file
+
+    Args:
+        entry (dict): A dictionary representing a node/way element from our map data
+
+    Returns:
+        No return value, reports each changed value to record_change
+    """
+    if 'address' in entry.keys():
+        if 'postcode' in entry['address'].keys():
+            entry['address']['postcode'] = apply_normalized(entry, 'address.postcode', normalize_postcode(entry['address']['postcode']))
+
+def clean_postcode(map_dict):
+    """
+    Description:
+        Function used to clean postcode data from our 'shaped' San Diego map file
+
+    Args:
+        map_dict (list): A list of dictionaries representing the node/way elements from our map data
+
+    Returns:
+        No return value, reports each changed value to record_change
+    """
+    for entry in map_dict:
+        clean_postcode_entry(entry)
+
+
+# ### 5.3 Housenumber
+
+# In[82]:
+
+for number in housenumber:
+    if not number.isdigit():
+        print number
+
+
+# There were far too many house numbers to audit with my own eye and there are very vague rules on what house numbers (that are purely digits) are valid (ex: your house can be 111 or 6666666 and it can still be valid) so I decided for our audit, we would only look that those house numbers with non digit characters in them.
+# 
 # Below are the cleaning rules
 # 
 # Cleaning rules:
-# - Convert all '.5' addresses to the valid 1/2 format
-# - Entries with ';' characters express buildings with a range of addresses within. Fill in the values in this range and store as a list
+# - Convert all '.5' addresses to the valid 1/2 format
+# - Entries with ';' characters express buildings with a range of addresses within. Fill in the values in this range and store as a list
+
+# In[4]:
+
+@memoized('address.housenumber')
+def normalize_housenumber(housenumber):
+    """
+    Description:
+        Function used to clean a single housenumber value
+
+    Args:
+        housenumber (str): The raw housenumber
+
+    Returns:
+        (housenumber, changes): The cleaned housenumber and a list of the (rule, old value, new value) changes made
+    """
+    changes = []
+    if '.5' in housenumber:
+        changes.append(('housenumber_half', housenumber, housenumber.replace('.5', '1/2')))
+        housenumber = housenumber.replace('.5', '1/2')
+
+    if ';' in housenumber:
+        house_range = housenumber.split(';')
+        start = int(house_range[0])
+        end = int(house_range[1])
+        if start > end:
+            rng = range(end, start)
+        else:
+            rng = range(start, end)
+        changes.append(('housenumber_range', housenumber, rng))
+        housenumber = rng
+    return housenumber, changes
+
+@register_cleaner
+def clean_housenumber_entry(entry):
+    """
+    Description:
+        Function used to clean the housenumber data of a single entry from our 'shaped' San Diego map file
+
+    Args:
+        entry (dict): A dictionary representing a node/way element from our map data
+
+    Returns:
+        No return value, reports each changed value to record_change
+    """    
+    if 'address' in entry.keys():
+        if 'housenumber' in entry['address'].keys():
+            entry['address']['housenumber'] = apply_normalized(entry, 'address.housenumber', normalize_housenumber(entry['address']['housenumber']))
+
+def clean_housenumber(map_dict):
+    """
+    Description:
+        Function used to clean housenumber data from our 'shaped' San Diego map file
+
+    Args:
+        map_dict (list): A list of dictionaries representing the node/way elements from our map data
+
+    Returns:
+        No return value, reports each changed value to record_change
+    """    
+    for entry in map_dict:
+        clean_housenumber_entry(entry)
+
+
+# ### 5.4 Street Name
+
+# In[5]:
+
+def get_road_types(road_names):
+    """
+    Description:
+        Grabs the last word in a street name and add it to a set
+
+    Args:
+        road_names (set): A set of street names
+
+    Returns:
+        road_type (set): a set of the last word in each of our street names.
+    """
+    road_type = set()
+    for name in road_names:
+        n = name.split()
+        road_type.add(n[len(n) - 1])
+    return road_type
+
+def get_road_prefix(road_names):
+    """
+    Description:
+        Grabs the first word in a street name and add it to a set
+
+    Args:
+        road_names (set): A set of street names
+
+    Returns:
+        road_type (set): a set of the first word in each of our street names.
+    """
+    pre = set()
+    for name in road_names:
+        pre.add(name.split()[0])
+    return pre
+
+road_types = get_road_types(street)
+road_prefix = get_road_prefix(street)
+
+
+# In[84]:
+
+for rt in road_types:
+    if len(rt) < 4:
+        print rt
+
+
+# In[85]:
+
+for pre in road_prefix:
+    if len(pre) < 3:
+        print pre
+
+
+# In order to audit street names I looked immediately for problem areas like cardinal direction abbreviations in the first and last word in a street name string as well as abbreviations in the last word of the string (St., Rd., etc)
+# 
+# Rules
+#  - In our prefix, we will need to clean out values smaller than 3 characters long with a '.'.
+#  - In our suffix, we will need to clean out values matching 'Av, Ave, Ct, Pl, Dr, Ln, St'
+
+# In[6]:
+
+street_error = {
+    'Ave' : "Avenue",
+    'St' : "Street",
+    "Ln" : "Lane",
+    "Av" : "Avenue",
+    'Pl' : "Place",
+    "Dr" : "Drive",
+    "Dr." : "Drive",
+    'Rd' : "Road",
+    "Ct" : "Court",
+    "Rd." : "Road",   
+}
+
+@memoized('address.street')
+def normalize_street(street):
+    """
+    Description:
+        Function used to clean a single street name
+
+    Args:
+        street (str): The raw street name
+
+    Returns:
+        (street, changes): The cleaned street name and a list of the (rule, old value, new value) changes made
+    """
+    changes = []
+    name = street.split()
+    if name[len(name) - 1] in street_error:
+        name[len(name) - 1] = street_error[name[len(name) - 1]]
+        new_value = " ".join(map(str, name))
+        changes.append(('street_type', street, new_value))
+        street = new_value
+    return street, changes
+
+@register_cleaner
+def clean_street_entry(entry):
+    """
+    Description:
+        Function used to clean the street data of a single entry from our 'shaped' San Diego map file
+
+    Args:
+        entry (dict): A dictionary representing a node/way element from our map data
+
+    Returns:
+        No return value, reports each changed value to record_change
+    """    
+    if 'address' in entry.keys():
+        if 'street' in entry['address'].keys():
+            entry['address']['street'] = apply_normalized(entry, 'address.street', normalize_street(entry['address']['street']))
+
+def clean_street(data):
+    """
+    Description:
+        Function used to clean street data from our 'shaped' San Diego map file
+
+    Args:
+        data (list): A list of dictionaries representing the node/way elements from our map data
+
+    Returns:
+        No return value, reports each changed value to record_change
+    """    
+    for entry in data:
+        clean_street_entry(entry)
+
+
+# ### 5.5 Phone Number
+
+# In[86]:
+
+for num in phone:
+    print num
+
+
+# Cleaning rules:
+#  - Remove all non digit characters (i.e. periods, plus sign, parentheses, dashes, etc)
+#  - Take the length of the phone number, those fewer than 10 digits xxx xxx xxxx (without spaces) should be removed
+#  - If the phone number has a leading 1, remove it
+#  - insert a '-' character after the 3rd and 6th digit for the xxx-xxx-xxxx format
+
+# In[7]:
+
+@memoized('phone_number')
+def normalize_phone(phone_number):
+    """
+    Description:
+        Function used to clean a single phone number
+
+    Args:
+        phone_number (str): The raw phone number
+
+    Returns:
+        (phone_number, changes): The cleaned phone number (None if it should be removed) and a list of the (rule, old value, new value) changes made
+    """
+    digits = re.sub('[^0-9]','', phone_number)
+    if len(digits) < 10:
+        return None, [('phone_removed', phone_number, None)]
+    if digits[0] == '1':
+        digits = digits[1:]
+    formatted = digits[0:3] + '-' + digits[3:6] + '-' + digits[6:]
+    if formatted == phone_number:
+        return formatted, []
+    return formatted, [('phone_format', phone_number, formatted)]
+
+@register_cleaner
+def clean_phone_entry(entry):
+    """
+    Description:
+        Function used to clean the phone number data of a single entry from our 'shaped' San Diego map file
+
+    Args:
+        entry (dict): A dictionary representing a node/way element from our map data
+
+    Returns:
+        No return value, reports each changed value to record_change
+    """    
+    if 'phone_number' in entry.keys():
+        phone_number = apply_normalized(entry, 'phone_number', normalize_phone(entry['phone_number']))
+        if phone_number is None:
+            del entry['phone_number']
+        else:
+            entry['phone_number'] = phone_number
+
+def clean_phone(map_dict):
+    """
+    Description:
+        Function used to clean phone number data from our 'shaped' San Diego map file
+
+    Args:
+        map_dict (list): A list of dictionaries representing the node/way elements from our map data
+
+    Returns:
+        No return value, reports each changed value to record_change
+    """    
+    for entry in map_dict:
+        clean_phone_entry(entry)
+
+
+# ### 5.6 Amenity
+
+# In[88]:
+
+for a in sorted(amenity):
+    print a
+
+
+# All our amenity data looks like it is in good shape. I might have some arguments as to what should constitute an amenity but that is a gripe with OpenStreetMaps. Lets move on.
+
+# ### 5.7 Cuisine
+
+# In[266]:
+
+for c in sorted(cuisine):
+    print c
+
+
+# Note: Some entries in our data set are not fast food but retain the cuisine field (if the amenity is a restaurant, it is likely to have a cuisine field) we will clean these values even if we are not intending to use them in our analysis
+# 
+# Cleaning rules:
+# - If the first letter is capital, replace it with a lowercase
+# - If ';' or ',' is in the entry, split it and store as a list
+# - strip any whitespace cause by list splits
+# - strip _shop, _house from entries
+# - change 'india' values to 'indian'
+# - pluralize 'burger'and 'pretzel'
+# - any variation on donut (doughnut, doughnuts) should be donuts
+
+# In[8]:
+
+import unicodedata
+
+# convenience function for cleaning cuisine types that will be broken out into a list
+def clean_list_values(val):
+    """
+    Description:
+        Function used to clean cuisine names from list data within our 'shaped' San Diego map file
+
+    Args:
+        val: Typically an instance of str or unicode extracted from a split function being called on the 'cuisine' key's value.
+
+    Returns:
+        val: an instance of str or unicode without '_' or " " characters
+    """    
+    if "_" in val:
+        val = val.strip("_")
+    if " " in val:
+        val = val.strip(" ")
+    return val
+
+@memoized('cuisine', key=lambda raw: (raw, isinstance(raw, unicode)))
+def normalize_cuisine(raw):
+    """
+    Description:
+        Function used to clean a single cuisine value
+
+    Args:
+        raw (str or unicode): The raw cuisine
+
+    Returns:
+        (cuisine, changes): The cleaned cuisine (a list if it named several) and a list of the (rule, old value, new value) changes made
+    """
+    changes = []
+    cuisine = raw.lower()
+    if isinstance(raw, unicode):
+        cuisine = unicodedata.normalize('NFKD', cuisine).encode('ascii','ignore')
+        if cuisine != raw:
+            changes.append(('cuisine_unicode', raw, cuisine))
+    if "_shop" in cuisine:
+        val = cuisine[:-5]
+        changes.append(('cuisine_shop', cuisine, val))
+        cuisine = val
+    if "_house" in cuisine:
+        val = cuisine[:-6]
+        changes.append(('cuisine_house', cuisine, val))
+        cuisine = val
+    if "india" == cuisine:
+        val = "indian"
+        changes.append(('cuisine_india', cuisine, val))
+        cuisine = val
+    if "nut" in cuisine:
+        val = "donuts"
+        changes.append(('cuisine_donuts', cuisine, val))
+        cuisine = val
+    if "pretzel" == cuisine:
+        val = "pretzels"
+        changes.append(('cuisine_pretzels', cuisine, val))
+        cuisine = val
+    if "burger" in cuisine and 'burgers' not in cuisine:
+        val = cuisine.replace('burger', 'burgers')
+        changes.append(('cuisine_burgers', cuisine, val))
+        cuisine = val
+    if ";" in cuisine:
+        val = cuisine.split(';')
+        changes.append(('cuisine_list', cuisine, val))
+        cuisine = val
+    if "," in cuisine:
+        val = cuisine.split(',')
+        val = map(clean_list_values, val)
+        changes.append(('cuisine_list', cuisine, val))
+        cuisine = val
+    return cuisine, changes
+
+@register_cleaner
+def clean_cuisine_entry(entry):
+    """
+    Description:
+        Function used to clean the cuisine data of a single entry from our 'shaped' San Diego map file. A cuisine that is already
+        a list was cleaned before and is left alone; unlike clean_cuisine (which stops at the first such entry, as the list
+        version always did) a stream cannot stop, so only that entry is skipped.
+
+    Args:
+        entry (dict): A dictionary representing a node/way element from our map data
+
+    Returns:
+        No return value, reports each changed value to record_change
+    """    
+    if 'cuisine' in entry.keys():
+        if isinstance(entry['cuisine'], list):
+            count('cuisine_already_cleaned')
+            return
+        entry['cuisine'] = apply_normalized(entry, 'cuisine', normalize_cuisine(entry['cuisine']))
+
+def clean_cuisine(map_dict):
+    """
+    Description:
+        Function used to clean housenumber data from our 'shaped' San Diego map file
+
+    Args:
+        map_dict (list): A list of dictionaries representing the node/way elements from our map data
+
+    Returns:
+        No return value, reports each changed value to record_change
+    """    
+    for entry in map_dict:
+        if 'cuisine' in entry.keys() and isinstance(entry['cuisine'], list):
+            # The first cleaned cuisine means the data was cleaned already, stop like we always have
+            count('cuisine_already_cleaned')
+            break
+        clean_cuisine_entry(entry)
+
+
+# ### 5.8 Fast Food Names
+
+# Since the `name` field can be used to describe the name of any node, way, or tag, I decided to take a different approach to finding our unique values (as opposed to adding them to a set when parsing tags earlier, I pull them from our shaped data).
+# 
+# Lets take a look at what our fast food names look like
+
+# In[9]:
+
+def get_set_of_ff_names(data):
+    """
+    Description:
+        Function used to get unique fast food name data from our 'shaped' San Diego map file
+
+    Args:
+        data (list): A list of dictionaries representing the node/way elements from our map data
+
+    Returns:
+        ff_names (set): A set of the unique fast food names in our data
+    """
+    ff_names = set()
+
+    for row in data:
+        if 'amenity' in row.keys():
+            if row['amenity'] == "fast_food" and 'name' in row.keys():
+                ff_names.add(row['name'])
+    return ff_names
 
-# In[4]:
 
-def clean_housenumber(map_dict):
+# In[106]:
+
+ff_names = get_set_of_ff_names(sample)
+pp.pprint(ff_names)
+
+
+# It looks like we are going to have a lot of similar values to be cleaned (see Jack in the Box and In-N-Out) I will want to have a means of identifying what needs to be cleaned programatically when we apply this to the full data set. To do so, I will simply filter out those who have the first 4 characters in common. This isn't perfect and I can already see it impacting places that start with 'The ' but it is a quick way to reduce the set that needs to be cleaned to a size that I can manually scrub.
+
+# In[11]:
+
+def create_list_of_names_to_clean(set_data):
     """
     Description:
-        Function used to clean housenumber data from our 'shaped' San Diego map file
+        Function used to get narrow down which fast food names will need cleaning.
 
     Args:
-        map_dict (list): A list of dictionaries representing the node/way elements from our map data
+        set_data (list): A list of the fast food names, misspellings and all.
 
     Returns:
-        No return value, outputs data to be cleaned and it's new cleaned value
-    """    
-    for entry in map_dict:
-        if 'address' in entry.keys():
-            if 'housenumber' in entry['address'].keys():
-                if '.5' in entry['address']['housenumber']:
-                    print "{} becomes {}".format(entry['address']['housenumber'], entry['address']['housenumber'].replace('.5', '1/2'))
-                    entry['address']['housenumber'] = entry['address']['housenumber'].replace('.5', '1/2')
-                    
-                if ';' in entry['address']['housenumber']:
-                    house_range = entry['address']['housenumber'].split(';')
-                    start = int(house_range[0])
-                    end = int(house_range[1])
-                    if start > end:
-                        rng = range(end, start)
-                    else:
-                        rng = range(start, end)
-                    print "{} becomes {}".format(entry['address']['housenumber'], rng)
-                    entry['address']['housenumber'] = rng
+        name_clean (list): An (incomplete) list of fast food names to clean
+    """
+    name_clean = []
+    data = sorted(list(set_data))
+    for x in range(1, len(data)):
+        cur_name = data[x]
+        prev_name = data[x - 1]
+        if cur_name[:4] == prev_name[:4]:
+            name_clean.append(cur_name)
+    return name_clean
 
 
-# ### 5.4 Street Name
+# In[110]:
 
-# In[5]:
+to_clean = create_list_of_names_to_clean(ff_names)
+pp.pprint(to_clean)
 
-def get_road_types(road_names):
+
+# As we can see from the results above, this did not do an excellent job at filtering as it missed our only other similar value (In n out). I will still keep this method around as I don't expect the number of franchises to grow (although I do anticipate more of the current values will have different spellings) this is an extremely manual means of cleaning but that is just a part of cleaning sometimes.
+# 
+# **Edit** When I applied this to the full data set, my filter method generated a much larger list. I worked my way through this list, identified a regular expression that would target these issues, compiled it into the list of rules you see below and formed the cleaning function.
+
+# Our franchise rules are kept as an ordered list of (regular expression, franchise name) pairs. They are applied one after another, each to the name as the rules before it left it, and every rule that matches replaces the name, so when more than one rule matches the one listed last wins. The list is in the order the rules were always applied in (the order Python iterated the dictionary they used to be kept in), so the cleaned names stay the same. Each expression is compiled once, and since the same few names appear over and over, the result for each distinct name is remembered (see `memoized` above) instead of running every rule on every entry. Setting `FRANCHISE_RULES_FILE` loads the rules from a json file instead, to grow the table without touching the code.
+
+# In[12]:
+
+FRANCHISE_RULES = [
+    ("(Wiene)", "Wienerschnitzel"),
+    ("^Z", "Zpizza"),
+    ("^Bombay", "Bombay Coast Indian Tandoor & Curry Express"),
+    ("^Little", "Little Caesars"),
+    ("^Daphn", "Daphne's California Greek Restaurant"),
+    (".Green", "Carl's Jr. / The Green Burrito"),
+    ("^Wahoo", "Wahoo's Fish Taco"),
+    ("^Five", "Five Guys Burger and Fries"),
+    ("^Evolution", "Evolution Fast Food"),
+    ("^Roberto", "Roberto's Taco Shop"),
+    ("^Papa", "Papa John's Pizza"),
+    ("^In", "In-N-Out Burger"),
+    ("^Jersey", "Jersey Mike's Subs"),
+    ("^Santan", "Fresh MXN Food"),
+    ("^Carl.*(r|\.)$", "Carl's Jr."),
+    ("^Chipo", "Chipotle Mexican Grill"),
+    ("^Subway", "Subway"),
+    ("^Rubio", "Rubio's Coastal Grill"),
+    ("^Pick", "Pick Up Stix"),
+    ("^Arby", "Arby's"),
+    ("^Jack", "Jack in the Box")
+    ]
+FRANCHISE_RULES_FILE = None # Parameter: a json file of [regular expression, franchise name] pairs to use instead of FRANCHISE_RULES
+
+def load_franchise_rules(filename):
     """
     Description:
-        Grabs the last word in a street name and add it to a set
+        Function used to read franchise cleaning rules from a json file
 
     Args:
-        road_names (set): A set of street names
+        filename (str): A json file holding a list of [regular expression, franchise name] pairs in the order they are applied
 
     Returns:
-        road_type (set): a set of the last word in each of our street names.
+        rules (list): A list of (regular expression, franchise name) tuples
     """
-    road_type = set()
-    for name in road_names:
-        n = name.split()
-        road_type.add(n[len(n) - 1])
-    return road_type
+    with open(filename) as fp:
+        return [(rgx, name) for rgx, name in json.load(fp)]
 
-def get_road_prefix(road_names):
+def build_franchise_normalizer(rules):
     """
     Description:
-        Grabs the first word in a street name and add it to a set
+        Function used to compile our franchise rules once into a function applying them to a name. Every rule is compiled on its own
+        and searched for in the name as the earlier rules left it; each match replaces the name, so the last matching rule wins.
 
     Args:
-        road_names (set): A set of street names
+        rules (list): A list of (regular expression, franchise name) tuples in the order they are applied
 
     Returns:
-        road_type (set): a set of the first word in each of our street names.
+        normalize (function): A memoized function taking a name and returning (franchise, changes), the franchise name being
+            None if no rule matched
     """
-    pre = set()
-    for name in road_names:
-        pre.add(name.split()[0])
-    return pre
+    compiled = [(re.compile(rgx), name) for rgx, name in rules]
+
+    @memoized('name')
+    def normalize_franchise(original):
+        value, franchise = original, None
+        for rgx, name in compiled:
+            if rgx.search(value):
+                franchise = value = name
+        if franchise is None:
+            return None, []
+        if franchise == original:
+            return franchise, []
+        return franchise, [('fast_food_franchise', original, franchise)]
+    return normalize_franchise
+
+if FRANCHISE_RULES_FILE:
+    FRANCHISE_RULES = load_franchise_rules(FRANCHISE_RULES_FILE)
+normalize_franchise_name = build_franchise_normalizer(FRANCHISE_RULES)
+
+@register_cleaner
+def clean_fast_food_entry(entry):
+    """
+    Description:
+        Function used to change a misspelling of a franchise name in a single entry into the name listed on their website.
 
-road_types = get_road_types(street)
-road_prefix = get_road_prefix(street)
+    Args:
+        entry (dict): A dictionary representing a node/way element from our map data
 
+    Returns:
+        None
+    """
+    if 'name' in entry.keys():
+        if 'amenity' in entry.keys():
+            if entry['amenity'] ==  'fast_food':
+                franchise = apply_normalized(entry, 'name', normalize_franchise_name(entry['name']))
+                if franchise:
+                    entry['name'] = franchise
 
-# In[84]:
+def clean_fast_food_entries(data):
+    """
+    Description:
+        Function used to change misspellings of franchise names into the name listed on their websites.
 
-for rt in road_types:
-    if len(rt) < 4:
-        print rt
+    Args:
+        data (list): A list of dictionaries representing the node/way elements from our map data
 
+    Returns:
+        None
+    """
+    for entry in data:
+        clean_fast_food_entry(entry)
 
-# In[85]:
 
-for pre in road_prefix:
-    if len(pre) < 3:
-        print pre
+# ### 5.9 Places of Worship
 
+# I wanted to get a measure of the religious presence is in San Diego mostly to compare the number of churches to my current home in Seattle, WA. Below are the audit and cleaning functions. 
 
-# In order to audit street names I looked immediately for problem areas like cardinal direction abbreviations in the first and last word in a street name string as well as abbreviations in the last word of the string (St., Rd., etc)
-# 
-# Rules
-#  - In our prefix, we will need to clean out values smaller than 3 characters long with a '.'.
-#  - In our suffix, we will need to clean out values matching 'Av, Ave, Ct, Pl, Dr, Ln, St'
+# In[14]:
 
-# In[6]:
+def get_places_of_worship(data):
+    """
+    Description:
+        Function used to retrieve the unique places of worship in our data.
 
-def clean_street(data):
+    Args:
+        data (list): A list of dictionaries representing the node/way elements from our map data
+
+    Returns:
+        worship_set (set): set of unique types of places of worship
+    """    
+    worship_set = set()
+    for entry in data:
+        if 'amenity' in entry.keys():
+            if entry['amenity'] == 'place_of_worship':
+                if 'religion' in entry.keys():
+                    worship_set.add(entry['religion'])
+    return worship_set
+
+
+# In[120]:
+
+get_places_of_worship(sample)
+
+
+# Our sample only returns 3 distinct religions in San Diego and I found that hard to believe so I tested it on our master set later on. The data was in good shape so the only change I made was to lump the values 'unitarian_universal' in the unitarian bucket
+
+# In[15]:
+
+@register_cleaner
+def clean_religion_entry(entry):
     """
     Description:
-        Function used to clean street data from our 'shaped' San Diego map file
+        Function used to clean the type of place of worship of a single entry in our data
+
+    Args:
+        entry (dict): A dictionary representing a node/way element from our map data
+
+    Returns:
+        None, changes unitarian_ entries to unitarian
+    """    
+    if 'amenity' in entry.keys():
+        if entry['amenity'] == 'place_of_worship':
+            if 'religion' in entry.keys():
+                if 'unitarian_' in entry['religion']:
+                    record_change('religion_unitarian', entry, 'religion', entry['religion'], 'unitarian')
+                    entry['religion'] = 'unitarian'
+
+def clean_religion(data):
+    """
+    Description:
+        Function used to clean the types of places of worship in our data
 
     Args:
         data (list): A list of dictionaries representing the node/way elements from our map data
 
     Returns:
-        No return value, outputs data to be cleaned and it's new cleaned value
+        None, changes unitarian_ entries to unitarian
     """    
-    error = {
-        'Ave' : "Avenue",
-        'St' : "Street",
-        "Ln" : "Lane",
-        "Av" : "Avenue",
-        'Pl' : "Place",
-        "Dr" : "Drive",
-        "Dr." : "Drive",
-        'Rd' : "Road",
-        "Ct" : "Court",
-        "Rd." : "Road",   
-    }
     for entry in data:
-        if 'address' in entry.keys():
-            if 'street' in entry['address'].keys():
-                name = entry['address']['street'].split()
-                if name[len(name) - 1] in list(error.keys()):
-                    name[len(name) - 1] = error[name[len(name) - 1]]
-                    new_value = " ".join(map(str, name))
-                    print "{} becomes {}".format(entry['address']['street'], new_value)
-                    entry['address']['street'] = new_value
+        clean_religion_entry(entry)
 
 
-# ### 5.5 Phone Number
+# ### Master cleaning function
+# 
+# Here is a convenience function for cleaning our data at once
 
-# In[86]:
+# In[16]:
 
-for num in phone:
-    print num
+def clean_all(data):
+    """
+    Description:
+        Master function applying every registered cleaning function to each entry for convenience of cleaning all desired fields in one call.
+        Each entry is visited once, no matter how many cleaning functions are registered.
+        
+    Args:
+        data (list): A list of dictionaries representing the node/way elements from our map data
+
+    Returns:
+        None
+    """       
+    with stage_timer('clean_all', len(data)):
+        for entry in data:
+            clean_document(entry)
 
+def clean_stream(data):
+    """
+    Description:
+        Lazy version of clean_all; applies every registered cleaning function to one document at a time and yields it,
+        so it can sit between iter_shaped and write_to_json without the whole data set ever being held in memory
 
-# Cleaning rules:
-#  - Remove all non digit characters (i.e. periods, plus sign, parentheses, dashes, etc)
-#  - Take the length of the phone number, those fewer than 10 digits xxx xxx xxxx (without spaces) should be removed
-#  - If the phone number has a leading 1, remove it
-#  - insert a '-' character after the 3rd and 6th digit for the xxx-xxx-xxxx format
+    Args:
+        data (iterable): An iterable of dictionaries representing the node/way elements from our map data
+
+    Returns:
+        A generator of the cleaned dictionaries
+    """
+    for entry in data:
+        yield clean_document(entry)
+
+
+# Our cleaning rules see the values exactly as the parser returns them, and some of them care whether a value is `str` or `unicode` (the cuisine rules only strip accents from unicode values). Every parser backend must therefore produce the same strings, not just equal ones, or the change counts and the change log would depend on the parser that happened to run. `check_backends` shapes and cleans a file with each backend and checks that the documents and the number of changes made by each rule are the same.
+
+# In[ ]:
+
+def check_backends(osm_file, backends=None):
+    """
+    Description:
+        Function used to check that every parser backend gives the same cleaned documents and the same change counts (clears the telemetry counters)
+
+    Args:
+        osm_file (str): The name of the .osm file
+        backends (list)(optional): The backends to compare, defaults to every available backend
+
+    Returns:
+        changes (dict): The number of changes made by each rule, which is the same for every backend
+    """
+    results = {}
+    for backend in backends or sorted(PARSER_BACKENDS):
+        reset_telemetry()
+        docs = list(clean_stream(iter_shaped(osm_file, backend)))
+        results[backend] = (docs, dict(TELEMETRY['changes']))
+    (first, (docs, changes)), rest = results.items()[0], results.items()[1:]
+    for backend, (other_docs, other_changes) in rest:
+        assert other_docs == docs, "{} and {} give different documents".format(first, backend)
+        assert other_changes == changes, "{} and {} give different change counts: {} != {}".format(first, backend, changes, other_changes)
+    reset_telemetry()
+    return changes
+
+
+# In[ ]:
+
+print "Every backend makes the same changes: {}".format(check_backends(SAMPLE_FILE))
+
+
+# ### Element cache
+# 
+# Most of the map does not change between two downloads of the extract, yet every run shapes and cleans every element again. The cache below keeps the cleaned document of each element in a sqlite file, keyed by the element's type, id and version and by a fingerprint of our rules (the shaping function, the key sets it uses, every registered cleaner and the tables they use, such as `FRANCHISE_RULES`). An element that is already cached with the same version and rules is read back instead of being shaped and cleaned; changing any rule changes the fingerprint, so everything is processed again. The cache keeps at most `max_entries` elements, dropping the least recently used ones first.
+# 
+# Each cached document is stored with the changes and counts our cleaning rules recorded for it, and they are recorded again when the document is read back, so the telemetry report and the change log do not depend on whether the cache was used. Elements are looked up a few hundred at a time rather than with one query each.
+
+# In[ ]:
+
+import cPickle as pickle
+import dis
+import sqlite3
+import types
+from itertools import islice
+
+# Globals our rules use that hold run time state rather than rules
+FINGERPRINT_SKIP = set(['TELEMETRY'])
+# Elements looked up per cache query (sqlite allows 999 parameters per statement)
+CACHE_LOOKUP_SIZE = 900
+
+def rules_fingerprint(value, seen=None):
+    """
+    Description:
+        Function used to build a text fingerprint of a rule: a function's bytecode, constants and the globals it uses (followed recursively),
+        or a plain value such as a list, dict or compiled regular expression. Line numbers and file names are left out so moving a cell does not change it.
+
+    Args:
+        value: A function or value to fingerprint
+        seen (set)(optional): The functions already fingerprinted
+
+    Returns:
+        fingerprint (str)
+    """
+    if seen is None:
+        seen = set()
+    if isinstance(value, types.FunctionType):
+        # A memoized rule is fingerprinted by the function it wraps, not by its (changing) memo
+        value = getattr(value, '__wrapped__', value)
+        if value in seen:
+            return value.__name__
+        seen.add(value)
+        parts = [value.__name__, code_fingerprint(value.__code__, value.__globals__, seen)]
+        for cell in value.__closure__ or ():
+            parts.append(rules_fingerprint(cell.cell_contents, seen))
+        return '\n'.join(parts)
+    if isinstance(value, dict):
+        return '{' + ','.join(sorted(rules_fingerprint(k, seen) + ':' + rules_fingerprint(v, seen) for k, v in value.items())) + '}'
+    if isinstance(value, (set, frozenset)):
+        return '{' + ','.join(sorted(rules_fingerprint(v, seen) for v in value)) + '}'
+    if isinstance(value, (list, tuple)):
+        return '[' + ','.join(rules_fingerprint(v, seen) for v in value) + ']'
+    if isinstance(value, type(re.compile(''))):
+        return 're({!r}, {})'.format(value.pattern, value.flags)
+    if value is None or isinstance(value, (basestring, int, long, float, bool)):
+        return repr(value)
+    return type(value).__name__
+
+def global_names(code):
+    """
+    Description:
+        Function used to find the global variables a code object reads (co_names also holds attribute names, which must not be
+        confused with a global of the same name)
+
+    Args:
+        code (code): The code object
+
+    Returns:
+        names (list): The names loaded with LOAD_GLOBAL or LOAD_NAME, in order of first use
+    """
+    names = []
+    ops = (dis.opmap['LOAD_GLOBAL'], dis.opmap['LOAD_NAME'])
+    co_code = code.co_code
+    i, extended = 0, 0
+    while i < len(co_code):
+        op = ord(co_code[i])
+        if op < dis.HAVE_ARGUMENT:
+            i += 1
+            continue
+        arg = ord(co_code[i + 1]) + ord(co_code[i + 2]) * 256 + extended
+        i += 3
+        extended = 0
+        if op == dis.EXTENDED_ARG:
+            extended = arg * 65536
+        elif op in ops and code.co_names[arg] not in names:
+            names.append(code.co_names[arg])
+    return names
+
+def code_fingerprint(code, global_vars, seen):
+    """
+    Description:
+        Function used to fingerprint a code object for rules_fingerprint
+
+    Args:
+        code (code): The code object
+        global_vars (dict): The globals of the function the code belongs to
+        seen (set): The functions already fingerprinted
+
+    Returns:
+        fingerprint (str)
+    """
+    parts = [code.co_code, repr(code.co_names)]
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            parts.append(code_fingerprint(const, global_vars, seen))
+        else:
+            parts.append(repr(const))
+    for name in global_names(code):
+        if name in global_vars and name not in FINGERPRINT_SKIP:
+            parts.append(name + '=' + rules_fingerprint(global_vars[name], seen))
+    return '\n'.join(parts)
+
+def rules_hash():
+    """
+    Description:
+        Function used to hash the current shaping and cleaning rules
+
+    Returns:
+        The sha1 hex digest of the rules' fingerprint
+    """
+    return hashlib.sha1(rules_fingerprint([shape_element, CLEANERS])).hexdigest()
+
+def open_element_cache(path, rules, max_entries=5000000):
+    """
+    Description:
+        Function used to open (or create) a sqlite element cache, dropping entries made with other rules
+
+    Args:
+        path (str): The name of the sqlite file
+        rules (str): The hash of the current rules (see rules_hash)
+        max_entries (int)(optional): The number of elements to keep
+
+    Returns:
+        cache (dict): The connection, settings and hit/miss counts
+    """
+    db = sqlite3.connect(path)
+    # Caches written before the telemetry records were stored with each document are started over
+    if 'changes' not in [column[1] for column in db.execute('PRAGMA table_info(elements)')]:
+        db.execute('DROP TABLE IF EXISTS elements')
+    db.execute('CREATE TABLE IF NOT EXISTS elements (type TEXT, id INTEGER, version INTEGER, rules TEXT, doc BLOB, changes BLOB, '
+               'used INTEGER, PRIMARY KEY (type, id))')
+    db.execute('CREATE INDEX IF NOT EXISTS elements_used ON elements (used)')
+    db.execute('DELETE FROM elements WHERE rules != ?', (rules,))
+    db.commit()
+    clock = db.execute('SELECT MAX(used) FROM elements').fetchone()[0] or 0
+    return {'db': db, 'rules': rules, 'max_entries': max_entries, 'clock': clock, 'used': [], 'pending': [],
+            'hits': 0, 'misses': 0, 'evictions': 0}
+
+def cache_get_many(cache, keys):
+    """
+    Description:
+        Function used to look up the cleaned documents of many elements, with one query per element type and chunk of ids
+
+    Args:
+        cache (dict): The cache from open_element_cache
+        keys (list): (kind, id, version) tuples of the elements, kind being 'node' or 'way'
+
+    Returns:
+        found (dict): (kind, id (int)) -> (cleaned document, telemetry records) for every element cached with the same version
+    """
+    wanted = defaultdict(dict)
+    for kind, el_id, version in keys:
+        wanted[kind][int(el_id)] = int(version or 0)
+    found = {}
+    for kind, versions in wanted.items():
+        ids = list(versions)
+        for start in range(0, len(ids), CACHE_LOOKUP_SIZE):
+            chunk = ids[start:start + CACHE_LOOKUP_SIZE]
+            rows = cache['db'].execute('SELECT id, version, doc, changes FROM elements WHERE type = ? AND rules = ? AND id IN ({})'
+                                       .format(', '.join('?' * len(chunk))), [kind, cache['rules']] + chunk)
+            for el_id, version, doc, changes in rows:
+                if versions[el_id] == version:
+                    cache['clock'] += 1
+                    cache['used'].append((cache['clock'], kind, el_id))
+                    found[(kind, el_id)] = (pickle.loads(str(doc)), pickle.loads(str(changes)))
+    lookups = sum(len(versions) for versions in wanted.values())
+    cache['hits'] += len(found)
+    cache['misses'] += lookups - len(found)
+    return found
+
+def cache_put(cache, doc, changes=(), flush_every=10000):
+    """
+    Description:
+        Function used to store the cleaned document of an element (replacing any older version of it)
+
+    Args:
+        cache (dict): The cache from open_element_cache
+        doc (dict): The cleaned node/way
+        changes (list)(optional): The telemetry records captured while cleaning it (see capture_telemetry)
+        flush_every (int)(optional): The number of pending writes collected before they are written in one transaction
+
+    Returns:
+        None
+    """
+    cache['clock'] += 1
+    cache['pending'].append((doc['type'], int(doc['id']), int(doc['created']['version'] or 0), cache['rules'],
+                             sqlite3.Binary(pickle.dumps(doc, pickle.HIGHEST_PROTOCOL)),
+                             sqlite3.Binary(pickle.dumps(list(changes), pickle.HIGHEST_PROTOCOL)), cache['clock']))
+    if len(cache['pending']) + len(cache['used']) >= flush_every:
+        flush_cache(cache)
+
+def flush_cache(cache):
+    """
+    Description:
+        Function used to write pending documents and recency updates, then evict the least recently used elements above max_entries
+
+    Args:
+        cache (dict): The cache from open_element_cache
+
+    Returns:
+        None
+    """
+    db = cache['db']
+    db.executemany('INSERT OR REPLACE INTO elements VALUES (?, ?, ?, ?, ?, ?, ?)', cache['pending'])
+    db.executemany('UPDATE elements SET used = ? WHERE type = ? AND id = ?', cache['used'])
+    cache['pending'], cache['used'] = [], []
+    extra = db.execute('SELECT COUNT(*) FROM elements').fetchone()[0] - cache['max_entries']
+    if extra > 0:
+        db.execute('DELETE FROM elements WHERE rowid IN (SELECT rowid FROM elements ORDER BY used LIMIT ?)', (extra,))
+        cache['evictions'] += extra
+    db.commit()
+
+def cache_stats(cache):
+    """
+    Description:
+        Function used to summarize how well the cache is doing
+
+    Args:
+        cache (dict): The cache from open_element_cache
 
-# In[7]:
+    Returns:
+        stats (dict): hits, misses, hit_rate, evictions and the number of entries stored
+    """
+    flush_cache(cache)
+    lookups = cache['hits'] + cache['misses']
+    return {'hits': cache['hits'], 'misses': cache['misses'], 'evictions': cache['evictions'],
+            'hit_rate': cache['hits'] / float(lookups) if lookups else 0.0,
+            'entries': cache['db'].execute('SELECT COUNT(*) FROM elements').fetchone()[0]}
 
-def clean_phone(map_dict):
+def cached_documents(map_file, cache, processes=None, lookup_size=CACHE_LOOKUP_SIZE):
     """
     Description:
-        Function used to clean phone number data from our 'shaped' San Diego map file
+        Generator yielding the cleaned documents of an .osm file, reading unchanged elements from the cache instead of shaping and cleaning them.
+        When the cache is empty (the first run, or after a rule change) there is nothing to look up, so the file is shaped with iter_shaped_parallel instead.
+        The changes and counts recorded while cleaning an element are stored with it and recorded again when it is read back,
+        so the telemetry counters and the change log are the same whether or not the cache was used.
 
     Args:
-        map_dict (list): A list of dictionaries representing the node/way elements from our map data
+        map_file (str): The name of the .osm file
+        cache (dict): The cache from open_element_cache
+        processes (int)(optional): The number of worker processes used when the cache is empty
+        lookup_size (int)(optional): The number of elements read from the file and looked up in the cache at a time
 
     Returns:
-        No return value, outputs data to be cleaned and it's new cleaned value
-    """    
-    for entry in map_dict:
-        if 'phone_number' in entry.keys():
-            entry['phone_number'] = re.sub('[^0-9]','', entry['phone_number'])
-            if len(entry['phone_number']) < 10:
-                print "Removing {}".format(entry['phone_number'])
-                del entry['phone_number']
-            else:
-                if entry['phone_number'][0] == '1':
-                    entry['phone_number'] = entry['phone_number'][1:]
-                formatted = entry['phone_number'][0:3] + '-' + entry['phone_number'][3:6] + '-' + entry['phone_number'][6:]
-                print "{} becomes {}".format(entry['phone_number'], formatted)
-                entry['phone_number'] = formatted
+        A generator of cleaned dictionaries, in file order
+    """
+    try:
+        if cache['db'].execute('SELECT COUNT(*) FROM elements').fetchone()[0] == 0:
+            for entry in iter_shaped_parallel(map_file, processes):
+                cache['misses'] += 1
+                with capture_telemetry() as changes:
+                    entry = clean_document(entry)
+                cache_put(cache, entry, changes)
+                yield entry
+            return
+        records = iter_records(map_file)
+        while True:
+            chunk = list(islice(records, lookup_size))
+            if not chunk:
+                break
+            chunk = [record for record in chunk if record[0] != 'relation']
+            found = cache_get_many(cache, [(kind, attrib.get('id'), attrib.get('version')) for kind, attrib, tags, refs in chunk])
+            for kind, attrib, tags, refs in chunk:
+                hit = found.get((kind, int(attrib.get('id'))))
+                if hit is not None:
+                    entry, changes = hit
+                    replay_telemetry(entry, changes)
+                else:
+                    with capture_telemetry() as changes:
+                        entry = clean_document(shape_record(kind, attrib, tags, refs))
+                    cache_put(cache, entry, changes)
+                yield entry
+    finally:
+        flush_cache(cache)
 
 
-# ### 5.6 Amenity
+# # Cleaning, Shaping, and JSON-ifying our final output
+# 
+# Now that we have a sense of what is in our map data, lets apply all the cleaning functions we derived from our sample to our original map file.
+# We will start by shaping the data to a python dictionary, calling our cleaning functions one-by-one, then writing this dictionary out to a JSON file. Each stage is a generator, so every document flows from the parser to the JSON file on its own and memory use stays flat no matter how large the map file is.
+# 
+# Finally when our file is formed, we will upload it to our instance of MongoDB!
 
-# In[88]:
+# In[400]:
 
-for a in sorted(amenity):
-    print a
+node_builder = new_node_index_builder()
+element_cache = open_element_cache('sd_cache.sqlite', rules_hash())
+set_progress(sys.stderr)
+change_log = open_change_log('sd_changes.parquet' if pyarrow is not None else 'sd_changes.ndjson.gz')
+master = track_stage(add_way_geometry(index_node_positions(cached_documents('san-diego_california.osm', element_cache), node_builder), node_builder), 'pipeline')
 
 
-# All our amenity data looks like it is in good shape. I might have some arguments as to what should constitute an amenity but that is a gripe with OpenStreetMaps. Lets move on.
+# Note that `master` is a generator, nothing has been parsed or cleaned yet; the work happens as our writer pulls documents through it one at a time. `track_stage` writes a progress line with the number of documents per second to stderr every 100,000 documents, and once everything is written the telemetry report (time per stage and number of values changed by each cleaning rule) is saved to `sd_telemetry.json`.
 
-# ### 5.7 Cuisine
+# In[17]:
 
-# In[266]:
+def write_to_json(data, filename):
+    """
+    Description:
+        Function used to write out dictionary data to json file. Documents are written one at a time as they are pulled from data, so a generator (such as the output of clean_stream) is never held in memory as a whole.
+        Keys are written in sorted order so the file is byte-identical whether the documents came from iter_shaped or iter_shaped_parallel
+        (dictionaries sent back from a worker process can iterate their keys in a different order).
 
-for c in sorted(cuisine):
-    print c
+    Args:
+        data (iterable): A list (or generator) of dictionaries representing the node/way elements from our map data
+        filename (str): The desired outfile
 
+    Returns:
+        None, a outfile is created
+    """   
+    with open(filename, 'w') as fp:
+        fp.write('[')
+        for i, entry in enumerate(data):
+            if i:
+                fp.write(', ')
+            json.dump(entry, fp, sort_keys=True)
+        fp.write(']')
 
-# Note: Some entries in our data set are not fast food but retain the cuisine field (if the amenity is a restaurant, it is likely to have a cuisine field) we will clean these values even if we are not intending to use them in our analysis
-# 
-# Cleaning rules:
-# - If the first letter is capital, replace it with a lowercase
-# - If ';' or ',' is in the entry, split it and store as a list
-# - strip any whitespace cause by list splits
-# - strip _shop, _house from entries
-# - change 'india' values to 'indian'
-# - pluralize 'burger'and 'pretzel'
-# - any variation on donut (doughnut, doughnuts) should be donuts
 
-# In[8]:
+# A single JSON array has to be read back in one piece, so for the full data set we write newline delimited JSON instead: one document per line, optionally gzip (or zstd) compressed. Writing starts as soon as the first document comes out of the cleaning stage, and the file can be read back one line at a time.
 
-import unicodedata
+# In[ ]:
 
-# convenience function for cleaning cuisine types that will be broken out into a list
-def clean_list_values(val):
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def get_compression(filename, compression=None):
     """
     Description:
-        Function used to clean cuisine names from list data within our 'shaped' San Diego map file
+        Function used to work out which compression to use for a file, guessing from its extension if none is given
 
     Args:
-        val: Typically an instance of str or unicode extracted from a split function being called on the 'cuisine' key's value.
+        filename (str): The name of the file
+        compression (str)(optional): 'gzip', 'zstd' or 'none'
 
     Returns:
-        val: an instance of str or unicode without '_' or " " characters
-    """    
-    if "_" in val:
-        val = val.strip("_")
-    if " " in val:
-        val = val.strip(" ")
-    return val
-
-def clean_cuisine(map_dict):
+        compression (str): 'gzip', 'zstd' or None
+    """
+    if compression is None:
+        if filename.endswith('.gz'):
+            compression = 'gzip'
+        elif filename.endswith('.zst'):
+            compression = 'zstd'
+    if compression == 'none':
+        compression = None
+    if compression not in (None, 'gzip', 'zstd'):
+        raise ValueError("Unknown compression {}".format(compression))
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package")
+    return compression
+
+def open_ndjson(filename, mode='rb', compression=None):
     """
     Description:
-        Function used to clean housenumber data from our 'shaped' San Diego map file
+        Function used to open a (possibly compressed) newline delimited JSON file
 
     Args:
-        map_dict (list): A list of dictionaries representing the node/way elements from our map data
+        filename (str): The name of the file
+        mode (str)(optional): 'rb' to read or 'wb' to write
+        compression (str)(optional): 'gzip', 'zstd' or 'none', guessed from the file extension by default
 
     Returns:
-        No return value, outputs data to be cleaned and it's new cleaned value
-    """    
-    for entry in map_dict:
-        if 'cuisine' in entry.keys():
-            if isinstance(entry['cuisine'], list):
-                print "Already cleaned!"
-                break
-            cuisine = entry['cuisine'].lower()
-            if isinstance(entry['cuisine'], unicode):
-                cuisine = unicodedata.normalize('NFKD', cuisine).encode('ascii','ignore')
-                print "Unicode becomes {}".format(cuisine)
-            if "_shop" in cuisine:
-                val = cuisine[:-5]
-                print "{} becomes {}".format(cuisine, val)
-                cuisine = val
-            if "_house" in cuisine:
-                val = cuisine[:-6]
-                print "{} becomes {}".format(cuisine, val)
-                cuisine = val
-            if "india" == cuisine:
-                val = "indian"
-                print "{} becomes {}".format(cuisine, val)
-                cuisine = val
-            if "nut" in cuisine:
-                val = "donuts"
-                print "{} becomes {}".format(cuisine, val)
-                cuisine = val
-            if "pretzel" == cuisine:
-                val = "pretzels"
-                print "{} becomes {}".format(cuisine, val)
-                cuisine = val
-            if "burger" in cuisine and 'burgers' not in cuisine:
-                val = cuisine.replace('burger', 'burgers')
-                print "{} becomes {}".format(cuisine, val)
-                cuisine = val
-            if ";" in cuisine:
-                val = cuisine.split(';')
-                print "{} becomes {}".format(cuisine, val)
-                cuisine = val  
-            if "," in cuisine:
-                val = cuisine.split(',')
-                val = map(clean_list_values, val)
-                print "{} becomes {}".format(cuisine, val)
-                cuisine = val 
-            entry['cuisine'] = cuisine                   
-
-
-# ### 5.8 Fast Food Names
-
-# Since the `name` field can be used to describe the name of any node, way, or tag, I decided to take a different approach to finding our unique values (as opposed to adding them to a set when parsing tags earlier, I pull them from our shaped data).
-# 
-# Lets take a look at what our fast food names look like
+        A binary file object
+    """
+    compression = get_compression(filename, compression)
+    if compression == 'gzip':
+        return gzip.open(filename, mode)
+    if compression == 'zstd':
+        fp = open(filename, mode)
+        if 'w' in mode:
+            return zstandard.ZstdCompressor().stream_writer(fp)
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fp))
+    return open(filename, mode)
+
+def write_to_ndjson(data, filename, compression=None, buffer_size=1 << 20):
+    """
+    Description:
+        Function used to write out dictionary data to a newline delimited JSON file, one document per line.
+        Lines are collected into a buffer of roughly buffer_size bytes before each write.
 
-# In[9]:
+    Args:
+        data (iterable): A list (or generator) of dictionaries representing the node/way elements from our map data
+        filename (str): The desired outfile
+        compression (str)(optional): 'gzip', 'zstd' or 'none', guessed from the file extension by default
+        buffer_size (int)(optional): The number of bytes to collect before writing
 
-def get_set_of_ff_names(data):
+    Returns:
+        count (int): The number of documents written
+    """
+    count = 0
+    with open_ndjson(filename, 'wb', compression) as fp:
+        lines = []
+        size = 0
+        for entry in data:
+            line = json.dumps(entry, sort_keys=True) + '\n'
+            lines.append(line)
+            size += len(line)
+            count += 1
+            if size >= buffer_size:
+                fp.write(''.join(lines))
+                lines = []
+                size = 0
+        fp.write(''.join(lines))
+    return count
+
+def iter_ndjson(filename, compression=None):
     """
     Description:
-        Function used to get unique fast food name data from our 'shaped' San Diego map file
+        Function used to read a newline delimited JSON file back one document at a time
 
     Args:
-        data (list): A list of dictionaries representing the node/way elements from our map data
+        filename (str): The name of the file
+        compression (str)(optional): 'gzip', 'zstd' or 'none', guessed from the file extension by default
 
     Returns:
-        ff_names (set): A set of the unique fast food names in our data
+        A generator of dictionaries
     """
-    ff_names = set()
+    with open_ndjson(filename, 'rb', compression) as fp:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
 
-    for row in data:
-        if 'amenity' in row.keys():
-            if row['amenity'] == "fast_food" and 'name' in row.keys():
-                ff_names.add(row['name'])
-    return ff_names
 
+# In[403]:
+
+print "{} documents written".format(write_to_ndjson(master, 'sd.ndjson.gz'))
+print "{} changes logged to {}".format(close_change_log(change_log), change_log['filename'])
 
-# In[106]:
 
-ff_names = get_set_of_ff_names(sample)
-pp.pprint(ff_names)
+# In[ ]:
 
+node_index = finish_node_index(node_builder, 'sd_nodes')
+print "{} nodes indexed".format(len(node_index['ids']))
+print cache_stats(element_cache)
+print json.dumps(telemetry_report('sd_telemetry.json')['changes'], indent=2, sort_keys=True)
 
-# It looks like we are going to have a lot of similar values to be cleaned (see Jack in the Box and In-N-Out) I will want to have a means of identifying what needs to be cleaned programatically when we apply this to the full data set. To do so, I will simply filter out those who have the first 4 characters in common. This isn't perfect and I can already see it impacting places that start with 'The ' but it is a quick way to reduce the set that needs to be cleaned to a size that I can manually scrub.
 
-# In[11]:
+# ## Incremental Updates
+# 
+# Refreshing the database by downloading the whole extract again and rerunning everything above takes a long time, even though only a small part of the map changes from one day to the next. OpenStreetMap publishes these changes as osmChange files (.osc, usually gzipped), which list the elements that were created, modified or deleted:
+# 
+#     <osmChange version="0.6">
+#       <modify>
+#         <node id="2406124091" version="3" timestamp="2016-02-01T10:12:03Z" ... >
+#           <tag k="amenity" v="fast_food"/>
+#         </node>
+#       </modify>
+#       <delete>
+#         <way id="123" version="4" ... />
+#       </delete>
+#     </osmChange>
+# 
+# `apply_changes` shapes and cleans only the elements in a change file with the same `shape_element` and `clean_document` functions used above, then upserts or deletes them in MongoDB using the same `_id` (type/id) the loader gives each document. A change is skipped when the stored document already has the same or a newer `created.version` (or, for equal versions, a timestamp that is not older), so replaying an old change file does no harm. A deleted element leaves a tombstone behind (its `_id`, the version and timestamp of the delete and `deleted: true`) in a side collection (`san-diego-map_tombstones`), and creates or modifications are checked against it, so an older change file cannot bring a deleted element back.
+# 
+# Every applied change is also written to a journal collection (`san-diego-map_journal`) with the report fields (`type`, `created.user`, `amenity`, `name`, `cuisine`) of the document before and after the change. The analysis notebook keeps its report summaries up to date from this journal instead of recomputing them over the whole collection. Once changes were applied, the collection's version stamp (in `collection_versions`) is bumped so the analysis notebook stops using query results it cached before.
 
-def create_list_of_names_to_clean(set_data):
+# In[ ]:
+
+from pymongo import DeleteOne, ReplaceOne
+
+CHANGE_ACTIONS = ('create', 'modify', 'delete')
+JOURNAL_FIELDS = ['type', 'created.user', 'amenity', 'name', 'cuisine']
+
+def iter_changes(change_file):
     """
     Description:
-        Function used to get narrow down which fast food names will need cleaning.
+        Generator parsing an osmChange file one element at a time
 
     Args:
-        set_data (list): A list of the fast food names, misspellings and all.
+        change_file (str): The name of the .osc file (gzip compressed if it ends in .gz)
 
     Returns:
-        name_clean (list): An (incomplete) list of fast food names to clean
+        A generator of (action, doc) tuples; doc is the shaped (not yet cleaned) node/way
     """
-    name_clean = []
-    data = sorted(list(set_data))
-    for x in range(1, len(data)):
-        cur_name = data[x]
-        prev_name = data[x - 1]
-        if cur_name[:4] == prev_name[:4]:
-            name_clean.append(cur_name)
-    return name_clean
-
-
-# In[110]:
-
-to_clean = create_list_of_names_to_clean(ff_names)
-pp.pprint(to_clean)
-
-
-# As we can see from the results above, this did not do an excellent job at filtering as it missed our only other similar value (In n out). I will still keep this method around as I don't expect the number of franchises to grow (although I do anticipate more of the current values will have different spellings) this is an extremely manual means of cleaning but that is just a part of cleaning sometimes.
-# 
-# **Edit** When I applied this to the full data set, my filter method generated a much larger list. I worked my way through this list, identified a regular expression that would target these issues, compiled it into the dictionary you see below and formed the cleaning function.
-
-# In[12]:
-
-def clean_fast_food_entries(data):
+    fp = gzip.open(change_file, 'rb') if change_file.endswith('.gz') else open(change_file, 'rb')
+    with fp:
+        context = iter(ET.iterparse(fp, events=('start', 'end')))
+        _, root = next(context)
+        action = None
+        for ev, el in context:
+            if ev == 'start':
+                if el.tag in CHANGE_ACTIONS:
+                    action = el.tag
+            elif el.tag in ('node', 'way', 'relation'):
+                if el.tag != 'relation' and action is not None:
+                    yield action, shape_element(el)
+                root.clear()
+
+def change_id(doc):
     """
     Description:
-        Function used to change misspellings of franchise names into the name listed on their websites.
+        Function used to build the MongoDB _id of a shaped document, matching the one used by load_collection
 
     Args:
-        data (list): A list of dictionaries representing the node/way elements from our map data
+        doc (dict): A shaped node/way
 
     Returns:
-        None
+        The _id (unicode)
     """
-    regex_dict = {
-    "^Arby": "Arby's",
-    "^Bombay" : "Bombay Coast Indian Tandoor & Curry Express",
-    ".Green" : "Carl's Jr. / The Green Burrito",
-    "^Carl.*(r|\.)$": "Carl's Jr.",
-    "^Chipo" : "Chipotle Mexican Grill",
-    "^Daphn" : "Daphne's California Greek Restaurant",
-    "(Wiene)" : "Wienerschnitzel",
-    "^Papa" : "Papa John's Pizza",
-    "^Rubio" : "Rubio's Coastal Grill",
-   "^Little" : "Little Caesars",
-    "^Pick" : "Pick Up Stix",
-   "^Jack" : "Jack in the Box",
-    "^In" : "In-N-Out Burger",
-    "^Five" : "Five Guys Burger and Fries",
-    "^Evolution": "Evolution Fast Food",
-    "^Jersey" : "Jersey Mike's Subs",
-    "^Roberto" : "Roberto's Taco Shop",
-    "^Santan" : "Fresh MXN Food",
-    "^Subway" : "Subway",
-    "^Wahoo" : "Wahoo's Fish Taco",
-    "^Z" : "Zpizza"
-    }
-    
-    for key in regex_dict.keys():
-        for entry in data:
-            if 'name' in entry.keys():
-                if 'amenity' in entry.keys():
-                    if entry['amenity'] ==  'fast_food':
-                        rgx = re.compile(key)
-                        if re.search(rgx, entry['name']):
-                            print "{} becomes {}".format(entry['name'], regex_dict[key])
-                            entry['name'] = regex_dict[key]
+    return u'{}/{}'.format(doc['type'], doc['id'])
 
+def is_newer(doc, current):
+    """
+    Description:
+        Function used to check whether a change is newer than the document already stored
 
-# ### 5.9 Places of Worship
+    Args:
+        doc (dict): The shaped node/way from the change file
+        current (dict): The stored document or the tombstone of a deleted one (only the created sub-document is needed), or None
 
-# I wanted to get a measure of the religious presence is in San Diego mostly to compare the number of churches to my current home in Seattle, WA. Below are the audit and cleaning functions. 
+    Returns:
+        True if the change should be applied
+    """
+    if current is None:
+        return True
+    new, old = doc['created'], current.get('created', {})
+    new_version, old_version = int(new.get('version') or 0), int(old.get('version') or 0)
+    if new_version != old_version:
+        return new_version > old_version
+    return (new.get('timestamp') or '') > (old.get('timestamp') or '')
+
+def journal_view(doc):
+    """
+    Description:
+        Function used to keep only the JOURNAL_FIELDS of a document
 
-# In[14]:
+    Args:
+        doc (dict): A stored or shaped document, or None
 
-def get_places_of_worship(data):
+    Returns:
+        view (dict): The same nesting as doc holding just those fields, None if doc is None
+    """
+    if doc is None:
+        return None
+    view = {}
+    for field in JOURNAL_FIELDS:
+        parts = field.split('.')
+        source, target = doc, view
+        for part in parts[:-1]:
+            source = source.get(part) if isinstance(source, dict) else None
+            target = target.setdefault(part, {})
+        if isinstance(source, dict) and parts[-1] in source:
+            target[parts[-1]] = source[parts[-1]]
+    return view
+
+def tombstone(_id, doc):
     """
     Description:
-        Function used to retrieve the unique places of worship in our data.
+        Function used to build the record kept for a deleted element
 
     Args:
-        data (list): A list of dictionaries representing the node/way elements from our map data
+        _id (unicode): The element's _id
+        doc (dict): The shaped node/way from the delete change
 
     Returns:
-        worship_set (set): set of unique types of places of worship
-    """    
-    worship_set = set()
-    for entry in data:
-        if 'amenity' in entry.keys():
-            if entry['amenity'] == 'place_of_worship':
-                if 'religion' in entry.keys():
-                    worship_set.add(entry['religion'])
-    return worship_set
-
+        tombstone (dict): The _id, the version and timestamp of the delete and deleted: True
+    """
+    created = doc['created']
+    return {'_id': _id, 'created': {'version': created.get('version'), 'timestamp': created.get('timestamp')}, 'deleted': True}
 
-# In[120]:
+def apply_change_batch(collection, batch, journal=None, tombstones=None):
+    """
+    Description:
+        Function used to apply one batch of changes, skipping the ones that are stale
 
-get_places_of_worship(sample)
+    Args:
+        collection (Collection): The MongoDb collection to update
+        batch (dict): _id -> (action, doc), holding the latest change seen for each element
+        journal (Collection)(optional): If given, the before/after journal_view of every applied change is inserted into it
+        tombstones (Collection)(optional): If given, deletes are recorded in it and changes to elements that are not
+            stored are checked against it, so a stale change cannot bring a deleted element back
 
+    Returns:
+        counts (dict): The number of documents upserted and deleted, and the number of stale changes skipped
+    """
+    counts = {'upserted': 0, 'deleted': 0, 'stale': 0}
+    projection = dict((field, 1) for field in ['created.version', 'created.timestamp'] + JOURNAL_FIELDS)
+    stored = collection.find({'_id': {'$in': list(batch)}}, projection)
+    current = dict((doc['_id'], doc) for doc in stored)
+    deleted = {}
+    if tombstones is not None:
+        missing = [_id for _id in batch if _id not in current]
+        if missing:
+            deleted = dict((doc['_id'], doc) for doc in tombstones.find({'_id': {'$in': missing}}))
+    requests = []
+    entries = []
+    buried = []
+    for _id, (action, doc) in batch.items():
+        if not is_newer(doc, current.get(_id, deleted.get(_id))):
+            counts['stale'] += 1
+        elif action == 'delete':
+            buried.append(ReplaceOne({'_id': _id}, tombstone(_id, doc), upsert=True))
+            if _id in current:
+                requests.append(DeleteOne({'_id': _id}))
+                entries.append({'element': _id, 'before': journal_view(current[_id]), 'after': None})
+                counts['deleted'] += 1
+        else:
+            doc = clean_document(doc)
+            doc['_id'] = _id
+            requests.append(ReplaceOne({'_id': _id}, doc, upsert=True))
+            entries.append({'element': _id, 'before': journal_view(current.get(_id)), 'after': journal_view(doc)})
+            counts['upserted'] += 1
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+    if tombstones is not None and buried:
+        tombstones.bulk_write(buried, ordered=False)
+    if journal is not None and entries:
+        journal.insert_many(entries)
+    return counts
+
+def bump_collection_version(collection):
+    """
+    Description:
+        Function used to move the version stamp of a collection on after its data changed (see the query cache in the analysis notebook)
 
-# Our sample only returns 3 distinct religions in San Diego and I found that hard to believe so I tested it on our master set later on. The data was in good shape so the only change I made was to lump the values 'unitarian_universal' in the unitarian bucket
+    Args:
+        collection (Collection): The MongoDb collection that changed
 
-# In[15]:
+    Returns:
+        None
+    """
+    collection.database['collection_versions'].update_one({'_id': collection.name}, {'$inc': {'version': 1}}, upsert=True)
 
-def clean_religion(data):
+def apply_changes(collection, change_file, batch_size=1000, journal_changes=True):
     """
     Description:
-        Function used to clean the types of places of worship in our data
+        Function used to bring a collection loaded from the full extract up to date with an osmChange file; deleted
+        elements are remembered in the <collection>_tombstones collection
 
     Args:
-        data (list): A list of dictionaries representing the node/way elements from our map data
+        collection (Collection): The MongoDb collection to update
+        change_file (str): The name of the .osc (or .osc.gz) file
+        batch_size (int)(optional): The number of elements looked up and written per round trip
+        journal_changes (bool)(optional): Record every applied change in the <collection>_journal collection (default)
 
     Returns:
-        None, changes unitarian_ entries to unitarian
-    """    
-    for entry in data:
-        if 'amenity' in entry.keys():
-            if entry['amenity'] == 'place_of_worship':
-                if 'religion' in entry.keys():
-                    if 'unitarian_' in entry['religion']:
-                        entry['religion'] = 'unitarian'
+        counts (dict): The number of documents upserted and deleted, and the number of stale changes skipped
+    """
+    counts = {'upserted': 0, 'deleted': 0, 'stale': 0}
+    journal = collection.database[collection.name + '_journal'] if journal_changes else None
+    tombstones = collection.database[collection.name + '_tombstones']
+    batch = {}
+    for action, doc in iter_changes(change_file):
+        _id = change_id(doc)
+        # An element can appear more than once in a change file, keep its latest version
+        if _id not in batch or is_newer(doc, batch[_id][1]):
+            batch[_id] = (action, doc)
+        if len(batch) >= batch_size:
+            for key, value in apply_change_batch(collection, batch, journal, tombstones).items():
+                counts[key] += value
+            batch = {}
+    if batch:
+        for key, value in apply_change_batch(collection, batch, journal, tombstones).items():
+            counts[key] += value
+    if counts['upserted'] or counts['deleted']:
+        bump_collection_version(collection)
+    return counts
+
+
+# In[ ]:
+
+from pymongo import MongoClient
+
+col = MongoClient()['san-diego']['san-diego-map']
+print apply_changes(col, 'san-diego.osc.gz')
+
+
+# ## Benchmarks
+# 
+# To know how long each stage of the pipeline takes, and how that changes as the code changes or the extract grows, the functions below build synthetic .osm files of any size from the tag distribution we profiled in Section 2 (so no download is needed), then time each stage on them: profiling, shaping, every registered cleaner on its own, writing JSON and NDJSON, and optionally loading into MongoDB. For every stage we record the time, the throughput and how the resident memory (RSS) of the process changed: `rss_delta_kb` is the current RSS after the stage minus before it (on Linux, where it can be read from /proc), and `peak_rss_raised_kb` is how far the stage pushed the process's peak RSS up. The peak is a high-water mark for the whole process, so a stage that needs less memory than an earlier one shows 0 there; `process_peak_rss_kb` is that high-water mark after the stage, not the stage's own peak. Python 2 has no tracemalloc, so allocations are not traced. Every run starts from a clean slate: the memos, the shared strings of `intern_string` and the telemetry counters are reset first, so a run does not profit from answers remembered by earlier cells or smaller sizes, and the memo hit rates of the run are saved with its results. The results are saved as JSON so the numbers of two versions can be compared with `compare_benchmarks`.
 
+# In[ ]:
 
-# ### Master cleaning function
-# 
-# Here is a convenience function for cleaning our data at once
+import bisect
+import platform
+import shutil
+import sys
+import tempfile
+from xml.sax.saxutils import quoteattr
 
-# In[16]:
+try:
+    import resource
+except ImportError:
+    resource = None
 
-def clean_all(data):
+SAN_DIEGO_BBOX = (32.53, -117.28, 33.12, -116.9)
+
+def weighted_picker(counts, rng):
     """
     Description:
-        Master function chaining together our other cleaning functions for convenience of cleaning all desired fields in one call
-        
+        Function used to build a function drawing items with probability proportional to their counts
+
     Args:
-        data (list): A list of dictionaries representing the node/way elements from our map data
+        counts (dict): item -> count
+        rng (Random): The random number generator
 
     Returns:
-        None
-    """       
-    print "1/6 Cleaning postcode data"
-    clean_postcode(data)
+        pick (function): A function with no arguments returning an item
+    """
+    items, cumulative, total = [], [], 0
+    for item, count in counts.items():
+        total += count
+        items.append(item)
+        cumulative.append(total)
+    return lambda: items[bisect.bisect_right(cumulative, rng.random() * total)]
+
+def poisson(rng, mean):
+    """
+    Description:
+        Function used to draw a number from a Poisson distribution (fine for the small means we need)
 
-    print "\n2/7 Cleaning house number data"
-    clean_housenumber(data)
-    
-    print "\n3/7 Cleaning street name data"
-    clean_street(data)
-    
-    print "\n4/7 Cleaning phone data"
-    clean_phone(data)
-    
-    print "\n5/7 Cleaning cuisine data"
-    clean_cuisine(data)
+    Args:
+        rng (Random): The random number generator
+        mean (float): The mean
 
-    print "\n6/7 Cleaning fast food name data"
-    clean_fast_food_entries(data)
+    Returns:
+        The number (int)
+    """
+    limit, k, p = math.exp(-mean), 0, rng.random()
+    while p > limit:
+        k += 1
+        p *= rng.random()
+    return k
 
-    print "\n7/7 Cleaning religion data"
-    clean_religion(data)
-    
-    print "All clean"
+def synthesize_osm(profile, osm_file, elements=100000, seed=0, bbox=SAN_DIEGO_BBOX):
+    """
+    Description:
+        Function used to write a synthetic .osm file whose nodes, ways and tags follow the distribution of a profiled file
 
+    Args:
+        profile (dict): The output of profile_osm
+        osm_file (str): The name of the file to write
+        elements (int)(optional): The number of nodes and ways to write
+        seed (int)(optional): The random seed; the same seed and profile always give the same file
+        bbox (tuple)(optional): The (min lat, min lon, max lat, max lon) the nodes are placed in
 
-# # Cleaning, Shaping, and JSON-ifying our final output
-# 
-# Now that we have a sense of what is in our map data, lets apply all the cleaning functions we derived from our sample to our original map file.
-# We will start by shaping the data to a python dictionary, calling our cleaning functions one-by-one, then writing this dictionary out to a JSON file.
-# 
-# Finally when our file is formed, we will upload it to our instance of MongoDB!
+    Returns:
+        counts (dict): The number of nodes and ways written
+    """
+    rng = random.Random(seed)
+    counts = profile['elements']
+    ways = int(elements * counts.get('way', 0) / float(counts.get('node', 0) + counts.get('way', 0) or 1))
+    nodes = elements - ways
+    tags_per_element = sum(stats['count'] for stats in profile['keys'].values()) / float(sum(counts.values()) or 1)
+    pick_key = weighted_picker(dict((key, stats['count']) for key, stats in profile['keys'].items()), rng)
+    pick_value = dict((key, weighted_picker(stats['top']['counts'], rng)) for key, stats in profile['keys'].items())
+
+    def write_element(fp, kind, el_id, attrs, refs):
+        fp.write('  <{} id="{}"{} version="{}" timestamp="{}" changeset="{}" uid="{uid}" user="user{uid}"'.format(
+            kind, el_id, attrs, rng.randint(1, 12), render_timestamp(rng.randint(1200000000, 1450000000)),
+            rng.randint(1, 40000000), uid=rng.randint(0, 499)))
+        keys = set(pick_key() for i in range(poisson(rng, tags_per_element)))
+        if not keys and not refs:
+            fp.write('/>\n')
+            return
+        fp.write('>\n')
+        for ref in refs:
+            fp.write('    <nd ref="{}"/>\n'.format(ref))
+        for key in sorted(keys):
+            value = pick_value[key]()
+            fp.write('    <tag k={} v={}/>\n'.format(quoteattr(key).encode('utf-8'), quoteattr(value).encode('utf-8')))
+        fp.write('  </{}>\n'.format(kind))
+
+    with open(osm_file, 'wb') as fp:
+        fp.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="synthesize_osm">\n')
+        for el_id in xrange(1, nodes + 1):
+            attrs = ' lat="{:.7f}" lon="{:.7f}"'.format(rng.uniform(bbox[0], bbox[2]), rng.uniform(bbox[1], bbox[3]))
+            write_element(fp, 'node', el_id, attrs, ())
+        for el_id in xrange(1, ways + 1):
+            start = rng.randint(1, max(1, nodes - 12))
+            write_element(fp, 'way', el_id, '', range(start, min(nodes, start + rng.randint(1, 11)) + 1))
+        fp.write('</osm>\n')
+    return {'node': nodes, 'way': ways}
+
+def peak_rss():
+    """
+    Description:
+        Function used to read the peak resident memory of this process (since it started, not of any one stage)
 
-# In[400]:
+    Returns:
+        The peak RSS in KB (None where the resource module is not available)
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
 
-master =  shape_data('san-diego_california.osm')
+def current_rss():
+    """
+    Description:
+        Function used to read the resident memory this process is using right now
 
+    Returns:
+        The current RSS in KB (None where /proc/self/statm is not available)
+    """
+    if resource is None or not os.path.exists('/proc/self/statm'):
+        return None
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * resource.getpagesize() // 1024
 
-# In[401]:
+def time_stage(stages, name, func, items=None):
+    """
+    Description:
+        Function used to run and measure one stage of the pipeline
 
-clean_all(master)
+    Args:
+        stages (list): The list the stage's measurements are appended to
+        name (str): The name of the stage
+        func (function): A function with no arguments running the stage
+        items (int or function)(optional): The number of items the stage processes (or a function computing it from what func returns),
+            defaults to the length of what func returns
 
+    Returns:
+        Whatever func returns
+    """
+    rss, peak = current_rss(), peak_rss()
+    start = time.time()
+    value = func()
+    seconds = time.time() - start
+    stage = {'stage': name, 'seconds': seconds, 'process_peak_rss_kb': peak_rss(), 'rss_delta_kb': None, 'peak_rss_raised_kb': None}
+    if rss is not None:
+        stage['rss_delta_kb'] = current_rss() - rss
+    if peak is not None:
+        stage['peak_rss_raised_kb'] = stage['process_peak_rss_kb'] - peak
+    if items is None:
+        items = len(value)
+    elif callable(items):
+        items = items(value)
+    stage['items'] = items
+    stage['items_per_sec'] = stage['items'] / seconds if seconds else None
+    stages.append(stage)
+    return value
+
+def benchmark_pipeline(osm_file, collection=None, batch_size=1000):
+    """
+    Description:
+        Function used to time every stage of our pipeline on an .osm file
 
-# In[17]:
+    Args:
+        osm_file (str): The name of the .osm file
+        collection (Collection)(optional): A MongoDb collection to time the load with; it is dropped first and its version stamp
+            is bumped after the load
+        batch_size (int)(optional): The number of documents per insert when loading
 
-def write_to_json(data, filename):
+    Returns:
+        results (dict): The file, the environment, a list of measurements for each stage and the memo statistics of the run
+    """
+    # Start from empty memos and counters, whatever ran before
+    reset_memos()
+    INTERNED.clear()
+    reset_telemetry()
+    stages = []
+    workdir = tempfile.mkdtemp()
+    try:
+        time_stage(stages, 'profile_osm', lambda: profile_osm(osm_file), lambda profile: sum(profile['elements'].values()))
+        docs = time_stage(stages, 'shape_data', lambda: shape_data(osm_file))
+        for cleaner in CLEANERS:
+            time_stage(stages, cleaner.__name__, lambda: [cleaner(entry) for entry in docs])
+        time_stage(stages, 'write_to_json', lambda: write_to_json(docs, os.path.join(workdir, 'out.json')), len(docs))
+        time_stage(stages, 'write_to_ndjson', lambda: write_to_ndjson(docs, os.path.join(workdir, 'out.ndjson.gz')), len(docs))
+        if collection is not None:
+            collection.drop()
+            def load():
+                for i in xrange(0, len(docs), batch_size):
+                    collection.insert_many([dict(entry) for entry in docs[i:i + batch_size]], ordered=False)
+            time_stage(stages, 'mongo_load', load, len(docs))
+            bump_collection_version(collection)
+    finally:
+        shutil.rmtree(workdir)
+    return {'file': osm_file, 'size_bytes': os.path.getsize(osm_file), 'python': platform.python_version(),
+            'platform': platform.platform(), 'time': render_timestamp(time.time()), 'stages': stages, 'memos': memo_stats()}
+
+def save_benchmark(results, filename):
     """
     Description:
-        Function used to write out dictionary data to json file
+        Function used to save benchmark results as json
 
     Args:
-        data (list): A list of dictionaries representing the node/way elements from our map data
+        results (dict or list): The output of benchmark_pipeline (or a list of them)
         filename (str): The desired outfile
 
     Returns:
         None, a outfile is created
-    """   
+    """
     with open(filename, 'w') as fp:
-        json.dump(data, fp)
-
+        json.dump(results, fp, indent=2, sort_keys=True)
 
-# In[403]:
+def compare_benchmarks(old_file, new_file):
+    """
+    Description:
+        Function used to compare the stage timings of two saved benchmarks (run on the same synthetic files)
 
-write_to_json(master, 'sd.json')
+    Args:
+        old_file (str): The json file of the older run
+        new_file (str): The json file of the newer run
 
+    Returns:
+        rows (list): (file, stage, old seconds, new seconds, new / old) tuples for the stages found in both runs
+    """
+    def seconds(filename):
+        with open(filename) as fp:
+            results = json.load(fp)
+        if isinstance(results, dict):
+            results = [results]
+        return dict(((os.path.basename(run['file']), stage['stage']), stage['seconds']) for run in results for stage in run['stages'])
+    old, new = seconds(old_file), seconds(new_file)
+    return [(key[0], key[1], old[key], new[key], new[key] / old[key] if old[key] else None) for key in sorted(old) if key in new]
+
+
+# In[ ]:
+
+benchmarks = []
+for size in (10000, 100000, 1000000):
+    synthetic_file = 'synthetic_{}.osm'.format(size)
+    synthesize_osm(profile, synthetic_file, elements=size, seed=0)
+    benchmarks.append(benchmark_pipeline(synthetic_file))
+    for stage in benchmarks[-1]['stages']:
+        print "{:>10} {:<24} {:8.2f}s {:>12,.0f} items/sec {:>10} KB RSS change".format(size, stage['stage'], stage['seconds'], stage['items_per_sec'] or 0, stage['rss_delta_kb'])
+    for field, stats in sorted(benchmarks[-1]['memos'].items()):
+        print "{:>10} memo {:<19} {:.1%} hit rate".format(size, field, stats['hit_rate'])
+save_benchmark(benchmarks, 'benchmark.json')
+
+
+# Rerunning the cell above after a change (saving to another file) and calling `compare_benchmarks('benchmark.json', 'benchmark_new.json')` lists how much faster or slower each stage became.
@@ -25,14 +25,1418 @@ db = client['san-diego']
 col = db['san-diego-map']
 
 
-# Now that we our client, database and collection ready, we will read our `sd.json` file (output from our shaping/cleaning functions before) into a python variable and load it into the collection using `insert_many`
+# Now that we our client, database and collection ready, we will load our `sd.ndjson.gz` file (output from our shaping/cleaning functions before) into the collection.
+# 
+# Reading the whole file into a python variable and handing it to a single `insert_many` call needs the entire data set in memory at once, so instead we stream the documents from the file (newline delimited JSON, or the older single JSON array in `sd.json`) and insert them in batches from a few worker threads. Each document gets an `_id` made from its type and id (e.g. `node/2406124091`), so a load that crashed can pick up from its checkpoint file and simply skip documents that were already inserted.
+
+# In[204]:
+
+import codecs
+import gzip
+import io
+import os
+import threading
+import time
+import Queue
+from pymongo.errors import BulkWriteError
+
+def open_data_file(filename):
+    """
+    Description: Convenience function for opening a (possibly gzip or zstd compressed) data file for reading
+    
+    Args:
+        filename (str): The name of the file, compression is guessed from a .gz or .zst extension
+
+    Returns:
+        A binary file object
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.zst'):
+        import zstandard
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb')))
+    return open(filename, 'rb')
+
+def iter_documents(filename, chunk_size=1 << 20):
+    """
+    Description: Generator yielding the documents from either a newline delimited JSON file or a file holding one JSON array, without reading the whole file into memory
+    
+    Args:
+        filename (str): The name of the file
+        chunk_size (int)(optional): The number of bytes read at a time from a JSON array file
+
+    Returns:
+        A generator of dictionaries
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    with open_data_file(filename) as fp:
+        buf = text.decode(fp.read(chunk_size)).lstrip()
+        if not buf.startswith('['):
+            # Newline delimited: finish the first (partial) line then read line by line
+            lines = (buf + text.decode(fp.readline())).splitlines()
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        pos = 1
+        while True:
+            # Skip whitespace and separators between documents
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            try:
+                doc, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                more = fp.read(chunk_size)
+                if not more:
+                    raise
+                buf = buf[pos:] + text.decode(more)
+                pos = 0
+                continue
+            if end == len(buf):
+                # A number or literal could continue in the next chunk; a document never ends at the edge of the buffer
+                more = fp.read(chunk_size)
+                if more:
+                    buf = buf[pos:] + text.decode(more)
+                    pos = 0
+                    continue
+            yield doc
+            pos = end
+
+def iter_batches(docs, batch_size):
+    """
+    Description: Generator grouping documents into lists of batch_size
+    
+    Args:
+        docs (iterable): The documents to group
+        batch_size (int): The number of documents in each batch
+
+    Returns:
+        A generator of lists of documents
+    """
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def collection_version(collection):
+    """
+    Description: Reads the version stamp of a collection (bumped by every load or change), 0 if it was never stamped
+    
+    Args:
+        collection (Collection): The MongoDb collection
+
+    Returns:
+        The version as an int
+    """
+    stamp = collection.database['collection_versions'].find_one({'_id': collection.name})
+    return stamp['version'] if stamp else 0
+
+def bump_collection_version(collection):
+    """
+    Description: Moves the version stamp of a collection on after its data changed, so cached query results are no longer used
+    
+    Args:
+        collection (Collection): The MongoDb collection
+
+    Returns:
+        None
+    """
+    collection.database['collection_versions'].update_one({'_id': collection.name}, {'$inc': {'version': 1}}, upsert=True)
+
+def insert_batch(collection, batch):
+    """
+    Description: Convenience function for inserting one batch with an unordered bulk write, ignoring documents that are already in the collection
+    
+    Args:
+        collection (Collection): The MongoDb collection to insert into
+        batch (list of dict): The documents to insert
+
+    Returns:
+        The number of documents inserted
+    """
+    try:
+        collection.insert_many(batch, ordered=False)
+    except BulkWriteError as e:
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
+        return e.details['nInserted']
+    return len(batch)
+
+def load_collection(collection, filename, batch_size=1000, workers=4, checkpoint=None, report_every=100):
+    """
+    Description: Streams documents from a data file into a collection in batches using several worker threads, reporting progress as it goes.
+        If a checkpoint file is given, the number of batches committed in order is saved to it after each batch, and a later call
+        with the same file resumes after the last committed batch. The checkpoint file is removed once the load completes.
+    
+    Args:
+        collection (Collection): The MongoDb collection to load into
+        filename (str): A newline delimited JSON or JSON array data file
+        batch_size (int)(optional): The number of documents per insert_many call
+        workers (int)(optional): The number of threads inserting batches at once
+        checkpoint (str)(optional): The name of the checkpoint file used to resume an interrupted load
+        report_every (int)(optional): Print progress every report_every batches
+
+    Returns:
+        The number of documents inserted by this call
+    """
+    committed = 0
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as fp:
+            state = json.load(fp)
+        if state['filename'] == filename and state['batch_size'] == batch_size:
+            committed = state['batches']
+            print "Resuming after batch {}".format(committed)
+
+    status = {'committed': committed, 'finished': set(), 'loaded': 0, 'error': None}
+    lock = threading.Lock()
+    tasks = Queue.Queue(maxsize=workers * 2)
+    start = time.time()
+
+    def save_checkpoint():
+        tmp = checkpoint + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({'filename': filename, 'batch_size': batch_size, 'batches': status['committed']}, fp)
+        os.rename(tmp, checkpoint)
+
+    def worker():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            index, batch = task
+            try:
+                count = insert_batch(collection, batch)
+            except Exception as e:
+                with lock:
+                    status['error'] = status['error'] or e
+                continue
+            with lock:
+                status['loaded'] += count
+                status['finished'].add(index)
+                while status['committed'] in status['finished']:
+                    status['finished'].remove(status['committed'])
+                    status['committed'] += 1
+                if checkpoint:
+                    save_checkpoint()
+                if (index + 1) % report_every == 0:
+                    elapsed = time.time() - start
+                    print "{} documents loaded ({:.0f} docs/sec)".format(status['loaded'], status['loaded'] / max(elapsed, 1e-6))
+
+    threads = [threading.Thread(target=worker) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for index, batch in enumerate(iter_batches(iter_documents(filename), batch_size)):
+            if index < committed:
+                continue
+            if status['error']:
+                break
+            for doc in batch:
+                doc.setdefault('_id', u'{}/{}'.format(doc['type'], doc['id']))
+            tasks.put((index, batch))
+    finally:
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+        if status['loaded']:
+            bump_collection_version(collection)
+    if status['error']:
+        raise status['error']
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    elapsed = time.time() - start
+    print "{} documents loaded in {:.1f}s ({:.0f} docs/sec)".format(status['loaded'], elapsed, status['loaded'] / max(elapsed, 1e-6))
+    return status['loaded']
+
+
+load_collection(col, 'sd.ndjson.gz', batch_size=1000, workers=4, checkpoint='sd.load.checkpoint')
+
+
+# We can also check that an interrupted load resumes correctly without touching the real database: `check_load_resume` copies the first `max_documents` documents of a data file to a small temporary file and loads them into an in-process stand-in (mongomock, if it is installed) or any collection we pass, stops the load on purpose after a few batches as if the process had been killed, then runs it again from the checkpoint. Batches that were inserted after the last committed one are inserted a second time, so this also exercises the duplicate skipping; in the end every document must be in the collection exactly once.
+
+# In[ ]:
+
+import shutil
+import tempfile
+from itertools import islice
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+class InterruptedLoad(Exception):
+    """
+    Description: Raised by FailingCollection to stop a load part way
+    """
+
+class FailingCollection(object):
+    """
+    Description: Wraps a collection so one insert_many call fails once a number of batches were inserted, like a load that was killed;
+        batches other threads are already inserting still go through, so they end up after the last committed batch
+
+    Attributes:
+        collection (Collection): The wrapped collection
+        batches_left (int): The number of insert_many calls that succeed before the failing one
+    """
+    def __init__(self, collection, batches_left):
+        self.collection = collection
+        self.batches_left = batches_left
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def insert_many(self, batch, ordered=True):
+        with self.lock:
+            self.batches_left -= 1
+            if self.batches_left == -1:
+                raise InterruptedLoad("load stopped on purpose")
+        return self.collection.insert_many(batch, ordered=ordered)
+
+def check_load_resume(filename, collection=None, max_documents=2000, batch_size=100, fail_after=3, workers=2):
+    """
+    Description: Loads the first documents of a data file, stopping part way, then resumes from the checkpoint and checks every document was loaded exactly once
+    
+    Args:
+        filename (str): A newline delimited JSON or JSON array data file
+        max_documents (int)(optional): The number of documents from the start of the file the check is run on
+        collection (Collection)(optional): An empty collection to load into, defaults to an in-process mongomock collection
+        batch_size (int)(optional): The number of documents per batch
+        fail_after (int)(optional): The number of batches inserted before the first load is stopped
+        workers (int)(optional): The number of inserting threads
+
+    Returns:
+        The number of documents in the collection
+    """
+    if collection is None:
+        if mongomock is None:
+            raise ValueError("Pass a collection (e.g. from a local mongod) or install mongomock")
+        collection = mongomock.MongoClient()['check']['load']
+    workdir = tempfile.mkdtemp()
+    try:
+        sample_file = os.path.join(workdir, 'check.ndjson')
+        with open(sample_file, 'wb') as fp:
+            for doc in islice(iter_documents(filename), max_documents):
+                fp.write(json.dumps(doc) + '\n')
+        checkpoint = os.path.join(workdir, 'check.checkpoint')
+        try:
+            load_collection(FailingCollection(collection, fail_after), sample_file, batch_size, workers, checkpoint)
+            raise AssertionError("The first load should have been stopped")
+        except InterruptedLoad:
+            pass
+        assert os.path.exists(checkpoint), "No checkpoint was saved"
+        load_collection(collection, sample_file, batch_size, workers, checkpoint)
+        assert not os.path.exists(checkpoint), "The checkpoint was not removed"
+
+        ids = [u'{}/{}'.format(doc['type'], doc['id']) for doc in iter_documents(sample_file)]
+    finally:
+        shutil.rmtree(workdir)
+    stored = collection.count_documents({})
+    assert stored == len(set(ids)) == len(ids), "{} documents stored, {} in the file".format(stored, len(ids))
+    assert collection.count_documents({'_id': {'$in': ids}}) == stored
+    return stored
+
+
+# In[ ]:
+
+print "Resumed load stored {} documents".format(check_load_resume('sd.ndjson.gz', max_documents=2000))
+
+
+# Every query in our analysis filters or groups on `type`, `created.user`, `amenity`, `name` or `cuisine`, so once the data is loaded we create indexes for them. The fast food queries always match on `amenity: fast_food`, so their indexes are partial indexes only holding fast food entries; this keeps them tiny compared to the collection. Positions are GeoJSON, so `pos` (and the `geometry` line of each way) get `2dsphere` indexes for the proximity queries further down. At the end of the notebook we check with explain plans that each query actually uses one of them.
+
+# In[ ]:
+
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
+
+ANALYSIS_INDEXES = [
+    IndexModel([('type', ASCENDING)], name='type'),
+    IndexModel([('created.user', ASCENDING), ('type', ASCENDING)], name='user_type'),
+    IndexModel([('amenity', ASCENDING), ('name', ASCENDING)], name='fast_food_name',
+               partialFilterExpression={'amenity': 'fast_food'}),
+    IndexModel([('amenity', ASCENDING), ('cuisine', ASCENDING), ('name', ASCENDING)], name='fast_food_cuisine',
+               partialFilterExpression={'amenity': 'fast_food'}),
+    IndexModel([('pos', GEOSPHERE)], name='pos_2dsphere'),
+    IndexModel([('geometry', GEOSPHERE)], name='geometry_2dsphere'),
+]
+
+def ensure_indexes(collection, indexes=ANALYSIS_INDEXES):
+    """
+    Description: Convenience function for creating the indexes our analysis queries rely on; indexes that already exist are left alone
+    
+    Args:
+        collection (str): A string representing the name of the collection in MongoDb you wish to use
+        indexes (list of IndexModel)(optional): The indexes to create, defaults to ANALYSIS_INDEXES
+
+    Returns:
+        The names of the indexes
+    """
+    return collection.create_indexes(indexes)
+
+
+# In[ ]:
+
+print ensure_indexes(col)
+
+
+# ## Analysis without Mongo
+# 
+# For batch jobs, running a Mongo server just to count Subways is heavy. Since every one of our analysis queries only looks at a handful of fields (`type`, `created.user`, `amenity`, `name`, `cuisine`), we can instead load just those fields from our data file into NumPy arrays. Each field is dictionary encoded: every distinct value gets an integer code, so a `$group` becomes a `bincount` over the codes. Fields that can hold lists (like `cuisine`) also keep one (row, code) pair per list item, which is what `$unwind` and Mongo's "array contains" matching need.
+# 
+# The convenience functions below accept either a Mongo collection or one of these column stores, so the rest of the notebook works with both.
+
+# In[ ]:
+
+from array import array
+import numpy as np
+
+STORE_FIELDS = ['type', 'created.user', 'amenity', 'name', 'cuisine']
+MISSING = object()
+
+def get_path(doc, field):
+    """
+    Description: Looks up a (possibly dotted, e.g. 'created.user') field in a document
+    
+    Args:
+        doc (dict): The document
+        field (str): The field name
+
+    Returns:
+        The value, or MISSING if the field does not exist
+    """
+    for part in field.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return MISSING
+        doc = doc[part]
+    return doc
+
+def get_position(doc):
+    """
+    Description: Reads the position of a shaped node (a GeoJSON point, "coordinates": [lon, lat])
+    
+    Args:
+        doc (dict): The document
+
+    Returns:
+        (lat, lon) as floats, NaN for documents without a position
+    """
+    if 'pos' not in doc:
+        return float('nan'), float('nan')
+    lon, lat = doc['pos']['coordinates']
+    return lat, lon
+
+def value_key(value):
+    """
+    Description: Turns a field value into something hashable so lists and sub-documents can be dictionary encoded
+    
+    Args:
+        value: Any JSON value
+
+    Returns:
+        A hashable version of value
+    """
+    if isinstance(value, list):
+        return ('list',) + tuple(value_key(v) for v in value)
+    if isinstance(value, dict):
+        return ('dict',) + tuple(sorted((k, value_key(v)) for k, v in value.items()))
+    return value
+
+def build_column_store(docs, fields=STORE_FIELDS):
+    """
+    Description: Builds an in-memory, dictionary encoded column store from an iterable of documents
+    
+    Args:
+        docs (iterable): The documents, e.g. iter_documents('sd.ndjson.gz')
+        fields (list of str)(optional): The (dotted) fields to keep, defaults to STORE_FIELDS
+
+    Returns:
+        store (dict): 'size' is the number of documents and 'columns' maps each field to a dict holding
+            'values' (the distinct values, indexed by code), 'index' (value key to code),
+            'codes' (the code of each document's value, -1 when missing) and
+            'item_rows'/'item_codes' (one entry per list item, or per scalar value);
+            'lat' and 'lon' hold each document's position (NaN when it has none)
+    """
+    builders = dict((field, {'values': [], 'index': {}, 'codes': array('i'), 'item_rows': array('i'), 'item_codes': array('i')}) for field in fields)
+
+    def encode(column, value):
+        key = value_key(value)
+        code = column['index'].get(key)
+        if code is None:
+            code = column['index'][key] = len(column['values'])
+            column['values'].append(value)
+        return code
+
+    size = 0
+    lat, lon = array('d'), array('d')
+    for row, doc in enumerate(docs):
+        size += 1
+        position = get_position(doc)
+        lat.append(position[0])
+        lon.append(position[1])
+        for field in fields:
+            column = builders[field]
+            value = get_path(doc, field)
+            if value is MISSING:
+                column['codes'].append(-1)
+                continue
+            column['codes'].append(encode(column, value))
+            for item in (value if isinstance(value, list) else [value]):
+                column['item_rows'].append(row)
+                column['item_codes'].append(encode(column, item))
+
+    for column in builders.values():
+        for name in ('codes', 'item_rows', 'item_codes'):
+            column[name] = np.frombuffer(column[name], dtype=np.int32) if len(column[name]) else np.zeros(0, dtype=np.int32)
+    return {'size': size, 'columns': builders, 'lat': np.frombuffer(lat, dtype=np.float64) if size else np.zeros(0),
+            'lon': np.frombuffer(lon, dtype=np.float64) if size else np.zeros(0)}
+
+def is_store(collection):
+    """
+    Description: Tells a column store apart from a Mongo collection
+    
+    Args:
+        collection: A MongoDb collection or a column store from build_column_store
+
+    Returns:
+        True if collection is a column store
+    """
+    return isinstance(collection, dict) and 'columns' in collection
+
+def store_exists(store, field):
+    """
+    Description: Boolean mask of the documents where a field exists ({field: {"$exists": True}})
+    
+    Args:
+        store (dict): A column store from build_column_store
+        field (str): The field name
+
+    Returns:
+        A boolean NumPy array with one entry per document
+    """
+    return store['columns'][field]['codes'] >= 0
+
+def store_equals(store, field, value):
+    """
+    Description: Boolean mask of the documents matching {field: value}; like Mongo, a list matches if any of its items equal value
+    
+    Args:
+        store (dict): A column store from build_column_store
+        field (str): The field name
+        value: The value to match
+
+    Returns:
+        A boolean NumPy array with one entry per document
+    """
+    column = store['columns'][field]
+    mask = np.zeros(store['size'], dtype=bool)
+    code = column['index'].get(value_key(value))
+    if code is not None:
+        mask[column['item_rows'][column['item_codes'] == code]] = True
+    return mask
+
+def store_group_counts(column, codes, limit=None):
+    """
+    Description: Counts the codes of a column and returns them like a $group/$sort/$limit pipeline would
+    
+    Args:
+        column (dict): A column of a column store
+        codes (NumPy array): The codes to count
+        limit (int)(optional): An optional parameter for limiting the number of results
+
+    Returns:
+        A list of dicts with keys _id and count, most frequent first
+    """
+    counts = np.bincount(codes, minlength=len(column['values']))
+    order = np.argsort(-counts, kind='mergesort')
+    order = order[counts[order] > 0]
+    if limit:
+        order = order[:limit]
+    return [{'_id': column['values'][code], 'count': int(counts[code])} for code in order]
+
+def store_field_counts(store, field_name, limit=None):
+    """
+    Description: Column store version of get_field_counts
+    
+    Args:
+        store (dict): A column store from build_column_store
+        field_name (str): The column you wish to gather the unique values from
+        limit (int)(optional): An optional parameter for limiting the number of results
+
+    Returns:
+        A list of dicts with keys _id and count, most frequent first
+    """
+    codes = store['columns'][field_name]['codes']
+    return store_group_counts(store['columns'][field_name], codes[codes >= 0], limit)
+
+def store_unique_count(store, field_name):
+    """
+    Description: Column store version of get_unique_count; like distinct, list items are counted individually
+    
+    Args:
+        store (dict): A column store from build_column_store
+        field_name (str): The column you wish to count the unique values of
+
+    Returns:
+        The number of unique values
+    """
+    return len(np.unique(store['columns'][field_name]['item_codes']))
+
+def store_fast_food(store, limit=None):
+    """
+    Description: Column store version of get_fast_food
+    
+    Args:
+        store (dict): A column store from build_column_store
+        limit (int)(optional): An optional parameter for limiting the number of results
+
+    Returns:
+        A list of dicts with keys _id and count, most frequent first
+    """
+    mask = store_equals(store, 'amenity', 'fast_food') & store_exists(store, 'name')
+    return store_group_counts(store['columns']['name'], store['columns']['name']['codes'][mask], limit)
+
+def store_fast_food_cuisine_counts(store, limit=None):
+    """
+    Description: Column store version of get_fast_food_cuisine_counts ($unwind is a lookup of each list item's row in the mask)
+    
+    Args:
+        store (dict): A column store from build_column_store
+        limit (int)(optional): An optional parameter for limiting the number of results
+
+    Returns:
+        A list of dicts with keys _id and count, most frequent first
+    """
+    mask = store_equals(store, 'amenity', 'fast_food') & store_exists(store, 'cuisine')
+    column = store['columns']['cuisine']
+    codes = column['item_codes'][mask[column['item_rows']]]
+    if None in column['index']:
+        # $unwind drops null values
+        codes = codes[codes != column['index'][None]]
+    return store_group_counts(column, codes, limit)
+
+def store_fast_food_by_type(store, cuisine_type):
+    """
+    Description: Column store version of fast_food_by_type
+    
+    Args:
+        store (dict): A column store from build_column_store
+        cuisine_type (str): The cuisine to count franchises for
+
+    Returns:
+        A list of dicts with keys _id and count, most frequent first
+    """
+    mask = store_equals(store, 'amenity', 'fast_food') & store_equals(store, 'cuisine', cuisine_type) & store_exists(store, 'name')
+    return store_group_counts(store['columns']['name'], store['columns']['name']['codes'][mask])
+
+
+# In[ ]:
+
+store = build_column_store(iter_documents('sd.ndjson.gz'))
+
+start = time.time()
+for field in ['type', 'created.user']:
+    store_field_counts(store, field)
+    store_unique_count(store, field)
+store_fast_food(store, 15)
+store_fast_food_cuisine_counts(store, 5)
+for cuisine_type in ['burgers', 'sandwich', 'mexican', 'pizza', 'chicken']:
+    store_fast_food_by_type(store, cuisine_type)
+print "All analysis queries ran in {:.1f} ms".format((time.time() - start) * 1000)
+
+
+# ## Spatial queries
+# 
+# Questions like "all fast food within 2 km of downtown" cannot be answered from the columns above without checking the distance to every node. While building the column store we also keep each document's position (`lat`/`lon`, NaN for ways), and `build_spatial_index` sorts the positioned rows into a regular grid of cells (about 500 m on a side by default). The points of each cell are stored next to each other in NumPy arrays, ordered row of cells by row of cells, so a bounding box is answered by reading one contiguous slice per grid row it covers and then checking the exact coordinates of just those points.
+# 
+# A radius query searches the bounding box of the circle and keeps the points within the great circle distance, closest first. The nearest neighbour query runs radius queries with a doubling radius until it has found `k` points (everything inside the radius has been checked, so those are the true nearest). Every query takes an optional boolean `mask` over the store's documents (e.g. from `store_equals`), so attribute filters are joined to the spatial search for free.
+
+# In[ ]:
+
+import math
+
+EARTH_RADIUS = 6371008.8 # Mean earth radius in meters
+
+def haversine(lat, lon, lats, lons):
+    """
+    Description: Great circle distance from one point to one or many points
+    
+    Args:
+        lat (float): Latitude of the first point
+        lon (float): Longitude of the first point
+        lats (float or NumPy array): Latitude(s) of the other point(s)
+        lons (float or NumPy array): Longitude(s) of the other point(s)
+
+    Returns:
+        The distance(s) in meters
+    """
+    lat1, lat2 = np.radians(lat), np.radians(lats)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(np.radians(lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def build_spatial_index(store, cell_size=0.005):
+    """
+    Description: Builds a grid index over the positions kept in a column store
+    
+    Args:
+        store (dict): A column store from build_column_store
+        cell_size (float)(optional): The width and height of a grid cell in degrees
+
+    Returns:
+        index (dict): The grid ('lat0', 'lon0', 'cell_size', 'nx', 'ny'), 'starts' (the offset of each cell's first point,
+            plus one final offset) and the 'rows', 'lat' and 'lon' of the points sorted by cell
+    """
+    rows = np.nonzero(~np.isnan(store['lat']))[0].astype(np.int32)
+    lat, lon = store['lat'][rows], store['lon'][rows]
+    index = {'cell_size': cell_size, 'lat0': 0.0, 'lon0': 0.0, 'nx': 1, 'ny': 1}
+    if len(rows):
+        index.update(lat0=lat.min(), lon0=lon.min(),
+                     nx=int((lon.max() - lon.min()) // cell_size) + 1, ny=int((lat.max() - lat.min()) // cell_size) + 1)
+    cells = grid_cell(index, lat, lon)
+    order = np.argsort(cells, kind='mergesort')
+    index['starts'] = np.concatenate(([0], np.cumsum(np.bincount(cells, minlength=index['nx'] * index['ny']))))
+    index['rows'], index['lat'], index['lon'] = rows[order], lat[order], lon[order]
+    return index
+
+def grid_xy(index, lat, lon):
+    """
+    Description: The grid column and row of one or many positions, clipped to the grid
+    
+    Args:
+        index (dict): A spatial index from build_spatial_index
+        lat (float or NumPy array): Latitude(s)
+        lon (float or NumPy array): Longitude(s)
+
+    Returns:
+        (x, y): The grid column(s) and row(s)
+    """
+    x = np.clip(np.floor((lon - index['lon0']) / index['cell_size']), 0, index['nx'] - 1).astype(np.int64)
+    y = np.clip(np.floor((lat - index['lat0']) / index['cell_size']), 0, index['ny'] - 1).astype(np.int64)
+    return x, y
+
+def grid_cell(index, lat, lon):
+    """
+    Description: The cell number of one or many positions (cells are numbered row by row)
+    
+    Args:
+        index (dict): A spatial index from build_spatial_index
+        lat (float or NumPy array): Latitude(s)
+        lon (float or NumPy array): Longitude(s)
+
+    Returns:
+        The cell number(s)
+    """
+    x, y = grid_xy(index, lat, lon)
+    return y * index['nx'] + x
+
+def spatial_bbox(index, south, west, north, east, mask=None):
+    """
+    Description: Finds the points inside a bounding box
+    
+    Args:
+        index (dict): A spatial index from build_spatial_index
+        south, west, north, east (float): The edges of the box in degrees
+        mask (NumPy array)(optional): A boolean array over the store's documents; only documents where it is True are returned
+
+    Returns:
+        (rows, lat, lon): NumPy arrays with the store row and position of each point found
+    """
+    x0, y0 = grid_xy(index, south, west)
+    x1, y1 = grid_xy(index, north, east)
+    starts, nx = index['starts'], index['nx']
+    # The cells x0..x1 of a grid row are stored next to each other
+    spans = [(starts[y * nx + x0], starts[y * nx + x1 + 1]) for y in range(y0, y1 + 1)]
+    rows, lat, lon = [np.concatenate([index[name][a:b] for a, b in spans]) for name in ('rows', 'lat', 'lon')]
+    keep = (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+    if mask is not None:
+        keep &= mask[rows]
+    return rows[keep], lat[keep], lon[keep]
+
+def spatial_radius(index, lat, lon, radius, mask=None):
+    """
+    Description: Finds the points within a distance of a position, closest first
+    
+    Args:
+        index (dict): A spatial index from build_spatial_index
+        lat (float): Latitude of the center
+        lon (float): Longitude of the center
+        radius (float): The distance in meters
+        mask (NumPy array)(optional): A boolean array over the store's documents; only documents where it is True are returned
+
+    Returns:
+        (rows, distances): NumPy arrays with the store row and distance in meters of each point found
+    """
+    angle = radius / EARTH_RADIUS
+    dlat = math.degrees(angle)
+    if math.sin(angle) >= math.cos(math.radians(lat)):
+        dlon = 180.0
+    else:
+        dlon = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(lat))))
+    rows, lats, lons = spatial_bbox(index, lat - dlat, lon - dlon, lat + dlat, lon + dlon, mask)
+    distances = haversine(lat, lon, lats, lons)
+    keep = distances <= radius
+    rows, distances = rows[keep], distances[keep]
+    order = np.argsort(distances, kind='mergesort')
+    return rows[order], distances[order]
+
+def spatial_nearest(index, lat, lon, k, mask=None):
+    """
+    Description: Finds the k points closest to a position
+    
+    Args:
+        index (dict): A spatial index from build_spatial_index
+        lat (float): Latitude of the position
+        lon (float): Longitude of the position
+        k (int): The number of points to find
+        mask (NumPy array)(optional): A boolean array over the store's documents; only documents where it is True are returned
+
+    Returns:
+        (rows, distances): NumPy arrays with the store row and distance in meters of each point found, closest first
+    """
+    south, west = index['lat0'], index['lon0']
+    north, east = south + index['ny'] * index['cell_size'], west + index['nx'] * index['cell_size']
+    reach = max(haversine(lat, lon, corner_lat, corner_lon) for corner_lat in (south, north) for corner_lon in (west, east))
+    radius = index['cell_size'] * math.pi / 180 * EARTH_RADIUS
+    while True:
+        rows, distances = spatial_radius(index, lat, lon, radius, mask)
+        if len(rows) >= k or radius > reach:
+            return rows[:k], distances[:k]
+        radius *= 2
+
+def store_rows(store, rows, fields):
+    """
+    Description: Turns store rows (e.g. from a spatial query) back into documents holding the given fields
+    
+    Args:
+        store (dict): A column store from build_column_store
+        rows (NumPy array): The rows to fetch
+        fields (list of str): The (dotted) fields to include, they must be columns of the store
+
+    Returns:
+        A list of dicts, one per row, with missing fields left out
+    """
+    docs = [{} for row in rows]
+    for field in fields:
+        column = store['columns'][field]
+        for doc, code in zip(docs, column['codes'][rows]):
+            if code >= 0:
+                doc[field] = column['values'][code]
+    return docs
+
+
+# In[ ]:
+
+spatial = build_spatial_index(store)
+downtown = (32.7157, -117.1611)
+fast_food = store_equals(store, 'amenity', 'fast_food')
+
+rows, distances = spatial_radius(spatial, downtown[0], downtown[1], 2000, mask=fast_food)
+print "{} fast food locations within 2 km of downtown".format(len(rows))
+for doc, distance in zip(store_rows(store, rows[:10], ['name', 'cuisine']), distances):
+    print "{:<30}{:<20}{:>8.0f} m".format(doc.get('name'), doc.get('cuisine'), distance)
+
+rows, distances = spatial_nearest(spatial, downtown[0], downtown[1], 5, mask=fast_food & store_equals(store, 'cuisine', 'burgers'))
+print "\nClosest burgers:", [(doc.get('name'), int(distance)) for doc, distance in zip(store_rows(store, rows, ['name']), distances)]
+
+repeat = 1000
+start = time.time()
+for i in range(repeat):
+    spatial_radius(spatial, downtown[0], downtown[1], 2000, mask=fast_food)
+print "\nRadius query: {:.3f} ms".format((time.time() - start) * 1000 / repeat)
+
+
+# Our documents store positions as GeoJSON points and the `pos_2dsphere` index covers them, so Mongo can answer the same proximity questions itself: `$near` returns the documents within a distance of a point, closest first, and `$geoWithin` the documents inside an area. The helpers below add any attribute filters (e.g. `{'amenity': 'fast_food'}`) to the geographic condition so both are resolved in one indexed query, and like the rest of the notebook they also accept a column store, where they run on the grid index above.
+
+# In[ ]:
+
+def geo_point(lat, lon):
+    """
+    Description: Builds a GeoJSON point
+    
+    Args:
+        lat (float): Latitude
+        lon (float): Longitude
+
+    Returns:
+        point (dict): {"type": "Point", "coordinates": [lon, lat]}
+    """
+    return {'type': 'Point', 'coordinates': [lon, lat]}
+
+def near_query(lat, lon, max_distance, query=None):
+    """
+    Description: Builds the filter used by get_near
+    
+    Args:
+        lat (float): Latitude of the center
+        lon (float): Longitude of the center
+        max_distance (float): The distance in meters
+        query (dict)(optional): Attribute filters to add, e.g. {'amenity': 'fast_food'}
+
+    Returns:
+        query (dict): The filter
+    """
+    near = dict(query or {})
+    near['pos'] = {'$near': {'$geometry': geo_point(lat, lon), '$maxDistance': max_distance}}
+    return near
+
+def within_query(south, west, north, east, query=None):
+    """
+    Description: Builds the filter used by get_within
+    
+    Args:
+        south, west, north, east (float): The edges of the box in degrees
+        query (dict)(optional): Attribute filters to add, e.g. {'amenity': 'fast_food'}
+
+    Returns:
+        query (dict): The filter
+    """
+    box = [[west, south], [east, south], [east, north], [west, north], [west, south]]
+    within = dict(query or {})
+    within['pos'] = {'$geoWithin': {'$geometry': {'type': 'Polygon', 'coordinates': [box]}}}
+    return within
+
+def store_query_mask(store, query=None):
+    """
+    Description: Boolean mask of the documents matching a filter of plain {field: value} conditions
+    
+    Args:
+        store (dict): A column store from build_column_store
+        query (dict)(optional): The filter, every field must be a column of the store
+
+    Returns:
+        A boolean NumPy array with one entry per document, None if there is no filter
+    """
+    mask = None
+    for field, value in (query or {}).items():
+        matches = store_equals(store, field, value)
+        mask = matches if mask is None else mask & matches
+    return mask
+
+def store_spatial_index(store):
+    """
+    Description: The grid index of a column store, built the first time it is needed
+    
+    Args:
+        store (dict): A column store from build_column_store
+
+    Returns:
+        index (dict): A spatial index from build_spatial_index
+    """
+    if 'spatial' not in store:
+        store['spatial'] = build_spatial_index(store)
+    return store['spatial']
+
+def get_near(collection, lat, lon, max_distance, query=None, fields=('name',), limit=None):
+    """
+    Description: Convenience function for finding the documents within a distance of a point, closest first
+    
+    Args:
+        collection (str): A string representing the name of the collection in MongoDb you wish to use
+        lat (float): Latitude of the center
+        lon (float): Longitude of the center
+        max_distance (float): The distance in meters
+        query (dict)(optional): Attribute filters, e.g. {'amenity': 'fast_food'}
+        fields (list of str)(optional): The fields to return
+        limit (int)(optional): An optional parameter for limiting the number of results
+
+    Returns:
+        A list of documents holding the requested fields
+    """
+    if is_store(collection):
+        rows, distances = spatial_radius(store_spatial_index(collection), lat, lon, max_distance, store_query_mask(collection, query))
+        return store_rows(collection, rows[:limit], fields)
+    return list(collection.find(near_query(lat, lon, max_distance, query), dict([(field, 1) for field in fields] + [('_id', 0)]), limit=limit or 0))
+
+def get_within(collection, south, west, north, east, query=None, fields=('name',)):
+    """
+    Description: Convenience function for finding the documents inside a bounding box
+    
+    Args:
+        collection (str): A string representing the name of the collection in MongoDb you wish to use
+        south, west, north, east (float): The edges of the box in degrees
+        query (dict)(optional): Attribute filters, e.g. {'amenity': 'fast_food'}
+        fields (list of str)(optional): The fields to return
+
+    Returns:
+        A list of documents holding the requested fields
+    """
+    if is_store(collection):
+        rows, lat, lon = spatial_bbox(store_spatial_index(collection), south, west, north, east, store_query_mask(collection, query))
+        return store_rows(collection, rows, fields)
+    return list(collection.find(within_query(south, west, north, east, query), dict([(field, 1) for field in fields] + [('_id', 0)])))
+
+
+# In[ ]:
+
+for source in (col, store):
+    nearby = get_near(source, downtown[0], downtown[1], 2000, {'amenity': 'fast_food'}, limit=10)
+    print "Closest fast food to downtown:", [doc.get('name') for doc in nearby]
+    print "Fast food in the Gaslamp Quarter:", len(get_within(source, 32.7065, -117.1640, 32.7150, -117.1580, {'amenity': 'fast_food'}))
+
+
+# ## Caching query results
+# 
+# Re-running the report cells repeats the same aggregations against data that has not changed since it was loaded. Every write to the collection (`load_collection` here, `apply_changes` in the cleaning notebook) bumps the collection's version stamp in the `collection_versions` collection, so a result can be cached under its query together with the version it was computed at: as soon as the data changes the stamp moves on and the old results are simply never looked up again. Looking up a cached result costs a single `_id` lookup of the stamp.
+# 
+# Results are kept in memory in least recently used order (`max_entries` of them), and optionally pickled to a directory as well, so a restarted notebook does not have to run its queries again. The cached lists are shared between calls, so treat the documents in them as read only.
+
+# In[ ]:
+
+import cPickle
+import glob
+import hashlib
+from collections import OrderedDict
+
+QUERY_CACHE = {'entries': OrderedDict(), 'max_entries': 256, 'directory': None, 'hits': 0, 'disk_hits': 0, 'misses': 0}
+
+def configure_query_cache(max_entries=256, directory=None):
+    """
+    Description: Sets the size of the in-memory cache and the directory of the on-disk tier (None to keep results in memory only)
+    
+    Args:
+        max_entries (int)(optional): The number of results kept in memory
+        directory (str)(optional): The directory results are also pickled to
+
+    Returns:
+        None
+    """
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    QUERY_CACHE.update(max_entries=max_entries, directory=directory)
+    while len(QUERY_CACHE['entries']) > max_entries:
+        QUERY_CACHE['entries'].popitem(last=False)
+
+def clear_query_cache(disk=False):
+    """
+    Description: Empties the in-memory cache, and optionally the on-disk tier
+    
+    Args:
+        disk (bool)(optional): Also remove the pickled results
+
+    Returns:
+        None
+    """
+    QUERY_CACHE['entries'].clear()
+    if disk and QUERY_CACHE['directory']:
+        for path in glob.glob(os.path.join(QUERY_CACHE['directory'], '*.pickle')):
+            os.remove(path)
+
+def query_cache_stats():
+    """
+    Description: Reports how often cached results were used
+    
+    Returns:
+        stats (dict): hits (from memory), disk_hits, misses, hit_rate and the number of entries in memory
+    """
+    lookups = QUERY_CACHE['hits'] + QUERY_CACHE['disk_hits'] + QUERY_CACHE['misses']
+    return {'hits': QUERY_CACHE['hits'], 'disk_hits': QUERY_CACHE['disk_hits'], 'misses': QUERY_CACHE['misses'],
+            'hit_rate': (QUERY_CACHE['hits'] + QUERY_CACHE['disk_hits']) / float(lookups) if lookups else 0.0,
+            'entries': len(QUERY_CACHE['entries'])}
+
+def cached_query(collection, query, compute):
+    """
+    Description: Returns the cached result of a query on a collection, computing (and caching) it if the collection changed since
+    
+    Args:
+        collection (Collection): The MongoDb collection the query reads
+        query: A JSON serializable description of the query, e.g. ['aggregate', pipeline]
+        compute (function): Called without arguments to run the query; its result must be picklable
+
+    Returns:
+        The query result
+    """
+    scope = hashlib.sha1(json.dumps([collection.database.name, collection.name])).hexdigest()[:16]
+    query_hash = hashlib.sha1(json.dumps(query, sort_keys=True, default=repr)).hexdigest()
+    key = '{}-{}-{}'.format(scope, collection_version(collection), query_hash)
+    entries = QUERY_CACHE['entries']
+    if key in entries:
+        QUERY_CACHE['hits'] += 1
+        result = entries.pop(key)
+        entries[key] = result
+        return result
+
+    path = os.path.join(QUERY_CACHE['directory'], key + '.pickle') if QUERY_CACHE['directory'] else None
+    if path and os.path.exists(path):
+        QUERY_CACHE['disk_hits'] += 1
+        with open(path, 'rb') as fp:
+            result = cPickle.load(fp)
+    else:
+        QUERY_CACHE['misses'] += 1
+        result = compute()
+        if path:
+            # Results of older versions of this collection can never be looked up again
+            for old in glob.glob(os.path.join(QUERY_CACHE['directory'], scope + '-*.pickle')):
+                if not os.path.basename(old).startswith(key.rsplit('-', 1)[0] + '-'):
+                    os.remove(old)
+            with open(path + '.tmp', 'wb') as fp:
+                cPickle.dump(result, fp, cPickle.HIGHEST_PROTOCOL)
+            os.rename(path + '.tmp', path)
+    entries[key] = result
+    if len(entries) > QUERY_CACHE['max_entries']:
+        entries.popitem(last=False)
+    return result
+
+def cached_aggregate(collection, pipeline):
+    """
+    Description: Cached version of collection.aggregate
+    
+    Args:
+        collection (Collection): The MongoDb collection to aggregate
+        pipeline (list): The aggregation pipeline
+
+    Returns:
+        The results as a list
+    """
+    return cached_query(collection, ['aggregate', pipeline], lambda: list(collection.aggregate(pipeline, allowDiskUse=True)))
+
+def cached_distinct(collection, field):
+    """
+    Description: Cached version of collection.distinct
+    
+    Args:
+        collection (Collection): The MongoDb collection
+        field (str): The field to get the distinct values of
+
+    Returns:
+        The distinct values as a list
+    """
+    return cached_query(collection, ['distinct', field], lambda: collection.distinct(field))
+
+
+# In[ ]:
+
+configure_query_cache(max_entries=256, directory='sd_query_cache')
+
+
+# ## Report summaries
+# 
+# The reports below run the same few `$group`/`$sort` pipelines over and over (`fast_food_by_type` once per cuisine, the contributor counts several times), and each run scans every matching document. All of them can be answered from three small "cubes" of counts instead:
+# 
+#  - `amenity_name`: the number of documents for every (amenity, name) pair
+#  - `amenity_cuisine_name`: the same per (amenity, cuisine, name), with lists of cuisines unwound; `count` counts list items like `$unwind` does and `docs` counts documents like a `$match` on the cuisine does
+#  - `user_type`: the number of documents for every (created.user, type) pair
+# 
+# `build_summaries` computes all three in a single pass (over the collection, or straight over the data file at load time) and stores them in the `<collection>_<cube>` collections, one document per cell with the cell's key as its `_id`. When `apply_changes` (in the cleaning notebook) updates the collection it journals the report fields of every document before and after the change; `refresh_summaries` turns those journal entries into `$inc` updates of the affected cells, so the summaries never need a full rebuild. The report helpers accept `open_summaries(col)` in place of a collection; they refresh from the journal first and then read the summaries.
+# 
+# Every cell remembers the last journal entry it includes (`journal`), and a refresh only adds the entries newer than that, so a refresh that failed halfway (after updating some cells but before clearing the journal) can simply be run again. Cells whose count drops to zero are kept, so they keep that mark; the report helpers skip them. `build_summaries` clears the journal and then reads the whole collection, so it must not run while `apply_changes` is updating the collection: a change journaled during the scan would be counted twice.
+
+# In[ ]:
+
+from bson.son import SON
+from pymongo import UpdateOne
+
+SUMMARY_CUBES = {
+    'amenity_name': {'key': [('amenity', 'amenity'), ('name', 'name')], 'required': ['amenity', 'name'], 'unwind': None},
+    'amenity_cuisine_name': {'key': [('amenity', 'amenity'), ('cuisine', 'cuisine'), ('name', 'name')], 'required': ['amenity', 'cuisine'], 'unwind': 'cuisine'},
+    'user_type': {'key': [('user', 'created.user'), ('type', 'type')], 'required': [], 'unwind': None},
+}
+SUMMARY_FIELDS = {'created.user': 'user', 'type': 'type'} # Fields get_field_counts/get_unique_count can read from the user_type cube
+
+def cube_rows(cube, doc):
+    """
+    Description: Works out which cells of a cube a document counts towards (mirroring $match, $unwind and $group)
+    
+    Args:
+        cube (dict): One of SUMMARY_CUBES
+        doc (dict): The document, or None
+
+    Returns:
+        rows (list): (key, count, docs) for each cell, where key is the cell's _id (a SON, missing fields left out like $group does)
+    """
+    if doc is None or any(get_path(doc, field) is MISSING for field in cube['required']):
+        return []
+    values = dict((path, get_path(doc, path)) for name, path in cube['key'])
+    items = [None]
+    if cube['unwind']:
+        items = values[cube['unwind']]
+        if items is None:
+            return []
+        if not isinstance(items, list):
+            items = [items]
+    cells = {}
+    for item in items:
+        if cube['unwind']:
+            values[cube['unwind']] = item
+        key = SON((name, values[path]) for name, path in cube['key'] if values[path] is not MISSING)
+        cells.setdefault(value_key(dict(key)), [key, 0])[1] += 1
+    return [(key, count, 1) for key, count in cells.values()]
+
+def add_cube_rows(totals, cube, doc, sign=1):
+    """
+    Description: Adds (or with sign=-1 removes) a document's cells to running cube totals
+    
+    Args:
+        totals (dict): value_key of the cell -> [key, count, docs]
+        cube (dict): One of SUMMARY_CUBES
+        doc (dict): The document, or None
+        sign (int)(optional): 1 to add the document, -1 to remove it
+
+    Returns:
+        None
+    """
+    for key, count, docs in cube_rows(cube, doc):
+        total = totals.setdefault(value_key(dict(key)), [key, 0, 0])
+        total[1] += sign * count
+        total[2] += sign * docs
+
+def summary_collection(collection, cube_name):
+    """
+    Description: The collection a cube is stored in
+    
+    Args:
+        collection (str): A string representing the name of the collection in MongoDb you wish to use
+        cube_name (str): A key of SUMMARY_CUBES
+
+    Returns:
+        The summary collection
+    """
+    return collection.database['{}_{}'.format(collection.name, cube_name)]
+
+def journal_collection(collection):
+    """
+    Description: The collection apply_changes journals its changes in
+    
+    Args:
+        collection (str): A string representing the name of the collection in MongoDb you wish to use
+
+    Returns:
+        The journal collection
+    """
+    return collection.database[collection.name + '_journal']
+
+def build_summaries(collection, docs=None, batch_size=1000):
+    """
+    Description: Computes every cube in one pass and replaces the summary collections with them; must not run while apply_changes is
+        updating the collection (changes journaled during the scan would be counted again by the next refresh)
+    
+    Args:
+        collection (str): A string representing the name of the collection in MongoDb you wish to use
+        docs (iterable)(optional): The documents to summarize, e.g. iter_documents('sd.ndjson.gz') right after loading;
+            defaults to reading the report fields of every document in the collection
+        batch_size (int)(optional): The number of cells inserted per round trip
+
+    Returns:
+        sizes (dict): The number of cells in each cube
+    """
+    # A full build already includes every journaled change
+    journal_collection(collection).delete_many({})
+    if docs is None:
+        docs = collection.find({}, dict((field, 1) for field in STORE_FIELDS))
+    totals = dict((name, {}) for name in SUMMARY_CUBES)
+    for doc in docs:
+        for name, cube in SUMMARY_CUBES.items():
+            add_cube_rows(totals[name], cube, doc)
+    for name in SUMMARY_CUBES:
+        summary = summary_collection(collection, name)
+        summary.drop()
+        cells = ({'_id': key, 'count': count, 'docs': doc_count} for key, count, doc_count in totals[name].values())
+        for batch in iter_batches(cells, batch_size):
+            summary.insert_many(batch)
+    # Results read from the old summaries must not be served from the query cache
+    bump_collection_version(collection)
+    return dict((name, len(totals[name])) for name in SUMMARY_CUBES)
+
+def refresh_summaries(collection):
+    """
+    Description: Applies the changes journaled by apply_changes to the summary collections. Each cell records the last journal entry
+        applied to it and only takes newer ones, so running it again after a failure does not count anything twice
+    
+    Args:
+        collection (str): A string representing the name of the collection in MongoDb you wish to use
+
+    Returns:
+        The number of journal entries applied
+    """
+    journal = journal_collection(collection)
+    entries = list(journal.find().sort('_id', ASCENDING))
+    if not entries:
+        return 0
+    last = entries[-1]['_id']
+    for name, cube in SUMMARY_CUBES.items():
+        summary = summary_collection(collection, name)
+        changes = []
+        keys = {}
+        for entry in entries:
+            rows = {}
+            add_cube_rows(rows, cube, entry['before'], -1)
+            add_cube_rows(rows, cube, entry['after'])
+            changes.append((entry['_id'], rows))
+            for cell, (key, count, docs) in rows.items():
+                keys[cell] = key
+        if not keys:
+            continue
+        applied = dict((value_key(dict(doc['_id'])), doc.get('journal'))
+                       for doc in summary.find({'_id': {'$in': list(keys.values())}}, {'journal': 1}))
+        totals = {}
+        for entry_id, rows in changes:
+            for cell, (key, count, docs) in rows.items():
+                if applied.get(cell) is not None and entry_id <= applied[cell]:
+                    continue
+                total = totals.setdefault(cell, [key, 0, 0])
+                total[1] += count
+                total[2] += docs
+        requests = [UpdateOne({'_id': key}, {'$inc': {'count': count, 'docs': docs}, '$set': {'journal': last}}, upsert=True)
+                    for key, count, docs in totals.values() if count or docs]
+        if requests:
+            summary.bulk_write(requests, ordered=False)
+    journal.delete_many({'_id': {'$lte': last}})
+    return len(entries)
+
+def open_summaries(collection):
+    """
+    Description: Wraps a collection so the report helpers read its summaries instead
+    
+    Args:
+        collection (str): A string representing the name of the collection in MongoDb you wish to use
+
+    Returns:
+        summaries (dict): Pass this to get_field_counts, get_unique_count, get_fast_food, get_fast_food_cuisine_counts or fast_food_by_type
+    """
+    return {'summaries': collection}
+
+def is_summaries(collection):
+    """
+    Description: Tells the result of open_summaries apart from a Mongo collection or a column store
+    
+    Args:
+        collection: A MongoDb collection, a column store or the result of open_summaries
+
+    Returns:
+        True if collection came from open_summaries
+    """
+    return isinstance(collection, dict) and 'summaries' in collection
+
+def summary_cube(summaries, cube_name):
+    """
+    Description: The up to date summary collection of a cube (journaled changes are applied first)
+    
+    Args:
+        summaries (dict): The result of open_summaries
+        cube_name (str): A key of SUMMARY_CUBES
+
+    Returns:
+        The summary collection
+    """
+    refresh_summaries(summaries['summaries'])
+    return summary_collection(summaries['summaries'], cube_name)
+
+def summary_aggregate(summaries, cube_name, pipeline):
+    """
+    Description: Runs a pipeline on the non-empty cells of an up to date cube; the result is cached under the version stamp of the summarized collection
+    
+    Args:
+        summaries (dict): The result of open_summaries
+        cube_name (str): A key of SUMMARY_CUBES
+        pipeline (list): The aggregation pipeline
+
+    Returns:
+        The results as a list
+    """
+    return cached_query(summaries['summaries'], ['summary', cube_name, pipeline],
+                        lambda: list(summary_cube(summaries, cube_name).aggregate([{"$match": {"count": {"$gt": 0}}}] + pipeline)))
+
+def summary_field_counts(summaries, field_name, limit=None):
+    """
+    Description: Summary version of get_field_counts; fields without a cube are counted on the collection
+    
+    Args:
+        summaries (dict): The result of open_summaries
+        field_name (str): The column you wish to gather the unique values from
+        limit (int)(optional): An optional parameter for limiting the number of results
+
+    Returns:
+        The query results with columns _id, count
+    """
+    if field_name not in SUMMARY_FIELDS:
+        return cached_aggregate(summaries['summaries'], field_counts_query(field_name, limit))
+    key = '_id.' + SUMMARY_FIELDS[field_name]
+    query = [{"$match": {key: {"$exists": True}}}, {"$group": {"_id": "$" + key, "count": {"$sum": "$count"}}}, {"$sort": {"count": -1}}]
+    if limit:
+        query.append({"$limit": limit})
+    return summary_aggregate(summaries, 'user_type', query)
+
+def summary_unique_count(summaries, field_name):
+    """
+    Description: Summary version of get_unique_count; fields without a cube are counted on the collection
+    
+    Args:
+        summaries (dict): The result of open_summaries
+        field_name (str): The column you wish to count the unique values of
+
+    Returns:
+        The number of unique values
+    """
+    if field_name not in SUMMARY_FIELDS:
+        return len(cached_distinct(summaries['summaries'], field_name))
+    key = '_id.' + SUMMARY_FIELDS[field_name]
+    # Cells of documents without the field have no such key; they are not a value of their own
+    query = [{"$match": {key: {"$exists": True}}}, {"$group": {"_id": "$" + key}}]
+    return len(summary_aggregate(summaries, 'user_type', query))
+
+def summary_fast_food(summaries, limit=None):
+    """
+    Description: Summary version of get_fast_food
+    
+    Args:
+        summaries (dict): The result of open_summaries
+        limit (int)(optional): An optional parameter for limiting the number of results
+
+    Returns:
+        A list of dicts with keys _id and count, most frequent first
+    """
+    query = [{"$match": {"_id.amenity": "fast_food"}}, {"$project": {"_id": "$_id.name", "count": 1}}, {"$sort": {"count": -1}}]
+    if limit:
+        query.append({"$limit": limit})
+    return summary_aggregate(summaries, 'amenity_name', query)
+
+def summary_fast_food_cuisine_counts(summaries, limit=None):
+    """
+    Description: Summary version of get_fast_food_cuisine_counts
+    
+    Args:
+        summaries (dict): The result of open_summaries
+        limit (int)(optional): An optional parameter for limiting the number of results
+
+    Returns:
+        The query results with columns _id, count
+    """
+    query = [{"$match": {"_id.amenity": "fast_food"}}, {"$group": {"_id": "$_id.cuisine", "count": {"$sum": "$count"}}}, {"$sort": {"count": -1}}]
+    if limit:
+        query.append({"$limit": limit})
+    return summary_aggregate(summaries, 'amenity_cuisine_name', query)
+
+def summary_fast_food_by_type(summaries, cuisine_type):
+    """
+    Description: Summary version of fast_food_by_type
+    
+    Args:
+        summaries (dict): The result of open_summaries
+        cuisine_type (str): The cuisine to count franchises for
+
+    Returns:
+        The query results with columns _id, count
+    """
+    query = [{"$match": {"_id.amenity": "fast_food", "_id.cuisine": cuisine_type, "_id.name": {"$exists": True}}},
+             {"$group": {"_id": "$_id.name", "count": {"$sum": "$docs"}}}, {"$sort": {"count": -1}}]
+    return summary_aggregate(summaries, 'amenity_cuisine_name', query)
 
-# In[204]:
 
-with open('sd.json') as data_file:    
-    data = json.load(data_file) 
+# In[ ]:
 
-col.insert_many(data)
+print build_summaries(col)
+report = open_summaries(col)
 
 
 # Let's test to make sure we have some data by running a simple query.
@@ -113,12 +1517,16 @@ def get_unique_count(collection, user_column):
     Returns:
         The length of the results from the distinct query; i.e. the number of unique values in a column
     """
-    return len(collection.distinct(user_column))
+    if is_store(collection):
+        return store_unique_count(collection, user_column)
+    if is_summaries(collection):
+        return summary_unique_count(collection, user_column)
+    return len(cached_distinct(collection, user_column))
 
 
 # In[209]:
 
-print "{} distinct users!".format(get_unique_count(col, "created.user"))
+print "{} distinct users!".format(get_unique_count(report, "created.user"))
 
 
 # Looks like we have just under 1,000 unique contributors.
@@ -129,28 +1537,45 @@ print "{} distinct users!".format(get_unique_count(col, "created.user"))
 
 # In[210]:
 
-def get_field_counts(collection, field_name, limit=None):
+def field_counts_query(field_name, limit=None):
     """
-    Description: Convenience function for querying for the unique values and frequencies in a collection
+    Description: Builds the aggregation pipeline used by get_field_counts
     
     Args:
-        collection (str): A string representing the name of the collection in MongoDb you wish to use
         field_name (str): The column you wish to gather the unique values from
         limit (int)(optional): An optional parameter for limiting the number of results
 
     Returns:
-        The query results with columns _id, count where _id is the unique value and count is the number of occurances that value has in the collection
+        query (list): The aggregation pipeline
     """
     if limit:
         query = [{"$match": {"{}".format(field_name): {"$exists" : True}}},                      {"$group": {"_id": "${}".format(field_name), "count":{"$sum": 1}}},                      {"$sort": {"count": -1}},                      {"$limit": limit}]
     else:
         query = [{"$match": {"{}".format(field_name): {"$exists" : True}}},                      {"$group": {"_id": "${}".format(field_name), "count":{"$sum": 1}}},                      {"$sort": {"count": -1}}]
-    return collection.aggregate(query)
+    return query
+
+def get_field_counts(collection, field_name, limit=None):
+    """
+    Description: Convenience function for querying for the unique values and frequencies in a collection
+    
+    Args:
+        collection (str): A string representing the name of the collection in MongoDb you wish to use
+        field_name (str): The column you wish to gather the unique values from
+        limit (int)(optional): An optional parameter for limiting the number of results
+
+    Returns:
+        The query results with columns _id, count where _id is the unique value and count is the number of occurances that value has in the collection
+    """
+    if is_store(collection):
+        return store_field_counts(collection, field_name, limit)
+    if is_summaries(collection):
+        return summary_field_counts(collection, field_name, limit)
+    return cached_aggregate(collection, field_counts_query(field_name, limit))
 
 
 # In[211]:
 
-top_contributors = get_field_counts(col, 'created.user', 10)
+top_contributors = get_field_counts(report, 'created.user', 10)
 proportion_from_top_ten = 0 
 
 for contributor in top_contributors:
@@ -183,7 +1608,7 @@ def draw_pie(data, color_list, labels):
 
 # In[213]:
 
-contributors_by_rank = list(get_field_counts(col, 'created.user'))
+contributors_by_rank = list(get_field_counts(report, 'created.user'))
 contributors_by_rank = [x['count'] for x in contributors_by_rank]
 
 proportion_from_top_ten = sum(contributors_by_rank[:10])
@@ -234,33 +1659,153 @@ def draw_stacked_bar(ind, bar1_data, bar2_data, x_y_labels, legend_tuple, labels
     plt.show()
 
 
-# In[216]:
+# Getting the node and way counts of the top ten used to take three queries (the top ten, then their nodes, then their ways), with the two lists sorted by name and assumed to line up. `contributor_stats` returns everything in one aggregation instead: it groups the documents by user once, counting the total, nodes and ways together, then sorts those groups and collects them into one result per period with the number of entries (for each user's proportion) and the top users. With `per='month'` or `per='changeset'` the groups also carry the month or changeset, and it returns the top users of each one, still in a single query but as one small result document per period (so a large map cannot push a single result past MongoDB's 16 MB document limit). A changeset is always uploaded by one user, so per changeset there is just that user, with the changeset's node/way breakdown. It also accepts the report summaries (without `per`) and a column store, which does the same counting with `bincount`.
+
+# In[ ]:
+
+CONTRIBUTOR_PERIODS = {'month': {'$substr': ['$created.timestamp', 0, 7]}, 'changeset': '$created.changeset'}
+
+def contributor_query(limit=10, per=None, user='$created.user', kind='$type', weight=1):
+    """
+    Description: Builds the aggregation pipeline used by contributor_stats
+    
+    Args:
+        limit (int)(optional): The number of users to return (per period)
+        per (str)(optional): None, 'month' or 'changeset' (see CONTRIBUTOR_PERIODS); a changeset has a single user,
+            so per changeset the "top" user is simply the one who uploaded it
+        user (str)(optional): The field holding the user name
+        kind (str)(optional): The field holding the type (node or way)
+        weight (optional): What each document counts for, e.g. '$count' when aggregating the user_type summary
+
+    Returns:
+        query (list): The aggregation pipeline; it returns one document per period (_id) with 'entries' (the number of
+            entries, including those without a user) and 'users' (the top users with their total, nodes and ways)
+    """
+    period = CONTRIBUTOR_PERIODS[per] if per else None
+    counts = {"total": {"$sum": weight},
+              "nodes": {"$sum": {"$cond": [{"$eq": [kind, "node"]}, weight, 0]}},
+              "ways": {"$sum": {"$cond": [{"$eq": [kind, "way"]}, weight, 0]}}}
+    groups = dict(counts, _id={"period": period, "user": user})
+    ranked = {"$filter": {"input": "$users", "as": "row", "cond": {"$gt": ["$$row.user", None]}}}
+    query = [{"$group": groups},
+             {"$sort": SON([("_id.period", 1), ("total", -1), ("_id.user", 1)])},
+             {"$group": {"_id": "$_id.period", "entries": {"$sum": "$total"},
+                         "users": {"$push": {"user": "$_id.user", "total": "$total", "nodes": "$nodes", "ways": "$ways"}}}},
+             {"$project": {"entries": 1, "users": {"$slice": [ranked, limit]}}},
+             {"$sort": {"_id": 1}}]
+    return query
+
+def contributor_rows(groups, totals, per=None):
+    """
+    Description: Turns ranked users per period into the rows contributor_stats returns
+    
+    Args:
+        groups (list): (period, users) pairs, users being dicts with user, total, nodes and ways in rank order
+        totals (dict): period -> the number of entries
+        per (str)(optional): The name of the period, added to each row
 
-# Get list of top 10 ranked contributors for match in query
-top_ten_usernames = list(get_field_counts(col, 'created.user', limit=10))
-top_ten_usernames = [user['_id'] for user in top_ten_usernames]
+    Returns:
+        rows (list of dict): rank, user, total, nodes, ways and proportion (and the period), ordered by period then rank
+    """
+    rows = []
+    for period, users in sorted(groups, key=lambda group: group[0]):
+        for rank, user in enumerate(users, 1):
+            row = {'rank': rank, 'user': user['user'], 'total': user['total'], 'nodes': user['nodes'], 'ways': user['ways'],
+                   'proportion': user['total'] / float(totals[period])}
+            if per:
+                row[per] = period
+            rows.append(row)
+    return rows
+
+def store_contributor_stats(store, limit=10, per=None):
+    """
+    Description: Column store version of contributor_stats
+    
+    Args:
+        store (dict): A column store from build_column_store; for per='month' it needs a 'created.timestamp' column
+            and for per='changeset' a 'created.changeset' column
+        limit (int)(optional): The number of users to return (per period)
+        per (str)(optional): None, 'month' or 'changeset'
 
-# Create queries for counting each user's individual node/way contributions
-node_query = [{"$match": {"type": "node", "created.user":{"$in": top_ten_usernames}}},         {"$group": {"_id": "$created.user", "count": {"$sum": 1}}}]
+    Returns:
+        rows (list of dict): See contributor_stats
+    """
+    users = store['columns']['created.user']
+    kinds = store['columns']['type']
+    if per:
+        field = 'created.timestamp' if per == 'month' else 'created.changeset'
+        if field not in store['columns']:
+            raise ValueError("Build the column store with a '{}' column to count per {}".format(field, per))
+        column = store['columns'][field]
+        periods, index, lookup = [], {}, []
+        for value in column['values'] + [None]:
+            name = value[:7] if per == 'month' and isinstance(value, basestring) else value
+            if value_key(name) not in index:
+                index[value_key(name)] = len(periods)
+                periods.append(name)
+            lookup.append(index[value_key(name)])
+        codes = np.array(lookup, dtype=np.int64)[column['codes']] # code -1 (missing) picks the trailing None
+    else:
+        periods, codes = [None], np.zeros(store['size'], dtype=np.int64)
+
+    n_users = len(users['values'])
+    totals = np.bincount(codes, minlength=len(periods))
+    has_user = users['codes'] >= 0
+    cells = codes[has_user] * n_users + users['codes'][has_user]
+    size = len(periods) * n_users
+    node_code, way_code = kinds['index'].get('node', -2), kinds['index'].get('way', -2)
+    total = np.bincount(cells, minlength=size).reshape(len(periods), n_users)
+    nodes = np.bincount(cells, weights=kinds['codes'][has_user] == node_code, minlength=size).reshape(len(periods), n_users)
+    ways = np.bincount(cells, weights=kinds['codes'][has_user] == way_code, minlength=size).reshape(len(periods), n_users)
+
+    # Ties are broken by user name, like the Mongo pipeline
+    name_rank = np.empty(n_users, dtype=np.int64)
+    name_rank[sorted(range(n_users), key=lambda code: users['values'][code])] = np.arange(n_users)
+    groups = []
+    for p in np.nonzero(total.sum(axis=1))[0]:
+        order = np.lexsort((name_rank, -total[p]))
+        order = order[total[p][order] > 0][:limit]
+        groups.append((periods[p], [{'user': users['values'][u], 'total': int(total[p, u]), 'nodes': int(nodes[p, u]), 'ways': int(ways[p, u])}
+                                    for u in order]))
+    return contributor_rows(groups, dict((periods[p], int(totals[p])) for p in range(len(periods))), per)
+
+def contributor_stats(collection, limit=10, per=None):
+    """
+    Description: Convenience function for ranking the top contributors with their node/way breakdown in a single query
+    
+    Args:
+        collection (str): A string representing the name of the collection in MongoDb you wish to use
+        limit (int)(optional): The number of users to return (per period)
+        per (str)(optional): None for the whole map, or 'month' or 'changeset' to rank the users of each month or changeset
 
-way_query = [{"$match": {"type": "way", "created.user":{"$in": top_ten_usernames}}},         {"$group": {"_id": "$created.user", "count": {"$sum": 1}}}]
+    Returns:
+        rows (list of dict): rank, user, total, nodes, ways and proportion (of all entries, or of the period's entries),
+            plus the month or changeset when per is given; ordered by period then rank
+    """
+    if is_store(collection):
+        return store_contributor_stats(collection, limit, per)
+    if is_summaries(collection) and not per:
+        result = summary_aggregate(collection, 'user_type', contributor_query(limit, None, '$_id.user', '$_id.type', '$count'))
+    else:
+        if is_summaries(collection):
+            collection = collection['summaries']
+        result = cached_aggregate(collection, contributor_query(limit, per))
+    totals = dict((group['_id'], group['entries']) for group in result)
+    return contributor_rows([(group['_id'], group['users']) for group in result], totals, per)
 
-ind = range(0,10)
 
-# Query and sort our results so that each user's bar has their node and way contributions adjacent
-node_contributions = list(col.aggregate(node_query))
-node_contributions = sorted(node_contributions, key=lambda k:k['_id'])
+# In[216]:
 
-way_contributions = list(col.aggregate(way_query))
-way_contributions = sorted(way_contributions, key=lambda k:k['_id'])
+top_ten = contributor_stats(report, 10)
 
+ind = range(0, len(top_ten))
 x_y_labels = ["Number of Contributions", "Username"]
 legend_tuple = ("Node", "Way")
 
 
 # In[217]:
 
-draw_stacked_bar(ind,                 [node['count'] for node in node_contributions],                 [way['count'] for way in way_contributions],                 x_y_labels, legend_tuple,                 [node['_id'] for node in node_contributions])
+draw_stacked_bar(ind, [row['nodes'] for row in top_ten], [row['ways'] for row in top_ten], x_y_labels, legend_tuple, [row['user'] for row in top_ten])
 
 
 # As you can see above, our top contributor, 'n76' doubled the contributions of our second place contributor but was not the highest contributor of 'ways'! 
@@ -273,29 +1818,45 @@ draw_stacked_bar(ind,                 [node['count'] for node in node_contributi
 
 # In[152]:
 
-def get_fast_food(collection, limit=None):
+def fast_food_query(limit=None):
     """
-    Description: Convenience function for querying for the most frequently occuring fast food chains
+    Description: Builds the aggregation pipeline used by get_fast_food
     
     Args:
-        collection (str): A string representing the name of the collection in MongoDb you wish to use
         limit (int)(optional): An optional parameter for limiting the number of results
 
     Returns:
-        The query results with columns _id, count where _id is the unique value and count is the number of occurances that value has in the collection
+        query (list): The aggregation pipeline
     """
     if not limit:
         query = [{"$match": {"amenity": 'fast_food', "name":{"$exists": True}}},                {"$group": {"_id": "$name", "count": {"$sum": 1}}},                {"$sort": {"count":-1}}]
     else:
         query = [{"$match": {"amenity": 'fast_food', "name":{"$exists": True}}},                {"$group": {"_id": "$name", "count": {"$sum": 1}}},                {"$sort": {"count":-1}},                {"$limit": limit}]
-    return collection.aggregate(query)
+    return query
+
+def get_fast_food(collection, limit=None):
+    """
+    Description: Convenience function for querying for the most frequently occuring fast food chains
+    
+    Args:
+        collection (str): A string representing the name of the collection in MongoDb you wish to use
+        limit (int)(optional): An optional parameter for limiting the number of results
+
+    Returns:
+        The query results with columns _id, count where _id is the unique value and count is the number of occurances that value has in the collection
+    """
+    if is_store(collection):
+        return store_fast_food(collection, limit)
+    if is_summaries(collection):
+        return summary_fast_food(collection, limit)
+    return cached_aggregate(collection, fast_food_query(limit))
 
 
 # To get the most commonly occuring fast food franchise, queried for entries with fast_food as the amenity, grouped those that had a name field, added their counts, sorted descending, and limited results to the top 15.
 
 # In[218]:
 
-results = list(get_fast_food(col, 15))
+results = list(get_fast_food(report, 15))
 
 ind = range(0, len(results))
 data = [ff['count'] for ff in results]
@@ -310,29 +1871,45 @@ draw_bar(ind, data, label, x_label, y_label)
 
 # In[219]:
 
-def get_fast_food_cuisine_counts(collection, limit=None):
+def fast_food_cuisine_query(limit=None):
     """
-    Description: Convenience function for querying for the most frequently occuring fast food cuisine types
+    Description: Builds the aggregation pipeline used by get_fast_food_cuisine_counts
     
     Args:
-        collection (str): A string representing the name of the collection in MongoDb you wish to use
         limit (int)(optional): An optional parameter for limiting the number of results
 
     Returns:
-        The query results with columns _id, count where _id is the unique value and count is the number of occurances that value has in the collection
+        query (list): The aggregation pipeline
     """
     if limit:
         query = [                {"$match": {"amenity": "fast_food", "cuisine": {"$exists": True}}},                {"$unwind": "$cuisine"},                {"$group": {"_id": "$cuisine", "count": {"$sum": 1}}},                {"$sort": {"count": -1}},                {"$limit": limit}]
     else:
         query = [            {"$match": {"amenity": "fast_food", "cuisine": {"$exists": True}}},            {"$unwind": "$cuisine"},            {"$group": {"_id": "$cuisine", "count": {"$sum": 1}}},            {"$sort": {"count": -1}}]
-    return collection.aggregate(query)
+    return query
+
+def get_fast_food_cuisine_counts(collection, limit=None):
+    """
+    Description: Convenience function for querying for the most frequently occuring fast food cuisine types
+    
+    Args:
+        collection (str): A string representing the name of the collection in MongoDb you wish to use
+        limit (int)(optional): An optional parameter for limiting the number of results
+
+    Returns:
+        The query results with columns _id, count where _id is the unique value and count is the number of occurances that value has in the collection
+    """
+    if is_store(collection):
+        return store_fast_food_cuisine_counts(collection, limit)
+    if is_summaries(collection):
+        return summary_fast_food_cuisine_counts(collection, limit)
+    return cached_aggregate(collection, fast_food_cuisine_query(limit))
 
 
 # Now that we know that 3 out of the top 5 most common fast food locations are burger joints, let's see if we can't visualize the type of fast food across San Diego.
 
 # In[220]:
 
-results = list(get_fast_food_cuisine_counts(col, 5))
+results = list(get_fast_food_cuisine_counts(report, 5))
 
 data = [c['count'] for c in results]
 label = [c['_id'] for c in results]
@@ -346,6 +1923,19 @@ draw_pie(data=data,color_list=['c','b', 'y', 'm', 'g'], labels=label)
 
 # In[9]:
 
+def fast_food_by_type_query(cuisine_type):
+    """
+    Description: Builds the aggregation pipeline used by fast_food_by_type
+    
+    Args:
+        cuisine_type (str): The cuisine to count franchises for
+
+    Returns:
+        query (list): The aggregation pipeline
+    """
+    query = [{"$match" : {        "name": {"$exists": True},        "cuisine": {"$exists": True}, "cuisine": "{}".format(cuisine_type),        "amenity": {"$exists": True}, "amenity": "fast_food"}},    {"$group": {"_id": "$name", "count": {"$sum": 1}}},    {"$sort": {"count": -1}}]
+    return query
+
 def fast_food_by_type(collection, cuisine_type):
     """
     Description: Convenience function for querying for the most frequently occuring fast food chains by cuisine type
@@ -357,17 +1947,20 @@ def fast_food_by_type(collection, cuisine_type):
     Returns:
         The query results with columns _id, count where _id is the unique value and count is the number of occurances that value has in the collection
     """
-    query = [{"$match" : {        "name": {"$exists": True},        "cuisine": {"$exists": True}, "cuisine": "{}".format(cuisine_type),        "amenity": {"$exists": True}, "amenity": "fast_food"}},    {"$group": {"_id": "$name", "count": {"$sum": 1}}},    {"$sort": {"count": -1}}]
-    return collection.aggregate(query)
+    if is_store(collection):
+        return store_fast_food_by_type(collection, cuisine_type)
+    if is_summaries(collection):
+        return summary_fast_food_by_type(collection, cuisine_type)
+    return cached_aggregate(collection, fast_food_by_type_query(cuisine_type))
 
 
 # In[10]:
 
-burger_data = list(fast_food_by_type(col, 'burgers'))
-sandwich_data = list(fast_food_by_type(col, 'sandwich'))
-mexican_data = list(fast_food_by_type(col, 'mexican'))
-pizza_data = list(fast_food_by_type(col, 'pizza'))
-chicken_data = list(fast_food_by_type(col, 'chicken'))
+burger_data = list(fast_food_by_type(report, 'burgers'))
+sandwich_data = list(fast_food_by_type(report, 'sandwich'))
+mexican_data = list(fast_food_by_type(report, 'mexican'))
+pizza_data = list(fast_food_by_type(report, 'pizza'))
+chicken_data = list(fast_food_by_type(report, 'chicken'))
 
 
 # In[11]:
@@ -429,3 +2022,76 @@ draw_bar(ind, data, label, xlab, ylab)
 # ## Religious Affiliation
 # 
 # I wanted to take a peak at the different types of churches in San Diego but after getting the types of churches and frequency it was overwhelmingly Christian (1750 out of 1812)
+
+
+# ## Index Check
+# 
+# To make sure none of the queries above fall back to a collection scan, we ask Mongo to explain the plan for each of them and look for the stages that read from an index.
+
+# In[ ]:
+
+INDEX_STAGES = set(['IXSCAN', 'COUNT_SCAN', 'DISTINCT_SCAN', 'IDHACK', 'EXPRESS_IXSCAN', 'GEO_NEAR_2DSPHERE'])
+
+def plan_stages(explain):
+    """
+    Description: Collects the stage names of the winning plan(s) in an explain result
+    
+    Args:
+        explain (dict): The output of an explain command
+
+    Returns:
+        stages (set of str): The stages used, e.g. 'IXSCAN', 'FETCH' or 'COLLSCAN'
+    """
+    stages = set()
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'rejectedPlans':
+                continue
+            if key == 'stage':
+                stages.add(value)
+            stages |= plan_stages(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            stages |= plan_stages(value)
+    return stages
+
+def check_query_plans(collection):
+    """
+    Description: Explains each of our analysis queries and reports whether it is answered from an index
+    
+    Args:
+        collection (str): A string representing the name of the collection in MongoDb you wish to use
+
+    Returns:
+        report (dict): Maps a description of each query to a tuple of (uses an index, stages in the winning plan)
+    """
+    db = collection.database
+    explains = {
+        'find type node': collection.find({'type': 'node'}).explain(),
+        'find type way': collection.find({'type': 'way'}).explain(),
+        'distinct created.user': db.command('explain', SON([('distinct', collection.name), ('key', 'created.user')])),
+        'get_near fast food': collection.find(near_query(32.7157, -117.1611, 2000, {'amenity': 'fast_food'})).explain(),
+        'get_within fast food': collection.find(within_query(32.7065, -117.1640, 32.7150, -117.1580, {'amenity': 'fast_food'})).explain(),
+    }
+    pipelines = {
+        'get_field_counts created.user': field_counts_query('created.user'),
+        'contributor_stats top ten': contributor_query(10),
+        'get_fast_food': fast_food_query(15),
+        'get_fast_food_cuisine_counts': fast_food_cuisine_query(5),
+    }
+    for cuisine_type in ['burgers', 'sandwich', 'mexican', 'pizza', 'chicken']:
+        pipelines['fast_food_by_type ' + cuisine_type] = fast_food_by_type_query(cuisine_type)
+    for name, pipeline in pipelines.items():
+        explains[name] = db.command('aggregate', collection.name, pipeline=pipeline, explain=True)
+
+    report = {}
+    for name, explain in explains.items():
+        stages = plan_stages(explain)
+        report[name] = ('COLLSCAN' not in stages and len(stages & INDEX_STAGES) > 0, sorted(stages))
+    return report
+
+
+# In[ ]:
+
+for name, (indexed, stages) in sorted(check_query_plans(col).items()):
+    print "{:<40}{:<10}{}".format(name, 'index' if indexed else 'NO INDEX', ', '.join(stages))